@@ -0,0 +1,80 @@
+"""
+Renderers for column-oriented versions of the bulk data endpoints
+
+Row-oriented output repeats every key on every row, which for bulk downloads
+makes up much of the payload. Views which support the columnar formats check
+`is_columnar(request)` and return a dict mapping each field name to a list or
+array of values (one per row), built directly from the underlying matrices or
+querysets, which these renderers then serialize as either:
+
+ * a JSON object of parallel arrays (format=columns);
+ * an Apache Arrow IPC stream (format=arrow);
+ * a Parquet file (format=parquet).
+
+Clients can request these either via the `format` parameter in the usual way
+or via the Accept header (see `frontend.negotiation`).
+"""
+
+import numpy
+import pyarrow
+import pyarrow.parquet
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+
+
+def is_columnar(request):
+    return getattr(request.accepted_renderer, "columnar", False)
+
+
+class ColumnsJSONRenderer(JSONRenderer):
+    media_type = "application/vnd.openprescribing.columns+json"
+    format = "columns"
+    columnar = True
+
+
+class ArrowRenderer(BaseRenderer):
+    media_type = "application/vnd.apache.arrow.stream"
+    format = "arrow"
+    charset = None
+    render_style = "binary"
+    columnar = True
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        table = to_table(data)
+        sink = pyarrow.BufferOutputStream()
+        with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+        return sink.getvalue().to_pybytes()
+
+
+class ParquetRenderer(BaseRenderer):
+    media_type = "application/vnd.apache.parquet"
+    format = "parquet"
+    charset = None
+    render_style = "binary"
+    columnar = True
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        sink = pyarrow.BufferOutputStream()
+        pyarrow.parquet.write_table(to_table(data), sink)
+        return sink.getvalue().to_pybytes()
+
+
+COLUMNAR_RENDERERS = [ColumnsJSONRenderer, ArrowRenderer, ParquetRenderer]
+
+
+def to_table(data):
+    """
+    Convert the data returned by a view to an Arrow table
+
+    This is normally a dict of columns, but error responses (e.g. `{"detail":
+    "..."}` or a plain message) get rendered as a table with a single row.
+    """
+    if not isinstance(data, dict):
+        data = {"detail": data}
+    if all(isinstance(value, (list, numpy.ndarray)) for value in data.values()):
+        return pyarrow.table(data)
+    return pyarrow.Table.from_pylist([data])
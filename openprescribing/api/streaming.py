@@ -0,0 +1,121 @@
+"""
+Streaming responses for API endpoints which return long lists of entries
+
+DRF renders the whole of a response's data in one go, so endpoints like
+`spending_by_org` would have to build a list of every entry (potentially
+hundreds of thousands of dicts for practice-level queries) and then hold the
+entire rendered output in memory before sending the first byte. Instead, for
+the JSON and CSV formats, we render entries incrementally from a generator
+so that memory use stays flat however large the response.
+
+The output matches that of DRF's `JSONRenderer` and the `CSVRenderer` from
+`rest_framework_csv`: nested dicts are flattened into dotted column names and
+CSV columns are sorted by name. For any other format (i.e. the browsable API)
+we fall back to an ordinary `Response`.
+"""
+
+import itertools
+
+from django.http import StreamingHttpResponse
+from matrixstore.csv_utils import dicts_to_csv
+from rest_framework.compat import LONG_SEPARATORS, SHORT_SEPARATORS
+from rest_framework.response import Response
+
+# Number of entries to render into each chunk of output. Sending each entry
+# as a separate chunk would mean a write to the socket for every few dozen
+# bytes.
+ENTRIES_PER_CHUNK = 1000
+
+
+def streaming_response(request, entries):
+    """
+    Return a response which renders the iterable of `entries` as a list in
+    the format requested
+    """
+    entries = iter(entries)
+    # Fetch the first entry immediately so that any exceptions raised while
+    # validating the request or running the initial queries get handled by DRF
+    # in the usual way, rather than after we've started sending the response
+    entries = itertools.chain(list(itertools.islice(entries, 1)), entries)
+    renderer = request.accepted_renderer
+    if renderer.format == "json":
+        content = render_json(entries, renderer)
+    elif renderer.format == "csv":
+        content = render_csv(entries)
+    else:
+        return Response(list(entries))
+    content_type = renderer.media_type
+    if renderer.charset:
+        content_type = "{}; charset={}".format(content_type, renderer.charset)
+    return StreamingHttpResponse(content, content_type=content_type)
+
+
+def render_json(entries, renderer):
+    """
+    Render `entries` as a JSON array using the same options as `renderer`
+    """
+    encoder = renderer.encoder_class(
+        ensure_ascii=renderer.ensure_ascii,
+        allow_nan=not renderer.strict,
+        separators=SHORT_SEPARATORS if renderer.compact else LONG_SEPARATORS,
+    )
+    separator = ","
+    yield "["
+    for i, batch in enumerate(batched(entries)):
+        # Encoding a whole batch as a list is much faster than encoding each
+        # entry separately; we just strip the enclosing brackets
+        output = encoder.encode(batch)[1:-1]
+        # See `JSONRenderer.render`
+        output = output.replace("\u2028", "\\u2028").replace("\u2029", "\\u2029")
+        yield separator + output if i else output
+    yield "]"
+
+
+def render_csv(entries):
+    """
+    Render `entries` as CSV with the same columns as `CSVRenderer` would give
+    (on the assumption that all entries have the same keys)
+    """
+    lines = dicts_to_csv(
+        {key: entry[key] for key in sorted(entry)} for entry in map(flatten, entries)
+    )
+    for batch in batched(lines):
+        yield "".join(batch)
+
+
+def iter_rows(columns):
+    """
+    Yield the rows of a dict of equal-length numpy arrays as tuples of native
+    Python values
+
+    We convert the columns a chunk at a time so that, as with rendering, memory
+    use doesn't grow with the number of rows.
+    """
+    columns = list(columns.values())
+    num_rows = len(columns[0]) if columns else 0
+    for start in range(0, num_rows, ENTRIES_PER_CHUNK):
+        end = start + ENTRIES_PER_CHUNK
+        # `tolist` converts numpy scalars to native Python types
+        yield from zip(*[column[start:end].tolist() for column in columns])
+
+
+def flatten(entry, prefix=""):
+    """
+    Flatten nested dicts so that e.g. `{"a": {"b": 1}}` becomes `{"a.b": 1}`
+    """
+    flat = {}
+    for key, value in entry.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, "{}{}.".format(prefix, key)))
+        else:
+            flat[prefix + key] = value
+    return flat
+
+
+def batched(iterable):
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, ENTRIES_PER_CHUNK))
+        if not batch:
+            break
+        yield batch
@@ -54,4 +54,6 @@ urlpatterns = [
     path(r"org_location/", views_org_location.org_location, name="org_location"),
 ]
 
-urlpatterns = format_suffix_patterns(urlpatterns, allowed=["json", "csv"])
+urlpatterns = format_suffix_patterns(
+    urlpatterns, allowed=["json", "csv", "columns", "arrow", "parquet"]
+)
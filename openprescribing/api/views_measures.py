@@ -1,5 +1,6 @@
 import re
 
+from django.db.models import Value
 from frontend.measure_tags import MEASURE_TAGS
 from frontend.models import Measure, MeasureGlobal, MeasureValue, Presentation
 from matrixstore.db import get_db, get_row_grouper
@@ -10,6 +11,7 @@ from rest_framework.response import Response
 from rest_framework_csv.renderers import CSVRenderer
 
 from . import view_utils as utils
+from .renderers import COLUMNAR_RENDERERS, is_columnar
 
 
 class MissingParameter(APIException):
@@ -222,31 +224,41 @@ class MeasureValueCSVRenderer(CSVRenderer):
 
 
 @api_view(["GET"])
-@renderer_classes([JSONRenderer, BrowsableAPIRenderer, MeasureValueCSVRenderer])
+@renderer_classes(
+    [JSONRenderer, BrowsableAPIRenderer, MeasureValueCSVRenderer, *COLUMNAR_RENDERERS]
+)
 def measure_by_regional_team(request, format=None):
     return _measure_by_org(request, "regional_team")
 
 
 @api_view(["GET"])
-@renderer_classes([JSONRenderer, BrowsableAPIRenderer, MeasureValueCSVRenderer])
+@renderer_classes(
+    [JSONRenderer, BrowsableAPIRenderer, MeasureValueCSVRenderer, *COLUMNAR_RENDERERS]
+)
 def measure_by_stp(request, format=None):
     return _measure_by_org(request, "stp")
 
 
 @api_view(["GET"])
-@renderer_classes([JSONRenderer, BrowsableAPIRenderer, MeasureValueCSVRenderer])
+@renderer_classes(
+    [JSONRenderer, BrowsableAPIRenderer, MeasureValueCSVRenderer, *COLUMNAR_RENDERERS]
+)
 def measure_by_ccg(request, format=None):
     return _measure_by_org(request, "ccg")
 
 
 @api_view(["GET"])
-@renderer_classes([JSONRenderer, BrowsableAPIRenderer, MeasureValueCSVRenderer])
+@renderer_classes(
+    [JSONRenderer, BrowsableAPIRenderer, MeasureValueCSVRenderer, *COLUMNAR_RENDERERS]
+)
 def measure_by_pcn(request, format=None):
     return _measure_by_org(request, "pcn")
 
 
 @api_view(["GET"])
-@renderer_classes([JSONRenderer, BrowsableAPIRenderer, MeasureValueCSVRenderer])
+@renderer_classes(
+    [JSONRenderer, BrowsableAPIRenderer, MeasureValueCSVRenderer, *COLUMNAR_RENDERERS]
+)
 def measure_by_practice(request, format=None):
     return _measure_by_org(request, "practice")
 
@@ -280,6 +292,9 @@ def _measure_by_org(request, org_type):
         org_type, parent_org_type, org_ids, measure_ids, tags
     )
 
+    if is_columnar(request):
+        return Response(_measure_value_columns(measure_values, org_type, aggregate))
+
     # Because we access the `name` of the related org for each MeasureValue
     # during the roll-up process below we need to prefetch them to avoid doing
     # N+1 db queries
@@ -393,5 +408,57 @@ def _measure_value_data(measure_value, org_type):
     return measure_value_data
 
 
+def _measure_value_columns(measure_values, org_type, aggregate):
+    """
+    Return the same values as `_measure_value_data` but in columnar form: a
+    dict mapping each field name to a list of values, one for each
+    MeasureValue
+
+    Rather than instantiating a model (and fetching the related org) for each
+    MeasureValue, we fetch just the fields we need as tuples.
+    """
+    fields = [
+        "measure",
+        "date",
+        "numerator",
+        "denominator",
+        "calc_value",
+        "percentile",
+        "cost_savings",
+    ]
+    if aggregate:
+        rows = [
+            (
+                mv.measure_id,
+                mv.month,
+                mv.numerator,
+                mv.denominator,
+                mv.calc_value,
+                mv.percentile,
+                mv.cost_savings,
+            )
+            for mv in measure_values.aggregate_by_measure_and_month()
+        ]
+    else:
+        org_field = org_type if org_type != "ccg" else "pct"
+        fields.extend(["org_type", "org_id", "org_name"])
+        rows = measure_values.values_list(
+            "measure_id",
+            "month",
+            "numerator",
+            "denominator",
+            "calc_value",
+            "percentile",
+            "cost_savings",
+            Value(org_type),
+            f"{org_field}_id",
+            f"{org_field}__name",
+        )
+    columns = {field: list(values) for field, values in zip(fields, zip(*rows))}
+    if not columns:
+        columns = {field: [] for field in fields}
+    return columns
+
+
 def _hydrate_tags(tag_ids):
     return [{"id": tag_id, "name": MEASURE_TAGS[tag_id]["name"]} for tag_id in tag_ids]
@@ -1,11 +1,17 @@
+import numpy
 from django.db.models import Q
 from frontend.models import PCN, PCT, STP, Practice, RegionalTeam
 from matrixstore.db import get_db, get_row_grouper
-from rest_framework.decorators import api_view
+from matrixstore.matrix_ops import is_integer, to_dense
+from rest_framework.decorators import api_view, renderer_classes
 from rest_framework.exceptions import APIException
+from rest_framework.renderers import BrowsableAPIRenderer, JSONRenderer
 from rest_framework.response import Response
+from rest_framework_csv.renderers import CSVRenderer
 
 from . import view_utils as utils
+from .renderers import COLUMNAR_RENDERERS, is_columnar
+from .streaming import iter_rows, streaming_response
 
 STATS_COLUMN_WHITELIST = (
     "total_list_size",
@@ -21,6 +27,9 @@ class KeysNotValid(APIException):
 
 
 @api_view(["GET"])
+@renderer_classes(
+    [JSONRenderer, BrowsableAPIRenderer, CSVRenderer, *COLUMNAR_RENDERERS]
+)
 def org_details(request, format=None):
     """
     Get list size and ASTRO-PU by month, for CCGs or practices.
@@ -32,8 +41,10 @@ def org_details(request, format=None):
     if org_type is None:
         org_type = "all_practices"
     orgs = _get_orgs(org_type, org_codes)
+    if is_columnar(request):
+        return Response(_get_practice_stats_columns(keys, org_type, orgs))
     data = _get_practice_stats_entries(keys, org_type, orgs)
-    return Response(list(data))
+    return streaming_response(request, data)
 
 
 def _get_orgs(org_type, org_codes):
@@ -68,53 +79,72 @@ def _get_orgs(org_type, org_codes):
 
 
 def _get_practice_stats_entries(keys, org_type, orgs):
+    columns = _get_practice_stats_columns(keys, org_type, orgs)
+    fields = list(columns.keys())
+    for values in iter_rows(columns):
+        entry = {}
+        star_pu = {}
+        for name, value in zip(fields, values):
+            if name.startswith("star_pu."):
+                star_pu[name[8:]] = value
+            elif name == "nothing":
+                continue
+            else:
+                entry[name] = value
+        if star_pu:
+            entry["star_pu"] = star_pu
+        if "nothing" in columns:
+            entry["nothing"] = 1
+        yield entry
+
+
+def _get_practice_stats_columns(keys, org_type, orgs):
+    """
+    Return the same data as `_get_practice_stats_entries` but in columnar
+    form: a dict mapping each field name to an array of values, one for each
+    entry, with the nested "star_pu" values given dotted names
+    """
     db = get_db()
-    practice_stats = db.query(*_get_query_and_params(keys))
+    practice_stats = list(db.query(*_get_query_and_params(keys)))
+    # Put the "star_pu" values after the others, matching the entries
+    practice_stats.sort(key=lambda stat: stat[0].startswith("star_pu."))
     group_by_org = get_row_grouper(org_type)
-    practice_stats = [
-        (name, group_by_org.sum(matrix)) for (name, matrix) in practice_stats
-    ]
     # `group_by_org.offsets` maps each organisation's primary key to its row
-    # offset within the matrices. We pair each organisation with its row
-    # offset, ignoring those organisations which aren't in the mapping (which
-    # implies that we have no statistics for them)
-    org_offsets = [
-        (org, group_by_org.offsets[org.pk])
-        for org in orgs
-        if org.pk in group_by_org.offsets
-    ]
-    # For the "all_practices" grouping we have no orgs and just a single row
+    # offset within the matrices. We ignore those organisations which aren't in
+    # the mapping (which implies that we have no statistics for them). For the
+    # "all_practices" grouping we have no orgs and just a single row.
     if org_type == "all_practices":
-        org_offsets = [(None, 0)]
-    date_offsets = sorted(db.date_offsets.items())
-    # Yield entries for each organisation on each date
-    for date, col_offset in date_offsets:
-        for org, row_offset in org_offsets:
-            entry = {"date": date}
-            if org is not None:
-                entry["row_id"] = org.pk
-                entry["row_name"] = org.name
-            index = (row_offset, col_offset)
-            star_pu = {}
-            has_value = False
-            for name, matrix in practice_stats:
-                value = matrix[index]
-                if value != 0:
-                    has_value = True
-                if isinstance(value, float):
-                    value = round(value, 2)
-                if name.startswith("star_pu."):
-                    star_pu[name[8:]] = value
-                else:
-                    entry[name] = value
-            if star_pu:
-                entry["star_pu"] = star_pu
-            # The special "nothing" key always takes the value 1
-            if "nothing" in keys:
-                entry["nothing"] = 1
-                has_value = True
-            if has_value:
-                yield entry
+        org_ids = None
+    else:
+        orgs = [org for org in orgs if org.pk in group_by_org.offsets]
+        org_ids = [org.pk for org in orgs]
+    # Group the statistics for each organisation, giving matrices with a row
+    # for each org and a column for each date. We transpose these so that
+    # entries are ordered by date and then by org.
+    matrices = [
+        (name, to_dense(group_by_org.sum(matrix, group_ids=org_ids)).T)
+        for name, matrix in practice_stats
+    ]
+    num_orgs = len(org_ids) if org_ids is not None else 1
+    # We only return entries which have some non-zero value, except that the
+    # special "nothing" key always takes the value 1
+    has_value = numpy.full((len(db.dates), num_orgs), "nothing" in keys)
+    for name, matrix in matrices:
+        has_value |= matrix != 0
+    date_index, org_index = numpy.nonzero(has_value)
+    columns = {"date": numpy.array(db.dates, dtype=object)[date_index]}
+    if org_ids is not None:
+        columns["row_id"] = numpy.array(org_ids, dtype=object)[org_index]
+        names = numpy.array([org.name for org in orgs], dtype=object)
+        columns["row_name"] = names[org_index]
+    for name, matrix in matrices:
+        values = matrix[date_index, org_index]
+        if not is_integer(values):
+            values = numpy.round(values, 2)
+        columns[name] = values
+    if "nothing" in keys:
+        columns["nothing"] = numpy.ones(len(date_index), dtype=int)
+    return columns
 
 
 def _get_query_and_params(keys):
@@ -1,3 +1,4 @@
+import numpy
 from common.utils import nhs_titlecase, parse_date
 from frontend.ghost_branded_generics import (
     get_ghost_branded_generic_spending,
@@ -13,12 +14,18 @@ from frontend.price_per_unit.savings import (
     get_all_savings_for_orgs,
     get_savings_for_orgs,
 )
+from matrixstore.bnf_prefix_totals import get_totals_for_bnf_code_prefixes
 from matrixstore.db import get_db, get_row_grouper
-from rest_framework.decorators import api_view
+from matrixstore.matrix_ops import get_submatrix, to_dense
+from rest_framework.decorators import api_view, renderer_classes
 from rest_framework.exceptions import APIException, NotFound, ValidationError
+from rest_framework.renderers import BrowsableAPIRenderer, JSONRenderer
 from rest_framework.response import Response
+from rest_framework_csv.renderers import CSVRenderer
 
 from . import view_utils as utils
+from .renderers import COLUMNAR_RENDERERS, is_columnar
+from .streaming import iter_rows, streaming_response
 
 
 class NotValid(APIException):
@@ -338,6 +345,9 @@ def tariff(request, format=None):
 
 
 @api_view(["GET"])
+@renderer_classes(
+    [JSONRenderer, BrowsableAPIRenderer, CSVRenderer, *COLUMNAR_RENDERERS]
+)
 def spending_by_org(request, format=None, org_type=None):
     codes = utils.param_to_list(request.query_params.get("code", []))
     codes = utils.get_bnf_codes_from_number_str(codes)
@@ -356,9 +366,13 @@ def spending_by_org(request, format=None, org_type=None):
             status=400,
         )
 
-    data = list(_get_prescribing_entries(codes, orgs, org_type, date=date))
+    if is_columnar(request):
+        data = _get_prescribing_columns(codes, orgs, org_type, date=date)
+        return Response(data)
 
-    response = Response(data)
+    data = _get_prescribing_entries(codes, orgs, org_type, date=date)
+
+    response = streaming_response(request, data)
     if request.accepted_renderer.format == "csv":
         filename = "spending-by-{}-{}.csv".format(org_type, "-".join(codes))
         response["content-disposition"] = "attachment; filename={}".format(filename)
@@ -429,59 +443,74 @@ def _get_prescribing_entries(bnf_code_prefixes, orgs, org_type, date=None):
     If a date is supplied then data for just that date is returned, otherwise
     all available dates are returned.
     """
+    columns = _get_prescribing_columns(bnf_code_prefixes, orgs, org_type, date=date)
+    fields = list(columns.keys())
+    for values in iter_rows(columns):
+        yield dict(zip(fields, values))
+
+
+def _get_prescribing_columns(bnf_code_prefixes, orgs, org_type, date=None):
+    """
+    Return the same data as `_get_prescribing_entries` but in columnar form:
+    a dict mapping each field name to an array of values, one for each entry
+    """
+    fields = ["items", "quantity", "actual_cost", "date", "row_id", "row_name"]
+    # Practices get some extra attributes in the existing API
+    if org_type == "practice":
+        fields.extend(["ccg", "setting"])
     db = get_db()
     items_matrix, quantity_matrix, actual_cost_matrix = _get_prescribing_for_codes(
         db, bnf_code_prefixes
     )
-    # If no data at all was found, return early which results in an empty
-    # iterator
+    # If no data at all was found, return early with no entries
     if items_matrix is None:
-        return
-    # Group together practice level data to the appropriate organisation level
-    group_by_org = get_row_grouper(org_type)
-    items_matrix = group_by_org.sum(items_matrix)
-    quantity_matrix = group_by_org.sum(quantity_matrix)
-    actual_cost_matrix = group_by_org.sum(actual_cost_matrix)
-    # `group_by_org.offsets` maps each organisation's primary key to its row
-    # offset within the matrices. We pair each organisation with its row
-    # offset, ignoring those organisations which aren't in the mapping (which
-    # implies that they did not prescribe in this period)
-    org_offsets = [
-        (org, group_by_org.offsets[org.pk])
-        for org in orgs
-        if org.pk in group_by_org.offsets
-    ]
-    # Pair each date with its column offset (either all available dates or just
-    # the specified one)
+        return {field: numpy.array([]) for field in fields}
+    # Select either all available dates or just the specified one
     if date:
         try:
-            date_offsets = [(date, db.date_offsets[date])]
+            date_offset = db.date_offsets[date]
         except KeyError:
             raise BadDate(date)
+        dates = [date]
+        cols = slice(date_offset, date_offset + 1)
     else:
-        date_offsets = sorted(db.date_offsets.items())
-    # Yield entries for each organisation on each date
-    for date, col_offset in date_offsets:
-        for org, row_offset in org_offsets:
-            index = (row_offset, col_offset)
-            items = items_matrix[index]
-            # Mimicking the behaviour of the existing API, we don't return
-            # entries where there was no prescribing
-            if items == 0:
-                continue
-            entry = {
-                "items": items,
-                "quantity": quantity_matrix[index],
-                "actual_cost": round(actual_cost_matrix[index], 2),
-                "date": date,
-                "row_id": org.pk,
-                "row_name": org.name,
-            }
-            # Practices get some extra attributes in the existing API
-            if org_type == "practice":
-                entry["ccg"] = org.ccg_id
-                entry["setting"] = org.setting
-            yield entry
+        dates = db.dates
+        cols = slice(None, None)
+    # `group_by_org.offsets` maps each organisation's primary key to its row
+    # offset within the matrices. We ignore those organisations which aren't in
+    # the mapping (which implies that they did not prescribe in this period)
+    group_by_org = get_row_grouper(org_type)
+    orgs = [org for org in orgs if org.pk in group_by_org.offsets]
+    if not orgs:
+        return {field: numpy.array([]) for field in fields}
+    org_ids = [org.pk for org in orgs]
+    # Group together practice level data to the appropriate organisation level,
+    # giving matrices with a row for each org (in order) and a column for each
+    # date. We transpose these so that entries are ordered by date and then by
+    # org.
+    items, quantity, actual_cost = [
+        to_dense(
+            group_by_org.sum(get_submatrix(matrix, cols=cols), group_ids=org_ids)
+        ).T
+        for matrix in [items_matrix, quantity_matrix, actual_cost_matrix]
+    ]
+    # Mimicking the behaviour of the existing API, we don't return entries
+    # where there was no prescribing
+    date_index, org_index = numpy.nonzero(items)
+    columns = {
+        "items": items[date_index, org_index],
+        "quantity": quantity[date_index, org_index],
+        "actual_cost": numpy.round(actual_cost[date_index, org_index], 2),
+        "date": numpy.array(dates, dtype=object)[date_index],
+        "row_id": numpy.array(org_ids, dtype=object)[org_index],
+        "row_name": numpy.array([org.name for org in orgs], dtype=object)[org_index],
+    }
+    if org_type == "practice":
+        ccgs = numpy.array([org.ccg_id for org in orgs], dtype=object)
+        settings = numpy.array([org.setting for org in orgs], dtype=object)
+        columns["ccg"] = ccgs[org_index]
+        columns["setting"] = settings[org_index]
+    return {field: columns[field] for field in fields}
 
 
 def _get_prescribing_for_codes(db, bnf_code_prefixes):
@@ -492,26 +521,17 @@ def _get_prescribing_for_codes(db, bnf_code_prefixes):
     presentations.
     """
     if bnf_code_prefixes:
-        where_clause = " OR ".join(["bnf_code LIKE ?"] * len(bnf_code_prefixes))
-        params = [code + "%" for code in bnf_code_prefixes]
-        sql = """
-            SELECT
-                matrix_sum(items) AS items,
-                matrix_sum(quantity) AS quantity,
-                matrix_sum(actual_cost) AS actual_cost
-            FROM
-                presentation
-            WHERE
-                {}
-            """.format(
-            where_clause
+        # This makes use of precalculated totals for BNF chapters, sections etc
+        # where it can, falling back to summing individual presentations
+        # otherwise
+        items, quantity, actual_cost = get_totals_for_bnf_code_prefixes(
+            db, bnf_code_prefixes, ["items", "quantity", "actual_cost"]
         )
     else:
         # As summing over all presentations can be quite slow we use the
         # precalculated results table
         sql = "SELECT items, quantity, actual_cost FROM all_presentations"
-        params = []
-    items, quantity, actual_cost = db.query_one(sql, params)
+        items, quantity, actual_cost = db.query_one(sql)
     # Convert from pence to pounds
     if actual_cost is not None:
         actual_cost = actual_cost / 100.0
@@ -12,33 +12,36 @@ version. So we attempt to infer the correct price by looking at all prescribing
 of that drug and finding the median price.
 """
 
-import hashlib
-
 import numpy
+from django.conf import settings
 from django.db import connection
 from frontend.models import Presentation
-from matrixstore.cachelib import memoize
+from matrixstore.cachelib import MB, fingerprint, memoize
 from matrixstore.db import get_db, get_row_grouper
-from matrixstore.matrix_ops import get_submatrix
+from matrixstore.matrix_ops import nan_centile
 
 # Minimum difference (positive or negative) between a practice's net costs for
 # a drug and our calculated tariff costs. Any differences below this level we
 # ignore. Value in pence.
 MIN_GHOST_GENERIC_DELTA = 200
 
+# When using the MatrixStore's cube (see `matrixstore.cube`) we handle this
+# many presentations at a time, which bounds the size of the intermediate
+# (presentations X practices) arrays
+CUBE_BATCH_SIZE = 256
+
 
 class SetWithCacheKey(set):
     """
     Set subclass which adds a `cache_key` attribute which is just the hash of
-    the of its values
+    its (sorted) values
     """
 
     cache_key = None
 
     def __new__(cls, items):
         instance = set.__new__(cls, items)
-        hashobj = hashlib.md5(str(sorted(items)).encode("utf8"))
-        instance.cache_key = hashobj.digest()
+        instance.cache_key = fingerprint(sorted(set(items)))
         return instance
 
 
@@ -115,7 +118,9 @@ def get_total_ghost_branded_generic_spending(date, org_type, org_id):
     return group_by_org.sum_one_group(practice_spending, org_id)[0] / 100
 
 
-@memoize()
+@memoize(
+    local_max_bytes=settings.GHOST_GENERICS_LOCAL_CACHE_MB * MB, single_flight=True
+)
 def get_total_ghost_branded_generic_spending_per_practice(
     db, date, presentations_to_ignore, min_delta
 ):
@@ -127,6 +132,10 @@ def get_total_ghost_branded_generic_spending_per_practice(
     for any organisation.
     """
     prices = get_inferred_tariff_prices(db, date, presentations_to_ignore)
+    if db.cube is not None and db.cube.covers(date):
+        return get_total_ghost_branded_generic_spending_per_practice_from_cube(
+            db.cube, date, prices, min_delta
+        )
     bnf_codes = list(prices.keys())
     totals = None
     for bnf_code, quantities, net_costs in get_prescribing(db, bnf_codes, date):
@@ -145,7 +154,32 @@ def get_total_ghost_branded_generic_spending_per_practice(
     return totals
 
 
-@memoize()
+def get_total_ghost_branded_generic_spending_per_practice_from_cube(
+    cube, date, prices, min_delta
+):
+    """
+    Does the same calculation as
+    `get_total_ghost_branded_generic_spending_per_practice` but on batches of
+    presentations at a time, taken from the cube
+    """
+    bnf_codes = list(prices.keys())
+    totals = numpy.zeros((len(cube.practices), 1))
+    for start in range(0, len(bnf_codes), CUBE_BATCH_SIZE):
+        batch = bnf_codes[start : start + CUBE_BATCH_SIZE]
+        quantities, batch = cube.get_rows("quantity", date, batch)
+        net_costs, _ = cube.get_rows("net_cost", date, batch)
+        tariff_prices = numpy.array([prices[bnf_code] for bnf_code in batch])
+        possible_savings = net_costs - quantities * tariff_prices[:, numpy.newaxis]
+        savings_above_threshold = numpy.absolute(possible_savings) >= min_delta
+        totals[:, 0] += numpy.sum(
+            possible_savings, axis=0, where=savings_above_threshold
+        )
+    return totals
+
+
+@memoize(
+    local_max_bytes=settings.GHOST_GENERICS_LOCAL_CACHE_MB * MB, single_flight=True
+)
 def get_inferred_tariff_prices(db, date, presentations_to_ignore):
     """
     Return a dict mapping BNF codes for generics to (our best guess for) their
@@ -192,6 +226,8 @@ def infer_tariff_price_for_presentations(db, bnf_codes, date):
 
     Returns a dict mapping BNF codes to inferred tariff price
     """
+    if db.cube is not None and db.cube.covers(date):
+        return infer_tariff_price_for_presentations_from_cube(db.cube, bnf_codes, date)
     # Silence numpy warnings
     numpy_err = numpy.seterr(divide="ignore", invalid="ignore")
     prices = {}
@@ -216,13 +252,36 @@ def infer_tariff_price_for_presentations(db, bnf_codes, date):
         # which we use elsewhere) because this matches the behaviour of
         # Postgres's PERCENTILE_DISC function on which this calculation was
         # originally based
-        median_ppu = numpy.nanpercentile(ppu, axis=0, q=50, interpolation="lower")[0]
+        median_ppu = nan_centile(ppu, 50, axis=0, method="lower")[0]
         prices[bnf_code] = median_ppu
     # Restore numpy warnings
     numpy.seterr(**numpy_err)
     return prices
 
 
+def infer_tariff_price_for_presentations_from_cube(cube, bnf_codes, date):
+    """
+    Does the same calculation as `infer_tariff_price_for_presentations` but on
+    batches of presentations at a time, taken from the cube
+    """
+    bnf_codes = list(bnf_codes)
+    prices = {}
+    for start in range(0, len(bnf_codes), CUBE_BATCH_SIZE):
+        batch = bnf_codes[start : start + CUBE_BATCH_SIZE]
+        quantities, batch = cube.get_rows("quantity", date, batch)
+        net_costs, _ = cube.get_rows("net_cost", date, batch)
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            ppu = net_costs / quantities
+        # See above for why we skip any presentations with infinite PPUs
+        usable = ~numpy.any(numpy.isinf(ppu), axis=1)
+        if not numpy.any(usable):
+            continue
+        median_ppus = nan_centile(ppu[usable], 50, axis=1, method="lower")
+        usable_codes = [code for code, ok in zip(batch, usable) if ok]
+        prices.update(zip(usable_codes, median_ppus))
+    return prices
+
+
 def get_prescribing_for_orgs(db, bnf_codes, date, org_type, org_ids):
     """
     Get all prescribing for a given set of presentations by the given
@@ -251,20 +310,14 @@ def get_prescribing(db, bnf_codes, date):
 
     Yields tuples of the form: (bnf_code, quantity_matrix, net_cost_matrix)
     """
-    date_column = db.date_offsets[date]
-    date_slice = slice(date_column, date_column + 1)
-
-    results = db.query(
+    results = db.query_columns(
         """
         SELECT bnf_code, quantity, net_cost FROM presentation WHERE bnf_code IN ({})
         """.format(
             ",".join("?" * len(bnf_codes))
         ),
+        (date, date),
         bnf_codes,
     )
     for bnf_code, quantity, net_cost in results:
-        yield (
-            bnf_code,
-            get_submatrix(quantity, cols=date_slice),
-            get_submatrix(net_cost, cols=date_slice),
-        )
+        yield bnf_code, quantity, net_cost
@@ -0,0 +1,193 @@
+"""
+Populates the shared cache with the results of the most expensive cached
+functions for the latest month of data, so that the first visitors after a new
+MatrixStore file goes live don't have to wait for them to be computed.
+
+By default this uses the live MatrixStore file but it can (and ideally should)
+be run against a newly built file before it is made live, using `--filename`.
+Because cache keys include the name of the MatrixStore file, values computed
+this way will be picked up as soon as the application restarts on the new
+file.
+
+Each function is run in a separate worker process and the time taken by each
+is reported at the end.
+"""
+
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.conf import settings
+from django.core.management import BaseCommand
+from django.db import connections
+from frontend.ghost_branded_generics import (
+    MIN_GHOST_GENERIC_DELTA,
+    PRESENTATIONS_TO_IGNORE,
+    get_inferred_tariff_prices,
+    get_total_ghost_branded_generic_spending_per_practice,
+)
+from frontend.models import ImportLog
+from frontend.price_per_unit.savings import (
+    CONFIG_MIN_SAVINGS_FOR_ORG_TYPE,
+    get_total_savings_for_all_orgs,
+)
+from frontend.views.views import (
+    all_england_low_priority_savings,
+    all_england_low_priority_total,
+    all_england_measure_savings,
+    cached,
+)
+from matrixstore.connection import MatrixStore
+from matrixstore.db import get_db
+
+# Entity types which can be selected on the All England dashboard
+ALL_ENGLAND_ENTITY_TYPES = ["CCG", "practice"]
+
+ALL_ENGLAND_FUNCTIONS = [
+    all_england_measure_savings,
+    all_england_low_priority_savings,
+    all_england_low_priority_total,
+]
+
+
+class Command(BaseCommand):
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--filename",
+            help="Name of MatrixStore file in MATRIXSTORE_BUILD_DIR (default: live)",
+        )
+        parser.add_argument(
+            "--processes",
+            type=int,
+            default=os.cpu_count(),
+            help="Number of worker processes to use (default: number of CPUs)",
+        )
+
+    def handle(self, filename=None, processes=None, **kwargs):
+        if filename:
+            path = os.path.join(settings.MATRIXSTORE_BUILD_DIR, filename)
+        else:
+            path = settings.MATRIXSTORE_LIVE_FILE
+        path = os.path.realpath(path)
+        if not settings.ENABLE_CACHING:
+            self.stdout.write(
+                "WARNING: ENABLE_CACHING is not set so results of `cached` "
+                "calls will not be stored"
+            )
+        tasks = get_tasks(path)
+        self.stdout.write(
+            "Warming {} cached functions using {}".format(len(tasks), path)
+        )
+        timings = run_tasks(path, tasks, processes)
+        for name, duration in sorted(timings, key=lambda i: i[1], reverse=True):
+            self.stdout.write("{:>8.1f}s  {}".format(duration, name))
+
+
+def get_tasks(path):
+    """
+    Return a list of (name, function, args) tuples, one for each function we
+    want to warm the cache for
+    """
+    matrixstore = MatrixStore.from_file(path)
+    prescribing_date = matrixstore.dates[-1]
+    matrixstore.close()
+    dashboard_date = ImportLog.objects.latest_in_category("dashboard_data").current_at
+    # Computing the ghost generic totals requires the inferred tariff prices,
+    # so we put this first to give it a head start. Any worker which needs the
+    # prices before they're ready will wait for them rather than computing
+    # them again (see `single_flight` in `matrixstore.cachelib.memoize`)
+    tasks = [
+        (
+            "get_inferred_tariff_prices({})".format(prescribing_date),
+            warm_inferred_tariff_prices,
+            (prescribing_date,),
+        )
+    ]
+    for org_type in CONFIG_MIN_SAVINGS_FOR_ORG_TYPE:
+        tasks.append(
+            (
+                "get_total_savings_for_org_type({}, {})".format(
+                    prescribing_date, org_type
+                ),
+                get_total_savings_for_all_orgs,
+                (prescribing_date, org_type),
+            )
+        )
+    # The All England dashboard shows savings for the latest month of
+    # dashboard data, which may lag behind the latest month of prescribing
+    if str(dashboard_date) != prescribing_date:
+        tasks.append(
+            (
+                "get_total_savings_for_org_type({}, all_standard_practices)".format(
+                    dashboard_date
+                ),
+                get_total_savings_for_all_orgs,
+                (str(dashboard_date), "all_standard_practices"),
+            )
+        )
+    tasks.append(
+        (
+            "get_total_ghost_branded_generic_spending_per_practice({})".format(
+                prescribing_date
+            ),
+            warm_ghost_branded_generic_spending,
+            (prescribing_date,),
+        )
+    )
+    for function in ALL_ENGLAND_FUNCTIONS:
+        for entity_type in ALL_ENGLAND_ENTITY_TYPES:
+            tasks.append(
+                (
+                    "{}({}, {})".format(function.__name__, entity_type, dashboard_date),
+                    cached,
+                    (function, entity_type, dashboard_date),
+                )
+            )
+    return tasks
+
+
+def run_tasks(path, tasks, processes):
+    """
+    Run each task in a pool of worker processes and return a list of (name,
+    duration) pairs
+    """
+    # Database connections must not be shared with the forked workers
+    connections.close_all()
+    # Workers inherit Django's configuration by forking rather than having to
+    # set it up again from scratch
+    context = multiprocessing.get_context("fork")
+    with ProcessPoolExecutor(
+        max_workers=processes,
+        mp_context=context,
+        initializer=initialize_worker,
+        initargs=(path,),
+    ) as executor:
+        futures = {
+            executor.submit(run_task, function, args): name
+            for name, function, args in tasks
+        }
+        return [(futures[future], future.result()) for future in as_completed(futures)]
+
+
+def initialize_worker(path):
+    settings.MATRIXSTORE_LIVE_FILE = path
+    get_db.cache_clear()
+
+
+def run_task(function, args):
+    start = time.monotonic()
+    function(*args)
+    return time.monotonic() - start
+
+
+def warm_inferred_tariff_prices(date):
+    get_inferred_tariff_prices(get_db(), date, PRESENTATIONS_TO_IGNORE)
+
+
+def warm_ghost_branded_generic_spending(date):
+    get_total_ghost_branded_generic_spending_per_practice(
+        get_db(), date, PRESENTATIONS_TO_IGNORE, MIN_GHOST_GENERIC_DELTA
+    )
@@ -15,6 +15,10 @@ class IgnoreAcceptsContentNegotiation(DefaultContentNegotiation):
         """
         # Allow URL style format override.  eg. "?format=json
         requested_format = format_suffix or request.query_params.get("format")
+        # We otherwise ignore the Accept header, except that clients can use it
+        # to ask for one of the columnar formats (see `api.renderers`)
+        if not requested_format:
+            requested_format = self.get_columnar_format(request, renderers)
         found_html = False
         if requested_format:
             renderers = self.filter_renderers(renderers, requested_format)
@@ -26,3 +30,17 @@ class IgnoreAcceptsContentNegotiation(DefaultContentNegotiation):
         if not found_html:
             renderer = renderers[0]
         return renderer, renderer.media_type
+
+    def get_columnar_format(self, request, renderers):
+        """
+        Return the format of the first columnar renderer whose media type
+        appears in the Accept header, if any
+        """
+        accepted = {
+            media_type.split(";")[0].strip().lower()
+            for media_type in self.get_accept_list(request)
+        }
+        for renderer in renderers:
+            if getattr(renderer, "columnar", False) and renderer.media_type in accepted:
+                return renderer.format
+        return None
@@ -1,7 +1,6 @@
 import numpy
 from frontend.models import Presentation
 from matrixstore.db import get_db, get_row_grouper
-from matrixstore.matrix_ops import get_submatrix
 
 from .substitution_sets import get_substitution_sets
 
@@ -27,13 +26,10 @@ def get_prescribing(generic_code, date):
         bnf_codes = [generic_code]
 
     db = get_db()
-    try:
-        date_column = db.date_offsets[date]
-    except KeyError:
+    if date not in db.date_offsets:
         return {}
-    date_slice = slice(date_column, date_column + 1)
 
-    results = db.query(
+    results = db.query_columns(
         """
         SELECT
           bnf_code, quantity, net_cost
@@ -44,15 +40,10 @@ def get_prescribing(generic_code, date):
         """.format(
             ",".join("?" * len(bnf_codes))
         ),
+        (date, date),
         bnf_codes,
     )
-    return {
-        bnf_code: (
-            get_submatrix(quantity, cols=date_slice),
-            get_submatrix(net_cost, cols=date_slice),
-        )
-        for bnf_code, quantity, net_cost in results
-    }
+    return {bnf_code: (quantity, net_cost) for bnf_code, quantity, net_cost in results}
 
 
 def get_ppu_breakdown(prescribing, org_type, org_id):
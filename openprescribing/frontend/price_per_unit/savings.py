@@ -1,7 +1,8 @@
 import numpy
-from matrixstore.cachelib import memoize
+from django.conf import settings
+from matrixstore.cachelib import MB, memoize
 from matrixstore.db import get_db, get_row_grouper
-from matrixstore.matrix_ops import get_submatrix, zeros_like
+from matrixstore.matrix_ops import nan_centile
 from matrixstore.sql_functions import MatrixSum
 
 from .substitution_sets import get_substitution_sets
@@ -24,21 +25,23 @@ CONFIG_MIN_SAVINGS_FOR_ORG_TYPE = {
     # based on the CCG limit
     "all_standard_practices": 50000 * 100,
 }
+# We calculate savings for this many substitution sets at a time (see
+# `iter_savings_batches`), which bounds the size of the intermediate
+# (practices X substitution sets) arrays
+BATCH_SIZE = 256
 
 
 def get_all_savings_for_orgs(date, org_type, org_ids):
     """
     Get all available savings through presentation switches for the given orgs
     """
-    min_saving = CONFIG_MIN_SAVINGS_FOR_ORG_TYPE[org_type]
-    results = []
-    for generic_code in get_substitution_sets().keys():
-        savings = get_savings_for_orgs(
-            generic_code, date, org_type, org_ids, min_saving=min_saving
-        )
-        results.extend(savings)
-    results.sort(key=lambda i: i["possible_savings"], reverse=True)
-    return results
+    return get_savings_for_substitution_sets(
+        list(get_substitution_sets().values()),
+        date,
+        org_type,
+        org_ids,
+        min_saving=CONFIG_MIN_SAVINGS_FOR_ORG_TYPE[org_type],
+    )
 
 
 def get_savings_for_orgs(generic_code, date, org_type, org_ids, min_saving=1):
@@ -52,45 +55,30 @@ def get_savings_for_orgs(generic_code, date, org_type, org_ids, min_saving=1):
     # substitutions (to which the answer is always: no savings)
     except KeyError:
         return []
-
-    quantities, net_costs = get_quantities_and_net_costs_at_date(
-        get_db(), substitution_set, date
+    return get_savings_for_substitution_sets(
+        [substitution_set], date, org_type, org_ids, min_saving=min_saving
     )
 
-    group_by_org = get_row_grouper(org_type)
-    quantities_for_orgs = group_by_org.sum(quantities, org_ids)
-    # Bail early if none of the orgs have any relevant prescribing
-    if not numpy.any(quantities_for_orgs):
-        return []
-    net_costs_for_orgs = group_by_org.sum(net_costs, org_ids)
-    ppu_for_orgs = net_costs_for_orgs / quantities_for_orgs
 
-    target_ppu = get_target_ppu(
-        quantities,
-        net_costs,
-        group_by_org=get_row_grouper(CONFIG_TARGET_PEER_GROUP),
+def get_savings_for_substitution_sets(
+    substitution_sets, date, org_type, org_ids, min_saving
+):
+    """
+    Get available savings for the given orgs within each of the supplied
+    substitution sets, largest first
+    """
+    group_by_org = get_row_grouper(org_type)
+    results = []
+    for batch in iter_savings_batches(
+        get_db(),
+        substitution_sets,
+        date,
+        practice_group_by_org=get_row_grouper(CONFIG_TARGET_PEER_GROUP),
         target_centile=CONFIG_TARGET_CENTILE,
-    )
-    practice_savings = get_savings(quantities, net_costs, target_ppu)
-
-    savings_for_orgs = group_by_org.sum(practice_savings, org_ids)
-
-    results = [
-        {
-            "date": date,
-            "org_id": org_id,
-            "price_per_unit": ppu_for_orgs[offset, 0] / 100,
-            "possible_savings": savings_for_orgs[offset, 0] / 100,
-            "quantity": quantities_for_orgs[offset, 0],
-            "lowest_decile": target_ppu[0] / 100,
-            "presentation": substitution_set.id,
-            "formulation_swap": substitution_set.formulation_swaps,
-            "name": substitution_set.name,
-        }
-        for offset, org_id in enumerate(org_ids)
-        if savings_for_orgs[offset, 0] >= min_saving
-    ]
-
+        group_by_org=group_by_org,
+        org_ids=org_ids,
+    ):
+        results.extend(batch.get_results(date, group_by_org, org_ids, min_saving))
     results.sort(key=lambda i: i["possible_savings"], reverse=True)
     return results
 
@@ -99,29 +87,42 @@ def get_total_savings_for_org(date, org_type, org_id):
     """
     Get total available savings through presentation switches for the given org
     """
-    group_by_org = get_row_grouper(org_type)
-    substitution_sets = get_substitution_sets()
+    totals = get_total_savings_for_all_orgs(date, org_type)
     # This only happens during testing where a test case might not have enough
     # different presentations to generate any substitutions. If this is the
     # case then their are, obviously, zero savings available.
-    if not substitution_sets:
+    if totals is None:
         return 0.0
-    totals = get_total_savings_for_org_type(
+    offset = get_row_grouper(org_type).offsets[org_id]
+    return totals[offset, 0] / 100
+
+
+def get_total_savings_for_all_orgs(date, org_type):
+    """
+    Return a matrix giving total available savings for every org of the given
+    type (or None if there are no substitutions available)
+    """
+    substitution_sets = get_substitution_sets()
+    if not substitution_sets:
+        return None
+    return get_total_savings_for_org_type(
         db=get_db(),
         substitution_sets=substitution_sets,
         date=date,
-        group_by_org=group_by_org,
+        group_by_org=get_row_grouper(org_type),
         min_saving=CONFIG_MIN_SAVINGS_FOR_ORG_TYPE[org_type],
         practice_group_by_org=get_row_grouper(CONFIG_TARGET_PEER_GROUP),
         target_centile=CONFIG_TARGET_CENTILE,
     )
-    offset = group_by_org.offsets[org_id]
-    return totals[offset, 0] / 100
 
 
 # Increment the version number if the logic of this function changes such that
 # the same inputs no longer produce the same outputs
-@memoize(version=1)
+@memoize(
+    version=2,
+    local_max_bytes=settings.PPU_SAVINGS_LOCAL_CACHE_MB * MB,
+    single_flight=True,
+)
 def get_total_savings_for_org_type(
     db,
     substitution_sets,
@@ -134,34 +135,144 @@ def get_total_savings_for_org_type(
     """
     Return a matrix giving total savings for all orgs of a given type
 
-    This duplicates some of the logic in `get_savings_for_orgs` but it gives us
-    much better caching behaviour to calculate savings for all orgs of a given
-    type together in a single, cacheable matrix than it does to do them one by
-    one.
+    It gives us much better caching behaviour to calculate savings for all orgs
+    of a given type together in a single, cacheable matrix than it does to do
+    them one by one.
 
     Because we want this function to be cacheable it needs to touch no global
     state or configuration and have eveything passed into it, hence the
     slightly convoluted call signature.
     """
     totals = None
-    for substitution_set in substitution_sets.values():
-        quantities, net_costs = get_quantities_and_net_costs_at_date(
-            db, substitution_set, date
+    for batch in iter_savings_batches(
+        db,
+        list(substitution_sets.values()),
+        date,
+        practice_group_by_org,
+        target_centile,
+    ):
+        savings_for_orgs = group_by_org.sum(batch.practice_savings)
+        batch_totals = numpy.sum(
+            savings_for_orgs,
+            axis=1,
+            keepdims=True,
+            where=savings_for_orgs >= min_saving,
         )
+        totals = batch_totals if totals is None else totals + batch_totals
+    assert totals is not None
+    return totals
+
+
+class SavingsBatch:
+    """
+    Practice-level quantities, net costs and savings for a batch of
+    substitution sets, with each set represented by a column of a (practices X
+    sets) matrix, together with the target price-per-unit for each set
+    """
+
+    def __init__(self, substitution_sets, quantities, net_costs, target_ppu):
+        self.substitution_sets = substitution_sets
+        self.quantities = quantities
+        self.net_costs = net_costs
+        self.target_ppu = target_ppu
+        self.practice_savings = get_savings(quantities, net_costs, target_ppu)
+
+    def get_results(self, date, group_by_org, org_ids, min_saving):
+        """
+        Return a savings dict for every combination of org and substitution
+        set where the org could save at least `min_saving`
+        """
+        savings_for_orgs = group_by_org.sum(self.practice_savings, org_ids)
+        # Transpose so we get offsets ordered by substitution set, then by org
+        set_offsets, org_offsets = numpy.nonzero(savings_for_orgs.T >= min_saving)
+        quantities = group_by_org.sum(self.quantities, org_ids)
+        net_costs = group_by_org.sum(self.net_costs, org_ids)
+        quantities = quantities[org_offsets, set_offsets]
+        ppu = net_costs[org_offsets, set_offsets] / quantities
+        savings = savings_for_orgs[org_offsets, set_offsets]
+        target_ppu = self.target_ppu[set_offsets]
+        substitution_sets = [self.substitution_sets[i] for i in set_offsets]
+        return [
+            {
+                "date": date,
+                "org_id": org_ids[org_offset],
+                "price_per_unit": ppu[n] / 100,
+                "possible_savings": savings[n] / 100,
+                "quantity": quantities[n],
+                "lowest_decile": target_ppu[n] / 100,
+                "presentation": substitution_set.id,
+                "formulation_swap": substitution_set.formulation_swaps,
+                "name": substitution_set.name,
+            }
+            for n, (org_offset, substitution_set) in enumerate(
+                zip(org_offsets.tolist(), substitution_sets)
+            )
+        ]
+
+
+def iter_savings_batches(
+    db,
+    substitution_sets,
+    date,
+    practice_group_by_org,
+    target_centile,
+    group_by_org=None,
+    org_ids=None,
+):
+    """
+    Calculate practice-level savings for every one of the supplied
+    substitution sets, yielding a `SavingsBatch` for each batch of sets
+
+    Rather than handling each set separately, we stack the quantities and net
+    costs for a batch of sets into (practices X sets) matrices so that the
+    target price-per-unit and savings for every set can be calculated in a
+    handful of numpy operations
+
+    If `org_ids` (and the corresponding `group_by_org`) are supplied then we
+    skip any sets which none of these orgs prescribe, as they can't have any
+    savings, before doing the relatively expensive target price-per-unit
+    calculation
+    """
+    for start in range(0, len(substitution_sets), BATCH_SIZE):
+        batch = substitution_sets[start : start + BATCH_SIZE]
+        quantities, net_costs = get_quantities_and_net_costs_for_batch(db, batch, date)
+        if org_ids is not None:
+            quantities_for_orgs = group_by_org.sum(quantities, org_ids)
+            prescribed = numpy.any(quantities_for_orgs, axis=0)
+            if not prescribed.any():
+                continue
+            if not prescribed.all():
+                batch = [batch[i] for i in numpy.flatnonzero(prescribed)]
+                quantities = quantities[:, prescribed]
+                net_costs = net_costs[:, prescribed]
         target_ppu = get_target_ppu(
             quantities,
             net_costs,
             group_by_org=practice_group_by_org,
             target_centile=target_centile,
         )
-        practice_savings = get_savings(quantities, net_costs, target_ppu)
-        savings_for_orgs = group_by_org.sum(practice_savings)
-        savings_above_threshold = savings_for_orgs >= min_saving
-        if totals is None:
-            totals = zeros_like(savings_for_orgs)
-        numpy.add(totals, savings_for_orgs, out=totals, where=savings_above_threshold)
-    assert totals is not None
-    return totals
+        yield SavingsBatch(batch, quantities, net_costs, target_ppu)
+
+
+def get_quantities_and_net_costs_for_batch(db, substitution_sets, date):
+    """
+    Return (practices X sets) matrices giving the total quantity and net cost
+    over the presentations in each of the supplied substitution sets
+    """
+    if db.cube is not None and db.cube.covers(date):
+        grouping = db.cube.get_grouping_matrix(
+            [s.presentations for s in substitution_sets]
+        )
+        quantities = (grouping @ db.cube.get("quantity", date)).T
+        net_costs = (grouping @ db.cube.get("net_cost", date)).T
+        return quantities, net_costs
+    matrices = [
+        get_quantities_and_net_costs_at_date(db, substitution_set, date)
+        for substitution_set in substitution_sets
+    ]
+    quantities = numpy.hstack([quantities for quantities, _ in matrices])
+    net_costs = numpy.hstack([net_costs for _, net_costs in matrices])
+    return quantities, net_costs
 
 
 def get_target_ppu(quantities, net_costs, group_by_org, target_centile):
@@ -172,7 +283,7 @@ def get_target_ppu(quantities, net_costs, group_by_org, target_centile):
     quantities = group_by_org.sum(quantities)
     net_costs = group_by_org.sum(net_costs)
     ppu = net_costs / quantities
-    target_ppu = numpy.nanpercentile(ppu, axis=0, q=target_centile)
+    target_ppu = nan_centile(ppu, target_centile, axis=0)
     return target_ppu
 
 
@@ -190,18 +301,17 @@ def get_savings(quantities, net_costs, target_ppu):
 
 
 # Increment the version number if the logic of this function changes such that
-# the same inputs no longer produce the same outputs
-@memoize(version=1)
+# the same inputs no longer produce the same outputs. This gets called once for
+# every substitution set, hence the relatively large in-process cache.
+@memoize(version=1, local_max_bytes=settings.PPU_QUANTITIES_LOCAL_CACHE_MB * MB)
 def get_quantities_and_net_costs_at_date(db, substitution_set, date):
     """
     Sum quantities and net costs over the supplied list of BNF codes for just
     the specified date.
     """
     bnf_codes = substitution_set.presentations
-    date_column = db.date_offsets[date]
-    date_slice = slice(date_column, date_column + 1)
-
-    results = db.query(
+    # Only fetch data for the specified date
+    results = db.query_columns(
         """
         SELECT
           quantity, net_cost
@@ -212,12 +322,13 @@ def get_quantities_and_net_costs_at_date(db, substitution_set, date):
         """.format(
             ",".join("?" * len(bnf_codes))
         ),
+        (date, date),
         bnf_codes,
     )
 
     quantity_sum = MatrixSum()
     net_cost_sum = MatrixSum()
     for quantity, net_cost in results:
-        quantity_sum.add(get_submatrix(quantity, cols=date_slice))
-        net_cost_sum.add(get_submatrix(net_cost, cols=date_slice))
+        quantity_sum.add(quantity)
+        net_cost_sum.add(net_cost)
     return quantity_sum.value(), net_cost_sum.value()
@@ -9,12 +9,12 @@ fetch a string giving the formulation of each presentation.
 """
 
 import functools
-import hashlib
 from pathlib import Path
 
 from django.db import connection
 from django.db.models import Max
 from dmd.models import PriceInfo
+from matrixstore.cachelib import Fingerprint, fingerprint
 from matrixstore.db import get_db
 
 
@@ -42,24 +42,24 @@ class SubstitutionSet:
         # `cache_key` is used to identify the state of this SubstitutionSet for
         # caching purposes i.e.  SubstitutionSet instances should have the same
         # cache_key if and only if they have same list of presentations
-        hashobj = hashlib.md5(str(self.presentations).encode("utf8"))
-        self.cache_key = hashobj.digest()
+        self.cache_key = fingerprint(list(self.presentations))
 
 
 class DictWithCacheID(dict):
     """
     Dict subclass which adds a `cache_key` attribute which is just the hash of
-    the cache_keys of its values
+    its keys and the cache_keys of its values
     """
 
     cache_key = None
 
     def __new__(cls, items):
         instance = dict.__new__(cls, items)
-        hashobj = hashlib.md5()
+        fingerprint = Fingerprint()
         for key, value in items:
-            hashobj.update(value.cache_key)
-        instance.cache_key = hashobj.digest()
+            fingerprint.update(key)
+            fingerprint.update(value.cache_key)
+        instance.cache_key = fingerprint.digest()
         return instance
 
 
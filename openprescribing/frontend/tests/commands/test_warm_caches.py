@@ -0,0 +1,52 @@
+import datetime
+import os
+import shutil
+import sqlite3
+import tempfile
+
+from django.test import TestCase
+from frontend.management.commands.warm_caches import get_tasks, run_task
+from frontend.models import ImportLog
+from matrixstore.tests.data_factory import DataFactory
+from matrixstore.tests.import_test_data_fast import import_test_data_fast
+
+
+class WarmCachesTest(TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, "matrixstore.sqlite")
+        factory = DataFactory()
+        factory.create_all(start_date="2020-01-01", num_months=2, num_practices=2)
+        connection = sqlite3.connect(self.path)
+        import_test_data_fast(connection, factory, "2020-02", months=2)
+        connection.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_get_tasks(self):
+        ImportLog.objects.create(
+            category="dashboard_data", current_at=datetime.date(2020, 2, 1)
+        )
+        names = [name for name, _, _ in get_tasks(self.path)]
+        self.assertIn("get_total_savings_for_org_type(2020-02-01, ccg)", names)
+        # The inferred tariff prices are needed by other tasks so come first
+        self.assertEqual(names[0], "get_inferred_tariff_prices(2020-02-01)")
+        self.assertIn("all_england_measure_savings(practice, 2020-02-01)", names)
+        self.assertEqual(len(names), len(set(names)))
+        self.assertEqual(len(names), 11)
+
+    def test_get_tasks_with_earlier_dashboard_data(self):
+        ImportLog.objects.create(
+            category="dashboard_data", current_at=datetime.date(2020, 1, 1)
+        )
+        names = [name for name, _, _ in get_tasks(self.path)]
+        self.assertIn(
+            "get_total_savings_for_org_type(2020-01-01, all_standard_practices)",
+            names,
+        )
+        self.assertIn("all_england_low_priority_total(CCG, 2020-01-01)", names)
+        self.assertEqual(len(names), 12)
+
+    def test_run_task_returns_duration(self):
+        self.assertGreaterEqual(run_task(sorted, ([2, 1],)), 0)
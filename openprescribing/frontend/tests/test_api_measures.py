@@ -329,6 +329,41 @@ class TestAPIMeasureViews(ApiTestBase):
         self.assertEqual(d["calc_value"], None)
         self.assertEqual(d["cost_savings"]["10"], 0.0)
 
+    def test_api_measure_by_practice_as_columns(self):
+        url = "/api/1.0/measure_by_practice/"
+        url += "?org=C84001&measure=cerazette&format=columns"
+        data = self._get_json(url)
+        self.assertEqual(
+            list(data),
+            [
+                "measure",
+                "date",
+                "numerator",
+                "denominator",
+                "calc_value",
+                "percentile",
+                "cost_savings",
+                "org_type",
+                "org_id",
+                "org_name",
+            ],
+        )
+        self.assertEqual(data["measure"], ["cerazette"])
+        self.assertEqual(data["numerator"], [1000])
+        self.assertEqual(data["denominator"], [11000])
+        self.assertEqual("%.2f" % data["cost_savings"][0]["10"], "485.58")
+        self.assertEqual(data["org_type"], ["practice"])
+        self.assertEqual(data["org_id"], ["C84001"])
+        self.assertEqual(data["org_name"], ["LARWOOD SURGERY"])
+
+    def test_api_measure_by_all_practices_aggregated_as_columns(self):
+        url = "/api/1.0/measure_by_practice/"
+        url += "?measure=cerazette&aggregate=true&format=columns"
+        data = self._get_json(url)
+        self.assertNotIn("org_id", data)
+        self.assertEqual(data["numerator"], [85500])
+        self.assertEqual(data["denominator"], [181500])
+
     def test_api_two_practices_one_measure(self):
         # Regression test
         url = "/api/1.0/measure_by_practice/"
@@ -1,6 +1,16 @@
 import csv
+import io
+import json
+from unittest import mock
+
+import numpy
+import pyarrow.parquet
+from api.streaming import ENTRIES_PER_CHUNK
+from api.views_org_details import _get_practice_stats_entries
+from django.test import SimpleTestCase
 
 from .api_test_base import ApiTestBase
+from .test_api_spending import TrackedArray
 
 
 class TestAPIOrgDetailsViews(ApiTestBase):
@@ -9,7 +19,7 @@ class TestAPIOrgDetailsViews(ApiTestBase):
         url += "/org_details?format=csv"
         response = self.client.get(url, follow=True)
         self.assertEqual(response.status_code, 200)
-        rows = list(csv.DictReader(response.content.decode("utf8").splitlines()))
+        rows = list(csv.DictReader(response.getvalue().decode("utf8").splitlines()))
         self.assertEqual(len(rows), 2)
         self.assertEqual(rows[0]["date"], "2015-01-01")
         self.assertEqual(float(rows[0]["total_list_size"]), 1260)
@@ -22,7 +32,7 @@ class TestAPIOrgDetailsViews(ApiTestBase):
         url += "/org_details?format=csv&org_type=ccg"
         response = self.client.get(url, follow=True)
         self.assertEqual(response.status_code, 200)
-        rows = list(csv.DictReader(response.content.decode("utf8").splitlines()))
+        rows = list(csv.DictReader(response.getvalue().decode("utf8").splitlines()))
         self.assertEqual(len(rows), 4)
         self.assertEqual(rows[1]["row_id"], "03V")
         self.assertEqual(rows[1]["row_name"], "NHS Corby")
@@ -32,12 +42,46 @@ class TestAPIOrgDetailsViews(ApiTestBase):
         self.assertEqual(rows[1]["star_pu.oral_antibacterials_item"], "45.3")
         self.assertEqual(float(rows[1]["total_list_size"]), 648)
 
+    def test_api_view_org_details_all_ccgs_as_json(self):
+        url = self.api_prefix
+        url += "/org_details?format=json&org_type=ccg"
+        response = self.client.get(url, follow=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        rows = json.loads(response.getvalue().decode("utf8"))
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(rows[1]["row_id"], "03V")
+        self.assertEqual(rows[1]["date"], "2015-01-01")
+        self.assertEqual(rows[1]["astro_pu_cost"], 363.3)
+        self.assertEqual(rows[1]["star_pu"]["oral_antibacterials_item"], 45.3)
+
+    def test_api_view_org_details_no_orgs_as_json(self):
+        url = self.api_prefix
+        url += "/org_details?format=json&org_type=ccg&org=XXX"
+        response = self.client.get(url, follow=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.getvalue().decode("utf8")), [])
+
+    def test_api_view_org_details_all_ccgs_as_parquet(self):
+        url = self.api_prefix
+        url += "/org_details.parquet?org_type=ccg"
+        response = self.client.get(url, follow=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["content-type"], "application/vnd.apache.parquet")
+        table = pyarrow.parquet.read_table(io.BytesIO(response.content))
+        rows = table.to_pylist()
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(rows[1]["row_id"], "03V")
+        self.assertEqual(rows[1]["date"], "2015-01-01")
+        self.assertEqual(rows[1]["astro_pu_cost"], 363.3)
+        self.assertEqual(rows[1]["star_pu.oral_antibacterials_item"], 45.3)
+
     def test_api_view_org_details_all_ccgs_with_keys(self):
         url = self.api_prefix
         url += "/org_details?format=csv&org_type=ccg&keys=total_list_size"
         response = self.client.get(url, follow=True)
         self.assertEqual(response.status_code, 200)
-        rows = list(csv.DictReader(response.content.decode("utf8").splitlines()))
+        rows = list(csv.DictReader(response.getvalue().decode("utf8").splitlines()))
         self.assertEqual(len(rows), 4)
         self.assertEqual(rows[1]["row_id"], "03V")
         self.assertEqual(rows[1]["row_name"], "NHS Corby")
@@ -50,14 +94,14 @@ class TestAPIOrgDetailsViews(ApiTestBase):
         url += "/org_details?format=csv&org_type=ccg&keys=nothing"
         response = self.client.get(url, follow=True)
         self.assertEqual(response.status_code, 200)
-        list(csv.DictReader(response.content.decode("utf8").splitlines()))
+        list(csv.DictReader(response.getvalue().decode("utf8").splitlines()))
 
     def test_api_view_org_details_all_ccgs_with_unpermitted_key(self):
         url = self.api_prefix
         url += "/org_details?format=csv&org_type=ccg&keys=borg"
         response = self.client.get(url, follow=True)
         self.assertEqual(response.status_code, 400)
-        rows = list(csv.DictReader(response.content.decode("utf8").splitlines()))
+        rows = list(csv.DictReader(response.getvalue().decode("utf8").splitlines()))
         self.assertEqual(rows[0]["detail"], "borg is not a valid key")
 
     def test_api_view_org_details_all_ccgs_with_json_key(self):
@@ -68,7 +112,7 @@ class TestAPIOrgDetailsViews(ApiTestBase):
         )
         response = self.client.get(url, follow=True)
         self.assertEqual(response.status_code, 200)
-        rows = list(csv.DictReader(response.content.decode("utf8").splitlines()))
+        rows = list(csv.DictReader(response.getvalue().decode("utf8").splitlines()))
         self.assertEqual(rows[1]["row_id"], "03V")
         self.assertEqual(rows[1]["row_name"], "NHS Corby")
         self.assertEqual(rows[1]["date"], "2015-01-01")
@@ -79,7 +123,7 @@ class TestAPIOrgDetailsViews(ApiTestBase):
         url += "/org_details?format=csv&org_type=ccg&org=03V"
         response = self.client.get(url, follow=True)
         self.assertEqual(response.status_code, 200)
-        rows = list(csv.DictReader(response.content.decode("utf8").splitlines()))
+        rows = list(csv.DictReader(response.getvalue().decode("utf8").splitlines()))
         self.assertEqual(len(rows), 2)
         self.assertEqual(rows[0]["row_id"], "03V")
         self.assertEqual(rows[0]["row_name"], "NHS Corby")
@@ -94,7 +138,7 @@ class TestAPIOrgDetailsViews(ApiTestBase):
         url += "/org_details?format=csv&org_type=practice"
         response = self.client.get(url, follow=True)
         self.assertEqual(response.status_code, 200)
-        rows = list(csv.DictReader(response.content.decode("utf8").splitlines()))
+        rows = list(csv.DictReader(response.getvalue().decode("utf8").splitlines()))
         self.assertEqual(len(rows), 10)  # 5 practices, 2 months
         self.assertEqual(rows[0]["row_id"], "B82018")
         self.assertEqual(rows[0]["row_name"], "ESCRICK SURGERY")
@@ -111,7 +155,7 @@ class TestAPIOrgDetailsViews(ApiTestBase):
         url += "/org_details?format=csv&org_type=practice&org=03V"
         response = self.client.get(url, follow=True)
         self.assertEqual(response.status_code, 200)
-        rows = list(csv.DictReader(response.content.decode("utf8").splitlines()))
+        rows = list(csv.DictReader(response.getvalue().decode("utf8").splitlines()))
         self.assertEqual(len(rows), 6)  # 3 practices, 2 months
         self.assertIn("K83622", [row["row_id"] for row in rows])
         self.assertEqual(rows[0]["row_id"], "K83059")
@@ -126,7 +170,7 @@ class TestAPIOrgDetailsViews(ApiTestBase):
         url += "/org_details?format=csv&org_type=practice&org=03Q"
         response = self.client.get(url, follow=True)
         self.assertEqual(response.status_code, 200)
-        rows = list(csv.DictReader(response.content.decode("utf8").splitlines()))
+        rows = list(csv.DictReader(response.getvalue().decode("utf8").splitlines()))
         self.assertEqual(len(rows), 4)  # 2 practices, 2 months
         self.assertNotIn("K83622", [row["row_id"] for row in rows])
 
@@ -135,7 +179,7 @@ class TestAPIOrgDetailsViews(ApiTestBase):
         url += "/org_details?format=csv&org_type=practice&org=N84014"
         response = self.client.get(url, follow=True)
         self.assertEqual(response.status_code, 200)
-        rows = list(csv.DictReader(response.content.decode("utf8").splitlines()))
+        rows = list(csv.DictReader(response.getvalue().decode("utf8").splitlines()))
         self.assertEqual(len(rows), 2)  # 2 months
         self.assertEqual(rows[0]["row_id"], "N84014")
         self.assertEqual(rows[0]["row_name"], "AINSDALE VILLAGE SURGERY")
@@ -153,7 +197,7 @@ class TestAPIOrgDetailsViews(ApiTestBase):
         )
         response = self.client.get(url, follow=True)
         self.assertEqual(response.status_code, 200)
-        rows = list(csv.DictReader(response.content.decode("utf8").splitlines()))
+        rows = list(csv.DictReader(response.getvalue().decode("utf8").splitlines()))
         self.assertEqual(len(rows), 2)  # 2 months
         self.assertEqual(rows[0]["row_id"], "N84014")
         self.assertEqual(rows[0]["row_name"], "AINSDALE VILLAGE SURGERY")
@@ -170,7 +214,7 @@ class TestAPIOrgDetailsViews(ApiTestBase):
         )
         response = self.client.get(url, follow=True)
         self.assertEqual(response.status_code, 200)
-        rows = list(csv.DictReader(response.content.decode("utf8").splitlines()))
+        rows = list(csv.DictReader(response.getvalue().decode("utf8").splitlines()))
         self.assertEqual(len(rows), 2)
         self.assertEqual(rows[0]["date"], "2015-01-01")
         self.assertEqual(float(rows[0]["total_list_size"]), 1260)
@@ -182,7 +226,7 @@ class TestAPIOrgDetailsViews(ApiTestBase):
         url += "/org_details?format=csv&org_type=stp&org=E55"
         response = self.client.get(url, follow=True)
         self.assertEqual(response.status_code, 200)
-        rows = list(csv.DictReader(response.content.decode("utf8").splitlines()))
+        rows = list(csv.DictReader(response.getvalue().decode("utf8").splitlines()))
         self.assertEqual(len(rows), 2)
         self.assertEqual(rows[0]["row_id"], "E55")
         self.assertEqual(rows[0]["row_name"], "Northamptonshire")
@@ -197,7 +241,7 @@ class TestAPIOrgDetailsViews(ApiTestBase):
         url += "/org_details?format=csv&org_type=regional_team&org=Y55"
         response = self.client.get(url, follow=True)
         self.assertEqual(response.status_code, 200)
-        rows = list(csv.DictReader(response.content.decode("utf8").splitlines()))
+        rows = list(csv.DictReader(response.getvalue().decode("utf8").splitlines()))
         self.assertEqual(len(rows), 2)
         self.assertEqual(rows[0]["row_id"], "Y55")
         self.assertEqual(
@@ -214,7 +258,7 @@ class TestAPIOrgDetailsViews(ApiTestBase):
         url += "/org_details?format=csv&org_type=pcn&org=PCN0001"
         response = self.client.get(url, follow=True)
         self.assertEqual(response.status_code, 200)
-        rows = list(csv.DictReader(response.content.decode("utf8").splitlines()))
+        rows = list(csv.DictReader(response.getvalue().decode("utf8").splitlines()))
         self.assertEqual(len(rows), 2)
         self.assertEqual(rows[0]["row_id"], "PCN0001")
         self.assertEqual(rows[0]["row_name"], "Transformational Sustainability")
@@ -223,3 +267,26 @@ class TestAPIOrgDetailsViews(ApiTestBase):
         self.assertEqual(rows[0]["astro_pu_items"], "342.2")
         self.assertEqual(rows[0]["star_pu.oral_antibacterials_item"], "34.2")
         self.assertEqual(float(rows[0]["total_list_size"]), 468)
+
+
+class TestPracticeStatsEntries(SimpleTestCase):
+    def test_columns_are_converted_in_chunks(self):
+        TrackedArray.converted = []
+        num_rows = ENTRIES_PER_CHUNK * 3
+        columns = {
+            "total_list_size": numpy.arange(num_rows).view(TrackedArray),
+            "star_pu.oral_antibacterials_item": numpy.ones(num_rows).view(TrackedArray),
+        }
+        with mock.patch(
+            "api.views_org_details._get_practice_stats_columns",
+            return_value=columns,
+        ):
+            entries = _get_practice_stats_entries([], "practice", [])
+            self.assertEqual(
+                next(entries),
+                {"total_list_size": 0, "star_pu": {"oral_antibacterials_item": 1.0}},
+            )
+            # Only the first chunk of each column has been converted
+            self.assertEqual(TrackedArray.converted, [ENTRIES_PER_CHUNK] * 2)
+            self.assertEqual(len(list(entries)), num_rows - 1)
+        self.assertEqual(TrackedArray.converted, [ENTRIES_PER_CHUNK] * 6)
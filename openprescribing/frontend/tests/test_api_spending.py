@@ -1,9 +1,13 @@
 import csv
 import json
 from collections import defaultdict
+from unittest import mock
 
 import numpy as np
-from django.test import TestCase
+import pyarrow
+from api.streaming import ENTRIES_PER_CHUNK
+from api.views_spending import _get_prescribing_entries
+from django.test import SimpleTestCase, TestCase
 from dmd.models import VMPP
 from frontend.ghost_branded_generics import MIN_GHOST_GENERIC_DELTA
 from frontend.models import Prescription, TariffPrice
@@ -97,7 +101,7 @@ class TestSpending(ApiTestBase):
 
     def _get_rows(self, params):
         rsp = self._get(params)
-        return list(csv.DictReader(rsp.content.decode("utf8").splitlines()))
+        return list(csv.DictReader(rsp.getvalue().decode("utf8").splitlines()))
 
     def test_404_returned_for_unknown_short_code(self):
         params = {"code": "0"}
@@ -171,7 +175,7 @@ class TestSpendingByCCG(ApiTestBase):
 
     def _get_rows(self, params):
         rsp = self._get(params)
-        return list(csv.DictReader(rsp.content.decode("utf8").splitlines()))
+        return list(csv.DictReader(rsp.getvalue().decode("utf8").splitlines()))
 
     def test_total_spending_by_ccg(self):
         rows = self._get_rows({})
@@ -322,7 +326,7 @@ class TestSpendingByPractice(ApiTestBase):
 
     def _get_rows(self, params):
         rsp = self._get(params)
-        return list(csv.DictReader(rsp.content.decode("utf8").splitlines()))
+        return list(csv.DictReader(rsp.getvalue().decode("utf8").splitlines()))
 
     def test_spending_by_all_practices_on_product_without_date(self):
         response = self._get({"code": "0204000I0BC"})
@@ -342,6 +346,92 @@ class TestSpendingByPractice(ApiTestBase):
         self.assertEqual(rows[0]["items"], "41")
         self.assertEqual(rows[0]["quantity"], "2544.0")
 
+    def test_total_spending_by_practice_as_json(self):
+        params = {"date": "2014-11-01", "format": "json"}
+        rsp = self.client.get("/api/1.0/spending_by_practice/", params)
+        self.assertTrue(rsp.streaming)
+        self.assertEqual(rsp["content-type"], "application/json")
+        rows = json.loads(rsp.getvalue().decode("utf8"))
+
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(
+            rows[0],
+            {
+                "items": 41,
+                "quantity": 2544.0,
+                "actual_cost": 166.28,
+                "date": "2014-11-01",
+                "row_id": "K83059",
+                "row_name": "DR KHALID & PARTNERS",
+                "ccg": "03V",
+                "setting": -1,
+            },
+        )
+
+    def test_total_spending_by_practice_as_columns(self):
+        params = {"date": "2014-11-01", "format": "columns"}
+        rsp = self.client.get("/api/1.0/spending_by_practice/", params)
+        self.assertEqual(rsp.status_code, 200)
+        columns = json.loads(rsp.content.decode("utf8"))
+        rows = self._get_rows({"date": "2014-11-01"})
+
+        self.assertEqual(
+            list(columns),
+            [
+                "items",
+                "quantity",
+                "actual_cost",
+                "date",
+                "row_id",
+                "row_name",
+                "ccg",
+                "setting",
+            ],
+        )
+        self.assertEqual(columns["row_id"], [row["row_id"] for row in rows])
+        self.assertEqual(columns["date"], ["2014-11-01", "2014-11-01"])
+        self.assertEqual(columns["actual_cost"][0], 166.28)
+        self.assertEqual(columns["items"][0], 41)
+
+    def test_total_spending_by_practice_as_arrow(self):
+        rsp = self.client.get(
+            "/api/1.0/spending_by_practice/",
+            {"date": "2014-11-01"},
+            HTTP_ACCEPT="application/vnd.apache.arrow.stream",
+        )
+        self.assertEqual(rsp.status_code, 200)
+        self.assertEqual(rsp["content-type"], "application/vnd.apache.arrow.stream")
+        table = pyarrow.ipc.open_stream(rsp.content).read_all()
+        rows = self._get_rows({"date": "2014-11-01"})
+
+        self.assertEqual(table.num_rows, 2)
+        self.assertEqual(table["row_id"].to_pylist(), [r["row_id"] for r in rows])
+        self.assertEqual(table["actual_cost"][0].as_py(), 166.28)
+        self.assertEqual(table["items"][0].as_py(), 41)
+
+    def test_total_spending_by_practice_with_malformed_date_as_arrow(self):
+        rsp = self.client.get(
+            "/api/1.0/spending_by_practice/", {"date": "2015-1-1", "format": "arrow"}
+        )
+        self.assertEqual(rsp.status_code, 404)
+        table = pyarrow.ipc.open_stream(rsp.content).read_all()
+        self.assertEqual(
+            table.to_pylist(), [{"detail": "Dates must be in YYYY-MM-DD format"}]
+        )
+
+    def test_total_spending_by_practice_csv_is_streamed_as_attachment(self):
+        rsp = self._get({"date": "2014-11-01", "code": "0204000I0"})
+        self.assertTrue(rsp.streaming)
+        self.assertEqual(rsp["content-type"], "text/csv; charset=utf-8")
+        self.assertEqual(
+            rsp["content-disposition"],
+            "attachment; filename=spending-by-practice-0204000I0.csv",
+        )
+        header = rsp.getvalue().decode("utf8").splitlines()[0]
+        self.assertEqual(
+            header, "actual_cost,ccg,date,items,quantity,row_id,row_name,setting"
+        )
+
     def test_total_spending_by_practice_with_old_date(self):
         params = {"date": "1066-11-01"}
         rsp = self._get(params)
@@ -519,7 +609,7 @@ class TestSpendingByOrg(ApiTestBase):
 
     def _get_rows(self, params):
         rsp = self._get(params)
-        return list(csv.DictReader(rsp.content.decode("utf8").splitlines()))
+        return list(csv.DictReader(rsp.getvalue().decode("utf8").splitlines()))
 
     def test_spending_by_all_stps(self):
         rows = self._get_rows({"org_type": "stp"})
@@ -881,3 +971,36 @@ class TestAPISpendingViewsPPUBubble(ApiTestBase):
                 "plotline": 0.08875,
             },
         )
+
+
+class TrackedArray(np.ndarray):
+    """
+    Array which records the length of every array converted to a list
+    """
+
+    converted = None
+
+    def tolist(self):
+        self.converted.append(len(self))
+        return super().tolist()
+
+
+class TestPrescribingEntries(SimpleTestCase):
+    def test_columns_are_converted_in_chunks(self):
+        TrackedArray.converted = []
+        num_rows = ENTRIES_PER_CHUNK * 3
+        columns = {
+            "items": np.arange(num_rows).view(TrackedArray),
+            "row_id": np.array(
+                ["P{}".format(i) for i in range(num_rows)], dtype=object
+            ).view(TrackedArray),
+        }
+        with mock.patch(
+            "api.views_spending._get_prescribing_columns", return_value=columns
+        ):
+            entries = _get_prescribing_entries([], [], "practice")
+            self.assertEqual(next(entries), {"items": 0, "row_id": "P0"})
+            # Only the first chunk of each column has been converted
+            self.assertEqual(TrackedArray.converted, [ENTRIES_PER_CHUNK] * 2)
+            self.assertEqual(len(list(entries)), num_rows - 1)
+        self.assertEqual(TrackedArray.converted, [ENTRIES_PER_CHUNK] * 6)
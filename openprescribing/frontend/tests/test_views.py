@@ -4,6 +4,7 @@ from urllib.parse import parse_qs, urlparse
 
 import mock
 from django.conf import settings
+from django.contrib.auth.models import User
 from django.core import mail
 from django.core.management import call_command
 from django.http import QueryDict
@@ -682,6 +683,12 @@ class TestCacheWrapper(SimpleTestCase):
             cached(test_func)
         self.assertEqual(test_func.call_count, 2)
 
+    def test_none_results_are_not_cached(self):
+        test_func = Mock(__name__="test_none_func", return_value=None)
+        cached(test_func)
+        cached(test_func)
+        self.assertEqual(test_func.call_count, 2)
+
     def test_no_caching_if_not_enabled(self):
         test_func = Mock(__name__="test_func", return_value="foo")
         with override_settings(ENABLE_CACHING=False):
@@ -690,6 +697,22 @@ class TestCacheWrapper(SimpleTestCase):
         self.assertEqual(test_func.call_count, 2)
 
 
+class TestMemoizeStatsView(TestCase):
+    def test_requires_staff_user(self):
+        response = self.client.get("/admin/memoize-stats/")
+        self.assertEqual(response.status_code, 302)
+
+    def test_returns_stats(self):
+        user = User.objects.create_user(
+            username="staff", email="staff@example.com", is_staff=True
+        )
+        self.client.force_login(user)
+        response = self.client.get("/admin/memoize-stats/")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["pid"], os.getpid())
+        self.assertIn("functions", response.json())
+
+
 class TestNationalRedirects(TestCase):
     def test_dashboard(self):
         self.assertRedirects(
@@ -12,11 +12,12 @@ from common.utils import parse_date
 from dateutil.relativedelta import relativedelta
 from django.conf import settings
 from django.contrib import messages
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.models import User
 from django.core.cache import cache
 from django.core.mail import EmailMultiAlternatives
 from django.db.models import Avg, Sum
-from django.http import Http404, HttpResponse
+from django.http import Http404, HttpResponse, JsonResponse
 from django.http.response import HttpResponseRedirect
 from django.shortcuts import get_object_or_404, redirect, render
 from django.template.loader import render_to_string
@@ -60,6 +61,7 @@ from frontend.views.spending_utils import (
 )
 from gcutils.bigquery import interpolate_sql
 from lxml import html
+from matrixstore.cachelib import get_memoize_stats, get_or_set_single_flight
 from matrixstore.db import latest_prescribing_date, org_has_prescribing
 
 logger = logging.getLogger(__name__)
@@ -359,6 +361,11 @@ def regional_team_home_page(request, regional_team_code):
 ##################################################
 
 
+# How long (in seconds) `cached` waits for another worker to compute a value
+# before computing it itself
+CACHED_MAX_WAIT = 5
+
+
 def cached(function, *args):
     """
     Wrapper which caches the result of calling `function` with the supplied
@@ -373,14 +380,23 @@ def cached(function, *args):
     key_parts = [settings.SOURCE_COMMIT_ID, __name__, function.__name__]
     key_parts.extend(map(str, args))
     key = ":".join(key_parts)
-    result = cache.get(key)
-    if result is None:
-        result = function(*args)
-        # We cache for a week which is likely to be the maximum useful lifetime
-        # of these values, given that they are invalidated on every deploy. (We
-        # don't need to worry about stale data after an import as the functions
-        # we're caching include a date in their arguments)
-        cache.set(key, result, timeout=60 * 60 * 24 * 7)
+    # Where several requests for the same uncached value arrive at once (e.g.
+    # just after a deploy) we only want one worker to compute it while the
+    # others wait for the result. But we don't want to tie up a worker waiting
+    # for long, so after a few seconds we give up and compute it ourselves.
+    #
+    # We cache for a week which is likely to be the maximum useful lifetime of
+    # these values, given that they are invalidated on every deploy. (We don't
+    # need to worry about stale data after an import as the functions we're
+    # caching include a date in their arguments)
+    result, _ = get_or_set_single_flight(
+        cache,
+        key,
+        functools.partial(function, *args),
+        timeout=60 * 60 * 24 * 7,
+        max_wait=CACHED_MAX_WAIT,
+        cache_none=False,
+    )
     return result
 
 
@@ -1353,6 +1369,13 @@ def ping(request):
     return HttpResponse(rsp)
 
 
+# Reports cache statistics for memoized functions. Note that these are per
+# process, so each request may be served by a different worker.
+@staff_member_required
+def memoize_stats(request):
+    return JsonResponse({"pid": os.getpid(), "functions": get_memoize_stats()})
+
+
 ##################################################
 # Helpers
 ##################################################
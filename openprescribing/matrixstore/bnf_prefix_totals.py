@@ -0,0 +1,133 @@
+"""
+Provides totals over all presentations matching a list of BNF code prefixes,
+making use of the precalculated totals in the `bnf_prefix_totals` table where
+possible (see `matrixstore.build.precalculate_bnf_prefix_totals`) and only
+falling back to summing individual presentations where we have to
+"""
+
+from bisect import bisect_left
+
+# Lengths of the BNF code prefixes for which we precalculate totals
+BNF_PREFIX_LENGTHS = (
+    2,  # Chapter
+    4,  # Section
+    6,  # Paragraph
+    7,  # Subparagraph
+    9,  # Chemical
+)
+
+MATRIX_FIELDS = ("items", "quantity", "actual_cost", "net_cost")
+
+
+def get_totals_for_bnf_code_prefixes(db, bnf_code_prefixes, fields):
+    """
+    Return a list of matrices, one for each of the supplied `fields`, giving the
+    totals over all presentations which match any of the supplied BNF code
+    prefixes
+
+    As with MATRIX_SUM, the values returned will be None if no presentations
+    match. Because we may end up summing over many thousands of presentations
+    we use the multi-threaded version of MATRIX_SUM.
+    """
+    for field in fields:
+        if field not in MATRIX_FIELDS:
+            raise ValueError("Unknown field: {}".format(field))
+    nodes, fallback_clauses, fallback_params = get_query_plan(
+        db.precalculated_bnf_prefixes, bnf_code_prefixes
+    )
+    columns = ", ".join(fields)
+    subqueries = []
+    params = []
+    if nodes:
+        subqueries.append(
+            "SELECT {} FROM bnf_prefix_totals WHERE prefix IN ({})".format(
+                columns, ",".join("?" * len(nodes))
+            )
+        )
+        params.extend(nodes)
+    if fallback_clauses:
+        subqueries.append(
+            "SELECT {} FROM presentation WHERE {}".format(
+                columns, " OR ".join(fallback_clauses)
+            )
+        )
+        params.extend(fallback_params)
+    if not subqueries:
+        return [None] * len(fields)
+    sql = "SELECT {} FROM ({})".format(
+        ", ".join("PARALLEL_MATRIX_SUM({0}) AS {0}".format(field) for field in fields),
+        " UNION ALL ".join(subqueries),
+    )
+    return db.query_one(sql, params)
+
+
+def get_query_plan(precalculated_prefixes, bnf_code_prefixes):
+    """
+    Break the supplied BNF code prefixes into the smallest number of
+    precalculated prefixes we can, plus a list of SQL clauses (and their
+    parameters) which select any remaining presentations not covered by those
+    precalculated prefixes
+
+    Returns a triple of the form:
+
+        precalculated_prefixes, sql_clauses, sql_params
+    """
+    sorted_precalculated = None
+    nodes = []
+    clauses = []
+    params = []
+    for prefix in remove_redundant_prefixes(bnf_code_prefixes):
+        if prefix in precalculated_prefixes:
+            nodes.append(prefix)
+            continue
+        # Where the prefix is shorter than a chemical code, but isn't one of
+        # the precalculated lengths, we can still make use of any precalculated
+        # prefixes at the next level down which it contains
+        next_length = next((n for n in BNF_PREFIX_LENGTHS if n > len(prefix)), None)
+        children = []
+        if next_length is not None and len(prefix) not in BNF_PREFIX_LENGTHS:
+            if sorted_precalculated is None:
+                sorted_precalculated = sorted(precalculated_prefixes)
+            children = get_prefixes_starting_with(
+                sorted_precalculated, prefix, next_length
+            )
+        if children:
+            nodes.extend(children)
+            clauses.append(
+                "(bnf_code LIKE ? AND substr(bnf_code, 1, {:d}) NOT IN ({}))".format(
+                    next_length, ",".join("?" * len(children))
+                )
+            )
+            params.append(prefix + "%")
+            params.extend(children)
+        else:
+            clauses.append("bnf_code LIKE ?")
+            params.append(prefix + "%")
+    return nodes, clauses, params
+
+
+def remove_redundant_prefixes(bnf_code_prefixes):
+    """
+    Remove any prefixes which are themselves matched by another prefix in the
+    list, as otherwise we would count the matching presentations twice
+    """
+    prefixes = []
+    for prefix in sorted(set(bnf_code_prefixes)):
+        if prefixes and prefix.startswith(prefixes[-1]):
+            continue
+        prefixes.append(prefix)
+    return prefixes
+
+
+def get_prefixes_starting_with(sorted_prefixes, prefix, length):
+    """
+    Return all prefixes of the given length which start with `prefix`
+    """
+    matches = []
+    for i in range(bisect_left(sorted_prefixes, prefix), len(sorted_prefixes)):
+        candidate = sorted_prefixes[i]
+        if not candidate.startswith(prefix):
+            break
+        if len(candidate) == length:
+            matches.append(candidate)
+    return matches
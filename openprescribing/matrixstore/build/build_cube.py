@@ -0,0 +1,67 @@
+"""
+Optionally write dense (presentations X practices) arrays of quantity and net
+cost for the latest few months into a memory-mapped cube file alongside the
+SQLite file.
+
+See `matrixstore.cube` for details.
+"""
+
+import logging
+import os.path
+import sqlite3
+
+import numpy
+from matrixstore.connection import MatrixStore
+from matrixstore.cube import CubeWriter, get_cube_path
+from matrixstore.matrix_ops import to_dense
+
+logger = logging.getLogger(__name__)
+
+
+def build_cube(sqlite_path, num_months):
+    if not os.path.exists(sqlite_path):
+        raise RuntimeError("No SQLite file at: {}".format(sqlite_path))
+    connection = sqlite3.connect(sqlite_path)
+    build_cube_for_db(connection, get_cube_path(sqlite_path), num_months)
+    connection.close()
+
+
+def build_cube_for_db(connection, cube_path, num_months):
+    matrixstore = MatrixStore(connection)
+    dates = matrixstore.dates[-num_months:]
+    logger.info(
+        "Finding presentations prescribed between %s and %s", dates[0], dates[-1]
+    )
+    bnf_codes = [
+        bnf_code
+        for bnf_code, quantity, net_cost in get_prescribing(matrixstore, dates)
+        if numpy.any(quantity) or numpy.any(net_cost)
+    ]
+    logger.info("Writing cube file for %s presentations: %s", len(bnf_codes), cube_path)
+    writer = CubeWriter(cube_path, bnf_codes, matrixstore.practices, dates)
+    offsets = {bnf_code: i for i, bnf_code in enumerate(bnf_codes)}
+    for bnf_code, quantity, net_cost in get_prescribing(matrixstore, dates):
+        if bnf_code not in offsets:
+            continue
+        row = offsets[bnf_code]
+        for n, date in enumerate(dates):
+            writer.arrays[date, "quantity"][row] = quantity[:, n]
+            writer.arrays[date, "net_cost"][row] = net_cost[:, n]
+    writer.close()
+
+
+def get_prescribing(matrixstore, dates):
+    """
+    Yield the BNF code of every presentation along with its quantity and net
+    cost as dense (practices X dates) arrays
+    """
+    results = matrixstore.query_columns(
+        """
+        SELECT bnf_code, quantity, net_cost FROM presentation
+        WHERE quantity IS NOT NULL
+        ORDER BY bnf_code
+        """,
+        (dates[0], dates[-1]),
+    )
+    for bnf_code, quantity, net_cost in results:
+        yield bnf_code, to_dense(quantity), to_dense(net_cost)
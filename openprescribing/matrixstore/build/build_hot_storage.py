@@ -0,0 +1,90 @@
+"""
+Optionally move the matrices for the most heavily prescribed presentations
+(which we use as a proxy for the most frequently requested) into an
+uncompressed, memory-mapped hot storage file alongside the SQLite file.
+
+See `matrixstore.hot_storage` for details.
+"""
+
+import heapq
+import logging
+import os.path
+import sqlite3
+
+from matrixstore.connection import MatrixStore
+from matrixstore.hot_storage import (
+    HotStorageWriter,
+    get_hot_storage_path,
+    make_reference,
+)
+from matrixstore.serializer import serialize
+
+logger = logging.getLogger(__name__)
+
+
+def build_hot_storage(sqlite_path, num_presentations):
+    if not os.path.exists(sqlite_path):
+        raise RuntimeError("No SQLite file at: {}".format(sqlite_path))
+    connection = sqlite3.connect(sqlite_path)
+    # Disable the sqlite module's magical transaction handling features because
+    # we want to use our own transactions below
+    previous_isolation_level = connection.isolation_level
+    connection.isolation_level = None
+    build_hot_storage_for_db(
+        connection, get_hot_storage_path(sqlite_path), num_presentations
+    )
+    connection.isolation_level = previous_isolation_level
+    connection.commit()
+    connection.close()
+
+
+def build_hot_storage_for_db(connection, hot_storage_path, num_presentations):
+    matrixstore = MatrixStore(connection)
+    logger.info("Finding %s most prescribed presentations", num_presentations)
+    bnf_codes = get_most_prescribed_presentations(matrixstore, num_presentations)
+    logger.info("Writing hot storage file: %s", hot_storage_path)
+    writer = HotStorageWriter(hot_storage_path)
+    locations = {}
+    for bnf_code in bnf_codes:
+        values = matrixstore.query_one(
+            """
+            SELECT items, quantity, actual_cost, net_cost
+            FROM presentation
+            WHERE bnf_code=?
+            """,
+            [bnf_code],
+        )
+        locations[bnf_code] = [writer.add(serialize(value)) for value in values]
+    storage_id = writer.close()
+    cursor = connection.cursor()
+    # We want the entire update to be an atomic operation. We use savepoints
+    # for this which are equivalent to transactions except they're allowed to
+    # nest so it doesn't matter if we're already inside a transaction when we
+    # get here.
+    cursor.execute("SAVEPOINT build_hot_storage")
+    for bnf_code in bnf_codes:
+        references = [
+            make_reference(storage_id, offset, length)
+            for offset, length in locations[bnf_code]
+        ]
+        cursor.execute(
+            """
+            UPDATE presentation SET items=?, quantity=?, actual_cost=?, net_cost=?
+            WHERE bnf_code=?
+            """,
+            references + [bnf_code],
+        )
+    cursor.execute("RELEASE build_hot_storage")
+    logger.info("Moved %s presentations to hot storage", len(bnf_codes))
+
+
+def get_most_prescribed_presentations(matrixstore, num_presentations):
+    """
+    Return the BNF codes of the `num_presentations` presentations with the
+    most items prescribed, in BNF code order
+    """
+    results = matrixstore.query(
+        "SELECT bnf_code, items FROM presentation WHERE items IS NOT NULL"
+    )
+    totals = ((items.sum(), bnf_code) for bnf_code, items in results)
+    return sorted(bnf_code for _, bnf_code in heapq.nlargest(num_presentations, totals))
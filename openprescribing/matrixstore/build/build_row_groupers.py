@@ -0,0 +1,36 @@
+"""
+Build the row groupers (which map practices to CCGs, PCNs, STPs etc.) for a
+MatrixStore file using the org relationships currently in the database and
+write them to a sidecar file alongside it.
+
+See `matrixstore.row_grouper_storage` for details.
+"""
+
+import logging
+import os
+
+from matrixstore.build.common import get_temp_filename
+from matrixstore.connection import MatrixStore
+from matrixstore.db import ORG_TYPES, build_row_grouper
+from matrixstore.row_grouper_storage import get_row_groupers_path, write_row_groupers
+
+logger = logging.getLogger(__name__)
+
+
+def build_row_groupers(sqlite_path):
+    if not os.path.exists(sqlite_path):
+        raise RuntimeError("No SQLite file at: {}".format(sqlite_path))
+    matrixstore = MatrixStore.from_file(sqlite_path)
+    row_groupers = {
+        org_type: build_row_grouper(org_type, matrixstore.practice_offsets)
+        for org_type in ORG_TYPES
+    }
+    output_path = get_row_groupers_path(sqlite_path)
+    logger.info("Writing row groupers to: %s", output_path)
+    # Write to a temporary file and then rename so that a running application
+    # never sees a partially written file
+    temp_path = get_temp_filename(output_path)
+    write_row_groupers(temp_path, matrixstore.practices, row_groupers)
+    os.rename(temp_path, output_path)
+    matrixstore.close()
+    return output_path
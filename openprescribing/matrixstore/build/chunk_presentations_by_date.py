@@ -0,0 +1,70 @@
+"""
+Optionally re-serialize the prescribing matrices for each presentation so that
+they are split by date into separately compressed blocks of one or more months.
+
+Code which only needs data for a single month (e.g. price-per-unit and ghost
+branded generics analyses) can then use `MatrixStore.query_columns` to
+decompress just the blocks it needs rather than the full five years of data.
+"""
+
+import logging
+import os.path
+import sqlite3
+
+from matrixstore.serializer import deserialize, serialize_chunked
+
+logger = logging.getLogger(__name__)
+
+
+def chunk_presentations_by_date(sqlite_path, months_per_chunk):
+    if not os.path.exists(sqlite_path):
+        raise RuntimeError("No SQLite file at: {}".format(sqlite_path))
+    connection = sqlite3.connect(sqlite_path)
+    # Disable the sqlite module's magical transaction handling features because
+    # we want to use our own transactions below
+    previous_isolation_level = connection.isolation_level
+    connection.isolation_level = None
+    chunk_presentations_by_date_for_db(connection, months_per_chunk)
+    connection.isolation_level = previous_isolation_level
+    connection.commit()
+    connection.close()
+
+
+def chunk_presentations_by_date_for_db(connection, months_per_chunk):
+    logger.info(
+        "Splitting presentation matrices into %s month chunks", months_per_chunk
+    )
+    bnf_codes = [
+        bnf_code
+        for (bnf_code,) in connection.execute("SELECT bnf_code FROM presentation")
+    ]
+    cursor = connection.cursor()
+    # We want the entire update to be an atomic operation. We use savepoints
+    # for this which are equivalent to transactions except they're allowed to
+    # nest so it doesn't matter if we're already inside a transaction when we
+    # get here.
+    cursor.execute("SAVEPOINT chunk_presentations")
+    for bnf_code in bnf_codes:
+        values = cursor.execute(
+            """
+            SELECT items, quantity, actual_cost, net_cost
+            FROM presentation
+            WHERE bnf_code=?
+            """,
+            [bnf_code],
+        ).fetchone()
+        cursor.execute(
+            """
+            UPDATE presentation SET items=?, quantity=?, actual_cost=?, net_cost=?
+            WHERE bnf_code=?
+            """,
+            [rechunk_value(value, months_per_chunk) for value in values] + [bnf_code],
+        )
+    cursor.execute("RELEASE chunk_presentations")
+    logger.info("Finished chunking %s presentations", len(bnf_codes))
+
+
+def rechunk_value(value, months_per_chunk):
+    if value is None:
+        return None
+    return serialize_chunked(deserialize(value), months_per_chunk)
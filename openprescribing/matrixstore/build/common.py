@@ -2,6 +2,7 @@ import errno
 import os
 import os.path
 import tempfile
+from collections import deque
 
 from django.conf import settings
 
@@ -15,9 +16,14 @@ def get_practice_stats_filename(date):
 
 def get_prescribing_filename(date):
     """
-    Return the full path to the prescribing CSV file this date
+    Return the full path to the file of sorted prescribing data for this date
+
+    Unlike the other files this isn't CSV but contains parsed data in the
+    format written by `import_prescribing.write_run`
     """
-    return _get_filename(date, "prescribing")
+    return os.path.join(
+        settings.MATRIXSTORE_IMPORT_DIR, "{}_prescribing.run".format(date)
+    )
 
 
 def get_filename_for_download(remote_filename):
@@ -49,6 +55,21 @@ def get_temp_filename(filename):
     )
 
 
+def map_in_order(executor, function, iterable, max_pending):
+    """
+    Like `executor.map` but consumes `iterable` lazily, keeping only a bounded
+    number of tasks in flight so we never hold more than a few batches of
+    input in memory at once
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append(executor.submit(function, item))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
 def _get_filename(date, type_name):
     return os.path.join(
         settings.MATRIXSTORE_IMPORT_DIR, "{}_{}.csv.gz".format(date, type_name)
@@ -1,23 +1,29 @@
 """
-Download prescribing data from BigQuery to gzipped CSV files in the
+Download prescribing data from BigQuery to files of sorted, parsed data in the
 `settings.MATRIXSTORE_IMPORT_DIR` directory
 """
+
 import glob
 import logging
 import os
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
 
 from django.conf import settings
-
 from gcutils.bigquery import Client, StorageClient
 
 from .common import (
-    get_prescribing_filename,
     get_filename_for_download,
+    get_prescribing_filename,
     get_temp_filename,
 )
 from .dates import generate_dates
-from .sort_and_merge_gzipped_csv_files import sort_and_merge_gzipped_csv_files
-
+from .import_prescribing import run_is_current
+from .sort_prescribing import sort_and_merge_prescribing_files
 
 logger = logging.getLogger(__name__)
 
@@ -27,8 +33,21 @@ logger = logging.getLogger(__name__)
 # the export has finished using the suffix below
 SENTINEL_SUFFIX = "done"
 
+# Maximum number of dates which can be at each stage of the process at once
+CONCURRENCY = {"extract": 4, "export": 4, "download": 2, "consolidate": 1}
+
+# Number of files downloaded in parallel for each date
+DOWNLOAD_THREADS = 8
 
-def download_prescribing(end_date, months=None):
+
+def download_prescribing(end_date, months=None, concurrency=None):
+    bq_client = Client("prescribing_export")
+    bucket = StorageClient().bucket()
+    dates = generate_dates(end_date, months=months)
+    download_prescribing_for_dates(dates, bq_client, bucket, concurrency=concurrency)
+
+
+def download_prescribing_for_dates(dates, bq_client, bucket, concurrency=None):
     # Getting a local copy of prescribing data for a given month is a
     # multi-stage process:
     #
@@ -37,44 +56,104 @@ def download_prescribing(end_date, months=None):
     # 2. Export that table to Google Cloud Storage (which will end up sharded
     #    into multiple files)
     # 3. Download those shard files
-    # 4. Consolidate the shards into a single file, sorted by BNF code
-    bq_client = Client("prescribing_export")
-    bucket = StorageClient().bucket()
+    # 4. Consolidate the shards into a single file of parsed data, sorted by
+    #    BNF code
+    #
     # To determine what steps to execute we need to work backwards through this
     # process. For instance, if we already have data downloaded for a given
     # date then there is no point checking whether the corresponding files
     # exist in Google Cloud Storage (they may have been deleted as part of a
     # cleanup in any case). So we start with all the dates we want and then filter
     # out anyting we've already got.
-    dates = generate_dates(end_date, months=months)
     dates_to_consolidate = filter_dates_to_consolidate(dates)
     dates_to_download = filter_dates_to_download(dates_to_consolidate)
     dates_to_export = filter_dates_to_export(dates_to_download, bucket)
     dates_to_extract = filter_dates_to_extract(dates_to_export, bq_client)
-    # Once we know what needs doing we loop over the required dates and carry
-    # out the tasks. There's obvious scope for speeding this up by doing things
-    # in parallel, but we keep it simple for now.
+    concurrency = dict(CONCURRENCY, **(concurrency or {}))
+    # Each consolidation gets an equal share of the CPUs for sorting
+    processes = max(1, (os.cpu_count() or 1) // concurrency["consolidate"])
+    steps_for_dates = {}
     for date in dates:
+        steps = []
         if date in dates_to_extract:
-            extract_data_for_date(date, bq_client)
+            steps.append(("extract", extract_data_for_date, (date, bq_client)))
         if date in dates_to_export:
-            export_data_for_date(date, bq_client, bucket)
+            steps.append(("export", export_data_for_date, (date, bq_client, bucket)))
         if date in dates_to_download:
-            download_data_for_date(date, bucket)
+            steps.append(("download", download_data_for_date, (date, bucket)))
         if date in dates_to_consolidate:
-            consolidate_data_for_date(date)
-        clean_up_downloaded_files(date)
+            steps.append(("consolidate", consolidate_data_for_date, (date, processes)))
+        else:
+            clean_up_downloaded_files(date)
+        steps_for_dates[date] = steps
+    # Each date needs to go through its steps in order, but different dates
+    # can be at different stages at the same time. The stages have very
+    # different costs (BigQuery jobs and downloads mostly involve waiting on
+    # the network while consolidation is CPU-bound) so each gets its own pool
+    # of workers with its own concurrency limit.
+    executors = {}
+    try:
+        executors["consolidate"] = ProcessPoolExecutor(
+            max_workers=concurrency["consolidate"]
+        )
+        # Start the consolidation processes before we start any threads, so
+        # we're not forking while downloads are in progress
+        if dates_to_consolidate:
+            executors["consolidate"].submit(os.getpid).result()
+        for stage in ["extract", "export", "download"]:
+            executors[stage] = ThreadPoolExecutor(
+                max_workers=concurrency[stage], thread_name_prefix=stage
+            )
+        run_steps(steps_for_dates, executors)
+    finally:
+        for executor in executors.values():
+            executor.shutdown()
+
+
+def run_steps(steps_for_dates, executors):
+    """
+    Given a dict mapping each date to a list of (stage, function, args) steps,
+    run each date's steps in order using the executor for each stage
+
+    If any step fails then no further steps are started and its exception is
+    raised once running steps have finished.
+    """
+    remaining = {date: list(steps) for date, steps in steps_for_dates.items()}
+    pending = {}
+
+    def submit_next_step(date):
+        if remaining[date]:
+            stage, function, args = remaining[date].pop(0)
+            pending[executors[stage].submit(function, *args)] = date
+
+    try:
+        for date in remaining:
+            submit_next_step(date)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                date = pending.pop(future)
+                # Raises the exception if the step failed
+                future.result()
+                submit_next_step(date)
+    finally:
+        for future in pending:
+            future.cancel()
+        wait(pending)
 
 
 def filter_dates_to_consolidate(dates):
     """
     Return only those dates for which a consolidated prescribing file (i.e. a
-    single gzipped CSV file containing all prescribing for a given month) does
-    not exist
+    single file containing all prescribing for a given month) does not exist,
+    or exists but was written in an older format
     """
-    return [
-        date for date in dates if not os.path.exists(get_prescribing_filename(date))
-    ]
+    return [date for date in dates if not consolidation_is_complete(date)]
+
+
+def consolidation_is_complete(date):
+    filename = get_prescribing_filename(date)
+    return os.path.exists(filename) and run_is_current(filename)
 
 
 def filter_dates_to_download(dates):
@@ -174,39 +253,49 @@ def download_data_for_date(date, bucket):
     Storage
     """
     prefix = remote_storage_prefix_for_date(date)
+    sentinel_file = prefix + SENTINEL_SUFFIX
     blobs = bucket.list_blobs(prefix=prefix)
-    # Sort the files so we always download the sentinel file last
     blobs = sorted(blobs, key=lambda blob: blob.name)
     logger.info(
         "Downloading %s files from gs://%s/%s*", len(blobs), bucket.name, prefix
     )
-    for blob in blobs:
-        local_name = get_filename_for_download(blob.name)
-        if not os.path.exists(local_name):
-            temp_name = get_temp_filename(local_name)
-            blob.download_to_filename(temp_name)
-            os.rename(temp_name, local_name)
-            logger.info("Downloaded %s", blob.name)
+    # We always download the sentinel file last, once everything else has
+    # downloaded successfully
+    data_blobs = [blob for blob in blobs if blob.name != sentinel_file]
+    sentinel_blobs = [blob for blob in blobs if blob.name == sentinel_file]
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_THREADS) as executor:
+        list(executor.map(download_blob, data_blobs))
+    for blob in sentinel_blobs:
+        download_blob(blob)
     if not download_is_complete(date):
         raise RuntimeError(
             "Export for {date} looks incomplete (no sentinel file)".format(date=date)
         )
 
 
-def consolidate_data_for_date(date):
+def download_blob(blob):
+    local_name = get_filename_for_download(blob.name)
+    if not os.path.exists(local_name):
+        temp_name = get_temp_filename(local_name)
+        blob.download_to_filename(temp_name)
+        os.rename(temp_name, local_name)
+        logger.info("Downloaded %s", blob.name)
+
+
+def consolidate_data_for_date(date, processes=None):
     """
     Consolidate downloaded prescribing data for the given date into a single
-    gzipped CSV file, sorted by (bnf_code, practice, month)
+    file, sorted by (bnf_code, practice, month), and then delete the downloaded
+    files
     """
     pattern = "{}*.csv.gz".format(local_storage_prefix_for_date(date))
     input_files = glob.glob(pattern)
     target_file = get_prescribing_filename(date)
     temp_file = get_temp_filename(target_file)
     logger.info("Consolidating %s data files into %s", len(input_files), target_file)
-    sort_and_merge_gzipped_csv_files(
-        input_files, temp_file, ("bnf_code", "practice", "month")
-    )
+    sort_and_merge_prescribing_files(input_files, temp_file, processes=processes)
     os.rename(temp_file, target_file)
+    clean_up_downloaded_files(date)
 
 
 def clean_up_downloaded_files(date):
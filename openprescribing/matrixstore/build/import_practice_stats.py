@@ -1,18 +1,25 @@
 """
 Import practice statistics from downloaded CSV files into SQLite
+
+The CSV is parsed in chunks and the values in each chunk are written in bulk
+into a dense matrix for each statistic, so memory use depends on the number of
+practices and dates rather than on the size of the CSV. The resulting matrices
+are identical to those we'd get by assigning each value individually to a
+`lil_matrix`, which is how this used to work.
 """
-import csv
-import gzip
+
 import json
 import logging
 import os.path
 import sqlite3
 
-from matrixstore.matrix_ops import sparse_matrix, finalise_matrix
+import numpy
+import pandas as pd
+from matrixstore.matrix_ops import finalise_matrix, is_integer
 from matrixstore.serializer import serialize_compressed
 
 from .common import get_practice_stats_filename
-
+from .import_prescribing import CHUNK_SIZE, build_matrix, lookup_offsets
 
 logger = logging.getLogger(__name__)
 
@@ -56,9 +63,8 @@ def write_practice_stats(connection, practice_statistics):
 
 def get_practice_statistics_for_dates(dates):
     """
-    Yield all practice statistics for the given dates as tuples of the form:
-
-        statistic_name, practice_code, date, statistic_value
+    Yield all practice statistics for the given dates as DataFrames in the
+    form produced by `parse_practice_statistics_csv`
     """
     dates = sorted(dates)
     filenames = [get_practice_stats_filename(date) for date in dates]
@@ -71,49 +77,86 @@ def get_practice_statistics_for_dates(dates):
         )
     for filename in filenames:
         logger.info("Reading practice statistics from %s", filename)
-        with gzip.open(filename, "rt") as f:
-            for row in parse_practice_statistics_csv(f):
-                yield row
+        yield from parse_practice_statistics_csv(filename, compression="gzip")
 
 
-def parse_practice_statistics_csv(input_stream):
+def parse_practice_statistics_csv(
+    input_stream, compression="infer", chunk_size=CHUNK_SIZE
+):
     """
-    Accepts a stream of CSV and yields practice stastics as tuples of the form:
+    Accepts a stream (or filename) of CSV and yields DataFrames of at most
+    `chunk_size` rows with columns:
 
-        statistic_name, practice_code, date, statistic_value
+        practice, date, <statistic_name>, <statistic_name>, ...
+
+    The values in the `star_pu` column are JSON objects and each of their keys
+    becomes a separate "star_pu.<key>" statistic
     """
-    reader = csv.reader(input_stream)
-    headers = next(reader)
     try:
-        date_col = headers.index("month")
-        practice_col = headers.index("practice")
-        star_pu_col = headers.index("star_pu")
-    except ValueError as e:
+        reader = pd.read_csv(
+            input_stream,
+            compression=compression,
+            chunksize=chunk_size,
+            dtype={"practice": str, "month": str, "star_pu": str, "pct_id": str},
+            float_precision="round_trip",
+        )
+        for chunk in reader:
+            yield parse_practice_statistics_chunk(chunk)
+    except pd.errors.EmptyDataError as e:
         raise MissingHeaderError(str(e))
-    other_headers = [
-        (i, header)
-        for (i, header) in enumerate(headers)
-        if i not in (date_col, practice_col, star_pu_col) and header != "pct_id"
-    ]
-    for row in reader:
-        # We only need the YYYY-MM-DD part of the date
-        date = row[date_col][:10]
-        # These sometimes have trailing spaces in the CSV
-        practice = row[practice_col].strip()
-        for i, statistic_name in other_headers:
-            value_str = row[i]
-            value = float(value_str) if "." in value_str else int(value_str)
-            yield statistic_name, practice, date, value
-        star_pu = json.loads(row[star_pu_col])
-        for star_pu_name, value in star_pu.items():
-            yield "star_pu." + star_pu_name, practice, date, value
+
+
+def parse_practice_statistics_chunk(chunk):
+    missing = {"month", "practice", "star_pu"}.difference(chunk.columns)
+    if missing:
+        raise MissingHeaderError("Missing columns: {}".format(", ".join(missing)))
+    # JSON objects are decoded one at a time, but in C which makes this
+    # cheap compared with the rest of the work
+    records = [json.loads(value) for value in chunk["star_pu"]]
+    star_pu = pd.DataFrame.from_records(records, index=chunk.index)
+    for name in star_pu.columns:
+        preserve_integer_type(star_pu, name, records)
+    star_pu.columns = ["star_pu." + name for name in star_pu.columns]
+    statistics = chunk.drop(
+        columns=["month", "practice", "star_pu", "pct_id"], errors="ignore"
+    )
+    return pd.concat(
+        [
+            # These sometimes have trailing spaces in the CSV
+            chunk["practice"].str.strip().rename("practice"),
+            # We only need the YYYY-MM-DD part of the date
+            chunk["month"].str[:10].rename("date"),
+            statistics,
+            star_pu,
+        ],
+        axis=1,
+    )
+
+
+def preserve_integer_type(star_pu, name, records):
+    """
+    Where a STAR-PU key is missing from some rows pandas fills the gaps with
+    NaN and so converts integer values to floats. We want the type of each
+    statistic to be determined by the JSON type of its first value (as it was
+    when we assigned values one at a time) so we convert these columns back to
+    pandas's nullable integer type.
+    """
+    column = star_pu[name]
+    if not pd.api.types.is_float_dtype(column.dtype):
+        return
+    present = column.notna().to_numpy()
+    if present.all() or not present.any():
+        return
+    first_value = records[present.argmax()][name]
+    if isinstance(first_value, int):
+        star_pu[name] = column.astype("Int64")
 
 
 def build_matrices(practice_statistics, practices, dates):
     """
-    Accepts an iterable of practice statistics, plus mappings of pratice codes
-    and date strings to their respective row/column offsets. Yields pairs of
-    the form:
+    Accepts an iterable of DataFrames of practice statistics, plus mappings of
+    pratice codes and date strings to their respective row/column offsets.
+    Yields pairs of the form:
 
         statistic_name, matrix
 
@@ -123,23 +166,65 @@ def build_matrices(practice_statistics, practices, dates):
     max_row = max(practices.values())
     max_col = max(dates.values())
     shape = (max_row + 1, max_col + 1)
+    practice_index = pd.Index(list(practices.keys()))
+    practice_offsets = numpy.array(list(practices.values()), dtype=numpy.int32)
+    date_index = pd.Index(list(dates.keys()))
+    date_offsets = numpy.array(list(dates.values()), dtype=numpy.int32)
+    # Each statistic's matrix is allocated when we first see a value for it
+    # and each chunk's values are written straight into it, so we never hold
+    # more than one chunk of the CSV in memory
     matrices = {}
-    for statistic_name, practice, date, value in practice_statistics:
-        try:
-            practice_offset = practices[practice]
-        except KeyError:
-            # Because we download all practice statistics for a given date
-            # range we end up including practices which have not prescribed at
-            # all during this period and hence which aren't included in our
-            # list of known practices. We just want to ignore these.
-            continue
-        date_offset = dates[date]
-        try:
-            matrix = matrices[statistic_name]
-        except KeyError:
-            matrix = sparse_matrix(shape, integer=isinstance(value, int))
-            matrices[statistic_name] = matrix
-        matrix[practice_offset, date_offset] = value
+    for statistics in practice_statistics:
+        positions = practice_index.get_indexer(statistics["practice"])
+        # Because we download all practice statistics for a given date range we
+        # end up including practices which have not prescribed at all during
+        # this period and hence which aren't included in our list of known
+        # practices. We just want to ignore these.
+        known = positions >= 0
+        statistics = statistics[known]
+        rows = practice_offsets[positions[known]]
+        columns = lookup_offsets(date_index, date_offsets, statistics["date"])
+        for statistic_name in statistics.columns.drop(["practice", "date"]):
+            column = statistics[statistic_name]
+            # Missing values are just left unset
+            present = column.notna().to_numpy()
+            if not present.any():
+                continue
+            matrix = matrices.get(statistic_name)
+            if matrix is None:
+                # Whether a statistic is integer valued is determined by the
+                # first values we see for it
+                integer = pd.api.types.is_integer_dtype(column.dtype)
+                dtype = numpy.int64 if integer else numpy.float64
+                matrix = numpy.zeros(shape, dtype=dtype)
+                matrices[statistic_name] = matrix
+            entries = remove_duplicate_entries(
+                rows[present],
+                columns[present],
+                column[present].to_numpy(dtype=matrix.dtype),
+                shape,
+            )
+            stat_rows, stat_columns, values = entries
+            matrix[stat_rows, stat_columns] = values
     logger.info("Writing %s practice statistics matrices to SQLite", len(matrices))
-    for statistic_name, matrix in sorted(matrices.items()):
+    for statistic_name in sorted(matrices):
+        matrix = matrices.pop(statistic_name)
+        rows, columns = numpy.nonzero(matrix)
+        matrix = build_matrix(
+            rows, columns, matrix[rows, columns], shape, is_integer(matrix)
+        )
         yield statistic_name, finalise_matrix(matrix)
+
+
+def remove_duplicate_entries(rows, columns, values, shape):
+    """
+    Where there's more than one value for the same practice and date keep just
+    the last one, as we would have done when assigning values one at a time
+    """
+    keys = rows.astype(numpy.int64) * shape[1] + columns
+    # Find the last occurrence of each key by searching the reversed array
+    unique_keys, reversed_positions = numpy.unique(keys[::-1], return_index=True)
+    if unique_keys.size == keys.size:
+        return rows, columns, values
+    keep = numpy.sort(keys.size - 1 - reversed_positions)
+    return rows[keep], columns[keep], values[keep]
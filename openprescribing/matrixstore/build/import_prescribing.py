@@ -1,31 +1,78 @@
 """
-Import prescribing data from CSV files into SQLite
+Import prescribing data into SQLite from the files of parsed and sorted
+prescribing data created by `download_prescribing` (one per month; see
+`matrixstore.build.sort_prescribing`)
+
+Rather than handling the data row by row we parse CSV in large chunks into
+arrays and do all the lookups and matrix construction in bulk.
+The resulting matrices are identical to those we'd get by assigning each value
+individually to a `lil_matrix`, which is how this used to work.
 """
-from collections import namedtuple
-import csv
-from itertools import groupby
+
 import logging
 import os
 import sqlite3
-import gzip
-import heapq
+import struct
+from collections import namedtuple
 
-from matrixstore.matrix_ops import sparse_matrix, finalise_matrix
+import numpy
+import pandas as pd
+import pyarrow
+import pyarrow.ipc
+import scipy.sparse
+from matrixstore.matrix_ops import finalise_matrix
 from matrixstore.serializer import serialize_compressed
 
 from .common import get_prescribing_filename
 
-
 logger = logging.getLogger(__name__)
 
 
 MatrixRow = namedtuple("MatrixRow", "bnf_code items quantity actual_cost net_cost")
 
+# Integer or floating point type for each of the prescribing matrices
+INTEGER_FIELDS = {
+    "items": True,
+    "quantity": False,
+    "actual_cost": True,
+    "net_cost": True,
+}
+
+# The magic initial bytes of a file containing parsed prescribing data (see
+# `write_run`), which are followed by the version number of the format.
+# Increment the version if the format changes: files written in any other
+# version are treated as missing and get downloaded again.
+RUN_MAGIC_NUMBER = b"MSRN"
+RUN_FORMAT_VERSION = 2
+RUN_HEADER = RUN_MAGIC_NUMBER + struct.pack("<H", RUN_FORMAT_VERSION)
+
+# The columns of the DataFrames produced by `parse_prescribing_csv`, as stored
+# in these files
+RUN_SCHEMA = pyarrow.schema(
+    [
+        ("bnf_code", pyarrow.string()),
+        ("practice", pyarrow.string()),
+        ("date", pyarrow.string()),
+        ("items", pyarrow.int64()),
+        ("quantity", pyarrow.float64()),
+        ("actual_cost", pyarrow.int64()),
+        ("net_cost", pyarrow.int64()),
+    ]
+)
+
+# Number of rows to read from each CSV file at a time. When reading many files
+# at once we hold roughly this many rows from each file in memory.
+CHUNK_SIZE = 50000
+
 
 class MissingHeaderError(Exception):
     pass
 
 
+class OutdatedRunError(RuntimeError):
+    pass
+
+
 def import_prescribing(filename):
     if not os.path.exists(filename):
         raise RuntimeError("No SQLite file at: {}".format(filename))
@@ -58,11 +105,10 @@ def write_prescribing(connection, prescriptions):
 
 def get_prescriptions_for_dates(dates):
     """
-    Yield all prescribing data for the given dates as tuples of the form:
-
-        bnf_code, practice_code, date, items, quantity, actual_cost, net_cost
-
-    sorted by bnf_code, practice and date.
+    Yield all prescribing data for the given dates as DataFrames (see
+    `parse_prescribing_csv` for the columns) such that all the prescribing for
+    any given BNF code is contained in a single DataFrame, and such that the
+    DataFrames are in BNF code order
     """
     dates = sorted(dates)
     filenames = [get_prescribing_filename(date) for date in dates]
@@ -73,53 +119,262 @@ def get_prescriptions_for_dates(dates):
                 "\n  ".join(missing_files)
             )
         )
-    prescribing_streams = [read_gzipped_prescribing_csv(f) for f in filenames]
-    # We assume that the input files are already sorted by (bnf_code, practice,
-    # month) so to ensure that the combined stream is sorted we just need to
-    # merge them correctly, which heapq.merge handles nicely for us
-    return heapq.merge(*prescribing_streams)
+    # These files are already parsed and sorted by (bnf_code, practice, date)
+    # (see `matrixstore.build.sort_prescribing`) so we can merge them a chunk
+    # at a time
+    prescribing_streams = [read_run(f) for f in filenames]
+    return merge_by_bnf_code(prescribing_streams)
 
 
-def read_gzipped_prescribing_csv(filename):
-    with gzip.open(filename, "rt") as f:
-        for row in parse_prescribing_csv(f):
-            yield row
+def parse_prescribing_csv(input_stream, compression="infer", chunk_size=CHUNK_SIZE):
+    """
+    Accepts a filename or stream of CSV and yields prescribing data as
+    DataFrames with the columns:
 
+        bnf_code, practice, date, items, quantity, actual_cost, net_cost
 
-def parse_prescribing_csv(input_stream):
-    """
-    Accepts a stream of CSV and yields prescribing data as tuples of the form:
+    where costs are converted to pence, in chunks of `chunk_size` rows
 
-        bnf_code, practice_code, date, items, quantity, actual_cost, net_cost
+    Compression is inferred from the filename, where there is one.
     """
-    reader = csv.reader(input_stream)
-    headers = next(reader)
+    columns = [
+        "bnf_code",
+        "practice",
+        "month",
+        "items",
+        "quantity",
+        "actual_cost",
+        "net_cost",
+    ]
     try:
-        bnf_code_col = headers.index("bnf_code")
-        practice_col = headers.index("practice")
-        date_col = headers.index("month")
-        items_col = headers.index("items")
-        quantity_col = headers.index("quantity")
-        actual_cost_col = headers.index("actual_cost")
-        net_cost_col = headers.index("net_cost")
+        reader = pd.read_csv(
+            input_stream,
+            compression=compression,
+            usecols=columns,
+            dtype={
+                "bnf_code": str,
+                "practice": str,
+                "month": str,
+                "items": numpy.int64,
+                "quantity": numpy.float64,
+                "actual_cost": numpy.float64,
+                "net_cost": numpy.float64,
+            },
+            keep_default_na=False,
+            # Ensure that values are parsed exactly as Python's `float` would
+            float_precision="round_trip",
+            chunksize=chunk_size,
+        )
     except ValueError as e:
         raise MissingHeaderError(str(e))
-    for row in reader:
-        yield (
-            # These sometimes have trailing spaces in the CSV
-            row[bnf_code_col].strip(),
-            row[practice_col].strip(),
-            # We only need the YYYY-MM-DD part of the date
-            row[date_col][:10],
-            int(row[items_col]),
-            float(row[quantity_col]),
-            pounds_to_pence(row[actual_cost_col]),
-            pounds_to_pence(row[net_cost_col]),
+    with reader:
+        for chunk in reader:
+            yield pd.DataFrame(
+                {
+                    # These sometimes have trailing spaces in the CSV
+                    "bnf_code": chunk["bnf_code"].str.strip(),
+                    "practice": chunk["practice"].str.strip(),
+                    # We only need the YYYY-MM-DD part of the date
+                    "date": chunk["month"].str.slice(0, 10),
+                    "items": chunk["items"],
+                    "quantity": chunk["quantity"],
+                    "actual_cost": pounds_to_pence(chunk["actual_cost"].to_numpy()),
+                    "net_cost": pounds_to_pence(chunk["net_cost"].to_numpy()),
+                }
+            )
+
+
+def write_run(filename, prescribing):
+    """
+    Write an iterable of DataFrames of prescribing data (as produced by
+    `parse_prescribing_csv`) to a file in a compact binary format
+
+    After a short header, each DataFrame is stored as a separately compressed
+    batch in an Arrow IPC stream so the file can be read back a chunk at a
+    time. We store plain columns of values, rather than anything specific to
+    pandas, so that these files (which are kept between builds) remain
+    readable whatever version of pandas we're using.
+    """
+    # We want speed rather than maximum compression here as these files are
+    # only used during the build
+    options = pyarrow.ipc.IpcWriteOptions(compression="lz4")
+    with open(filename, "wb") as f:
+        f.write(RUN_HEADER)
+        with pyarrow.ipc.new_stream(f, RUN_SCHEMA, options=options) as writer:
+            for chunk in prescribing:
+                writer.write_batch(
+                    pyarrow.record_batch(
+                        [
+                            pyarrow.array(chunk[field.name].to_numpy(), field.type)
+                            for field in RUN_SCHEMA
+                        ],
+                        schema=RUN_SCHEMA,
+                    )
+                )
+
+
+def read_run(filename):
+    """
+    Yield the DataFrames written to `filename` by `write_run`
+    """
+    with open(filename, "rb") as f:
+        check_run_header(filename, f.read(len(RUN_HEADER)))
+        for batch in pyarrow.ipc.open_stream(f):
+            yield pd.DataFrame(
+                {
+                    name: column.to_numpy(zero_copy_only=False)
+                    for name, column in zip(batch.schema.names, batch.columns)
+                }
+            )
+
+
+def run_is_current(filename):
+    """
+    Return whether `filename` is a file written by `write_run` in the current
+    format
+    """
+    with open(filename, "rb") as f:
+        header = f.read(len(RUN_HEADER))
+    try:
+        check_run_header(filename, header)
+    except OutdatedRunError:
+        return False
+    return True
+
+
+def check_run_header(filename, header):
+    if not header.startswith(RUN_MAGIC_NUMBER):
+        raise RuntimeError("Not a prescribing run file: {}".format(filename))
+    if header != RUN_HEADER:
+        raise OutdatedRunError(
+            "Prescribing run file not in current format: {}".format(filename)
         )
 
 
-def pounds_to_pence(value):
-    return int(round(float(value) * 100))
+def pounds_to_pence(values):
+    # `numpy.rint` rounds half to even, exactly as Python's `round` does
+    return numpy.rint(values * 100).astype(numpy.int64)
+
+
+def merge_by_bnf_code(streams):
+    """
+    Accepts a list of streams of DataFrames, each sorted by BNF code, and
+    yields DataFrames containing all their rows such that all the rows for any
+    given BNF code appear in the same DataFrame, and the DataFrames are in BNF
+    code order
+    """
+    streams = [iter(stream) for stream in streams]
+    buffers = [None] * len(streams)
+    for i in range(len(streams)):
+        read_next_chunk(streams, buffers, i)
+    while True:
+        open_streams = [i for i, stream in enumerate(streams) if stream is not None]
+        if not open_streams:
+            remaining = [buffer for buffer in buffers if buffer is not None]
+            if remaining:
+                yield pd.concat(remaining, ignore_index=True)
+            return
+        # We can't be sure we've seen every row for the last BNF code in each
+        # buffer until we've read the next chunk, so we only take rows whose
+        # BNF codes are less than the smallest of these
+        limit = min(buffers[i]["bnf_code"].iat[-1] for i in open_streams)
+        parts = []
+        for i, buffer in enumerate(buffers):
+            if buffer is None:
+                continue
+            n = buffer["bnf_code"].searchsorted(limit, side="left")
+            if n > 0:
+                parts.append(buffer.iloc[:n])
+                buffers[i] = buffer.iloc[n:] if n < len(buffer) else None
+        if parts:
+            yield pd.concat(parts, ignore_index=True)
+        for i in open_streams:
+            if buffers[i] is None or buffers[i]["bnf_code"].iat[-1] == limit:
+                read_next_chunk(streams, buffers, i)
+
+
+def read_next_chunk(streams, buffers, i):
+    """
+    Append the next chunk from stream `i` to its buffer, or mark the stream as
+    finished by setting it to None
+    """
+    chunk = next(streams[i], None)
+    # Skip over any empty chunks
+    while chunk is not None and len(chunk) == 0:
+        chunk = next(streams[i], None)
+    if chunk is None:
+        streams[i] = None
+        return
+    if buffers[i] is None:
+        buffers[i] = chunk
+    else:
+        buffers[i] = pd.concat([buffers[i], chunk], ignore_index=True)
+
+
+def group_prescriptions(prescriptions, practices, dates):
+    """
+    Accepts DataFrames of prescribing, as produced by
+    `get_prescriptions_for_dates`, plus mappings of practice codes and date
+    strings to their respective row/column offsets. Yields pairs of the form:
+
+        bnf_code, (rows, columns, items, quantity, actual_cost, net_cost)
+
+    in BNF code order, where each element of the tuple is an array with one
+    entry per prescription
+    """
+    practice_index = pd.Index(list(practices.keys()))
+    practice_offsets = numpy.array(list(practices.values()), dtype=numpy.int64)
+    date_index = pd.Index(list(dates.keys()))
+    date_offsets = numpy.array(list(dates.values()), dtype=numpy.int64)
+    for prescribing in prescriptions:
+        rows = lookup_offsets(practice_index, practice_offsets, prescribing["practice"])
+        columns = lookup_offsets(date_index, date_offsets, prescribing["date"])
+        bnf_codes = prescribing["bnf_code"].to_numpy()
+        # Rows for each BNF code are contiguous within each of the merged
+        # input files, so a stable sort keeps them in their original order
+        order = numpy.argsort(bnf_codes, kind="stable")
+        bnf_codes = bnf_codes[order]
+        arrays = [
+            rows[order],
+            columns[order],
+            prescribing["items"].to_numpy()[order],
+            prescribing["quantity"].to_numpy()[order],
+            prescribing["actual_cost"].to_numpy()[order],
+            prescribing["net_cost"].to_numpy()[order],
+        ]
+        starts = numpy.flatnonzero(bnf_codes[1:] != bnf_codes[:-1]) + 1
+        starts = numpy.concatenate([[0], starts])
+        ends = numpy.concatenate([starts[1:], [len(bnf_codes)]])
+        for start, end in zip(starts, ends):
+            entries = [array[start:end] for array in arrays]
+            yield bnf_codes[start], remove_duplicate_entries(entries, len(dates))
+
+
+def lookup_offsets(index, offsets, values):
+    positions = index.get_indexer(values)
+    if (positions < 0).any():
+        missing = values[positions < 0].iloc[0]
+        raise KeyError(missing)
+    return offsets[positions]
+
+
+def remove_duplicate_entries(entries, num_columns):
+    """
+    Where there's more than one prescription for the same practice and date
+    keep just one, as we would have done when assigning values one at a time
+    in sorted order (i.e. the last one wins)
+
+    This shouldn't happen with real data but we want to handle it consistently
+    """
+    rows, columns, items, quantity, actual_cost, net_cost = entries
+    keys = rows * num_columns + columns
+    if numpy.unique(keys).size == keys.size:
+        return tuple(entries)
+    order = numpy.lexsort((net_cost, actual_cost, quantity, items, columns, rows))
+    sorted_keys = keys[order]
+    is_last = numpy.append(sorted_keys[1:] != sorted_keys[:-1], True)
+    keep = order[is_last]
+    return tuple(array[keep] for array in entries)
 
 
 def build_matrices(prescriptions, practices, dates):
@@ -136,26 +391,31 @@ def build_matrices(prescriptions, practices, dates):
     max_row = max(practices.values())
     max_col = max(dates.values())
     shape = (max_row + 1, max_col + 1)
-    grouped_by_bnf_code = groupby(prescriptions, lambda row: row[0])
-    for bnf_code, row_group in grouped_by_bnf_code:
-        items_matrix = sparse_matrix(shape, integer=True)
-        quantity_matrix = sparse_matrix(shape, integer=False)
-        actual_cost_matrix = sparse_matrix(shape, integer=True)
-        net_cost_matrix = sparse_matrix(shape, integer=True)
-        for _, practice, date, items, quantity, actual_cost, net_cost in row_group:
-            practice_offset = practices[practice]
-            date_offset = dates[date]
-            items_matrix[practice_offset, date_offset] = items
-            quantity_matrix[practice_offset, date_offset] = quantity
-            actual_cost_matrix[practice_offset, date_offset] = actual_cost
-            net_cost_matrix[practice_offset, date_offset] = net_cost
-        yield MatrixRow(
-            bnf_code,
-            finalise_matrix(items_matrix),
-            finalise_matrix(quantity_matrix),
-            finalise_matrix(actual_cost_matrix),
-            finalise_matrix(net_cost_matrix),
-        )
+    for bnf_code, entries in group_prescriptions(prescriptions, practices, dates):
+        rows, columns = entries[:2]
+        matrices = [
+            finalise_matrix(build_matrix(rows, columns, values, shape, integer))
+            for values, integer in zip(entries[2:], INTEGER_FIELDS.values())
+        ]
+        yield MatrixRow(bnf_code, *matrices)
+
+
+def build_matrix(rows, columns, values, shape, integer):
+    """
+    Build a sparse matrix of the given shape from arrays of row offsets, column
+    offsets and values, in a form suitable for passing to `finalise_matrix`
+    """
+    dtype = numpy.int64 if integer else numpy.float64
+    values = values.astype(dtype, copy=False)
+    # Zero values aren't stored when assigning values to a LIL matrix so we
+    # exclude them here too
+    non_zero = values != 0
+    matrix = scipy.sparse.coo_matrix(
+        (values[non_zero], (rows[non_zero], columns[non_zero])), shape=shape
+    )
+    # Going via CSR gives us a matrix with exactly the same attributes (and so
+    # the same serialized form) as when converting from a LIL matrix
+    return matrix.tocsr()
 
 
 def format_as_sql_rows(matrices, connection):
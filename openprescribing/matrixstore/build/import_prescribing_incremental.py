@@ -0,0 +1,331 @@
+"""
+Import prescribing data into SQLite by reusing the data in a previously built
+MatrixStore file, so that we only need to read CSV files for months which that
+file doesn't contain
+
+Each month we build a new file which covers the same period as the previous
+one but shifted along by a month. Rather than re-reading five years' worth of
+CSV files we can take the existing matrices, drop the columns for months which
+have fallen out of the window, remap rows to account for practices which have
+appeared or disappeared, and add in data for the new month. The work is split
+by presentation across a pool of worker processes, each of which reads directly
+from the previous file.
+
+This is a drop-in replacement for the `import_prescribing` stage and the
+resulting file should be identical to one built from scratch, with one minor
+caveat: prescribing rows whose values are all zero are indistinguishable from
+no prescribing at all once stored, so presentations which have only such rows
+in the retained months will be dropped.
+"""
+
+import logging
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy
+import scipy.sparse
+from matrixstore.connection import MatrixStore
+from matrixstore.matrix_ops import finalise_matrix
+from matrixstore.serializer import (
+    CHUNKED_MAGIC_NUMBER,
+    HOT_STORAGE_REFERENCE_MAGIC_NUMBER,
+    deserialize_ints,
+    serialize_compressed,
+    starts_with,
+)
+
+from .common import map_in_order
+from .import_prescribing import (
+    INTEGER_FIELDS,
+    build_matrix,
+    get_prescriptions_for_dates,
+    group_prescriptions,
+    should_log_message,
+)
+
+logger = logging.getLogger(__name__)
+
+
+# Number of presentations handled by each task sent to the worker processes
+BATCH_SIZE = 64
+
+
+def import_prescribing_incremental(filename, previous_filename, processes=None):
+    new_dates = get_dates_missing_from_previous(filename, previous_filename)
+    logger.info(
+        "Reusing data from %s and importing data for: %s",
+        previous_filename,
+        ", ".join(new_dates),
+    )
+    prescriptions = get_prescriptions_for_dates(new_dates)
+    connection = sqlite3.connect(filename)
+    # Trade crash-safety for insert speed
+    connection.execute("PRAGMA synchronous=OFF")
+    write_prescribing_incremental(
+        connection, previous_filename, prescriptions, processes=processes
+    )
+    connection.commit()
+    connection.close()
+
+
+def get_dates_missing_from_previous(filename, previous_filename):
+    """
+    Return the dates in the new file for which the previous file has no data
+
+    We only support the case where the previous file ends earlier than the new
+    one (i.e. where the missing dates all fall at the end).
+    """
+    if not os.path.exists(filename):
+        raise RuntimeError("No SQLite file at: {}".format(filename))
+    connection = sqlite3.connect(filename)
+    missing_dates = get_dates_missing_from_previous_for_db(
+        connection, previous_filename
+    )
+    connection.close()
+    return missing_dates
+
+
+def get_dates_missing_from_previous_for_db(connection, previous_filename):
+    dates = sorted(date for (date,) in connection.execute("SELECT date FROM date"))
+    previous = MatrixStore.from_file(previous_filename)
+    previous_dates = set(previous.dates)
+    previous.close()
+    missing_dates = [date for date in dates if date not in previous_dates]
+    if dates[len(dates) - len(missing_dates) :] != missing_dates:
+        raise RuntimeError(
+            "Previous file does not cover the start of the new date range: {}".format(
+                previous_filename
+            )
+        )
+    return missing_dates
+
+
+def write_prescribing_incremental(
+    connection, previous_filename, prescriptions, processes=None
+):
+    """
+    Write prescribing data combining the matrices in `previous_filename` with
+    `prescriptions` (for the months not covered by that file) in the form
+    produced by `import_prescribing.get_prescriptions_for_dates`
+    """
+    cursor = connection.cursor()
+    practices = dict(cursor.execute("SELECT code, offset FROM practice"))
+    dates = dict(cursor.execute("SELECT date, offset FROM date"))
+    shape = (max(practices.values()) + 1, max(dates.values()) + 1)
+    previous = MatrixStore.from_file(previous_filename)
+    previous_bnf_codes = [
+        bnf_code
+        for (bnf_code,) in previous.query(
+            "SELECT bnf_code FROM presentation ORDER BY bnf_code"
+        )
+    ]
+    # Map each row in the previous file to its row in the new file (or -1 if
+    # the practice no longer appears)
+    row_map = numpy.array(
+        [practices.get(code, -1) for code in previous.practices], dtype=numpy.int64
+    )
+    previous_practices = previous.practices
+    retained_dates = sorted(set(dates).intersection(previous.dates))
+    previous.close()
+    if retained_dates:
+        date_range = (retained_dates[0], retained_dates[-1])
+        column_offset = dates[retained_dates[0]]
+    else:
+        date_range = None
+        column_offset = 0
+    new_entries = group_prescriptions(prescriptions, practices, dates)
+    batches = make_batches(merge_bnf_codes(previous_bnf_codes, new_entries))
+    processes = processes or os.cpu_count() or 1
+    count = 0
+    dropped_rows = set()
+    with ProcessPoolExecutor(
+        max_workers=processes,
+        initializer=initialize_worker,
+        initargs=(previous_filename, date_range, row_map, column_offset, shape),
+    ) as executor:
+        results = map_in_order(
+            executor, build_rows_for_batch, batches, max_pending=2 * processes
+        )
+        for rows, dropped_rows_for_batch in results:
+            dropped_rows.update(dropped_rows_for_batch)
+            for row in rows:
+                count += 1
+                bnf_code = row[-1]
+                if should_log_message(count):
+                    logger.info("Writing data for %s (%s)", bnf_code, count)
+                cursor.execute(
+                    "INSERT OR IGNORE INTO presentation (bnf_code) VALUES (?)",
+                    [bnf_code],
+                )
+                cursor.execute(
+                    """
+                    UPDATE presentation
+                    SET items=?, quantity=?, actual_cost=?, net_cost=?
+                    WHERE bnf_code=?
+                    """,
+                    row,
+                )
+    logger.info("Finished writing data for %s presentations", count)
+    if dropped_rows:
+        logger.warning(
+            "Dropped prescribing in previous file for practices not in new " "file: %s",
+            ", ".join(previous_practices[row] for row in sorted(dropped_rows)),
+        )
+
+
+def get_storage_options(previous_filename):
+    """
+    Return the values of the `months_per_chunk` and `hot_presentations` options
+    with which `previous_filename` was built, so that an incremental build can
+    store its matrices in the same way
+    """
+    connection = sqlite3.connect(previous_filename)
+    months_per_chunk = None
+    hot_presentations = 0
+    for (value,) in connection.execute("SELECT items FROM presentation"):
+        if value is None:
+            continue
+        if starts_with(value, HOT_STORAGE_REFERENCE_MAGIC_NUMBER):
+            hot_presentations += 1
+        elif months_per_chunk is None and starts_with(value, CHUNKED_MAGIC_NUMBER):
+            (months_per_chunk, _), _ = deserialize_ints(
+                memoryview(value)[len(CHUNKED_MAGIC_NUMBER) :]
+            )
+    connection.close()
+    return {
+        "months_per_chunk": months_per_chunk,
+        "hot_presentations": hot_presentations or None,
+    }
+
+
+def merge_bnf_codes(previous_bnf_codes, new_entries):
+    """
+    Merge the sorted list of BNF codes in the previous file with the sorted
+    stream of new prescribing, yielding (bnf_code, entries) pairs where
+    `entries` is None if there's no new prescribing for that code
+    """
+    previous_bnf_codes = iter(previous_bnf_codes)
+    previous_code = next(previous_bnf_codes, None)
+    for bnf_code, entries in new_entries:
+        while previous_code is not None and previous_code < bnf_code:
+            yield previous_code, None
+            previous_code = next(previous_bnf_codes, None)
+        if previous_code == bnf_code:
+            previous_code = next(previous_bnf_codes, None)
+        yield bnf_code, entries
+    while previous_code is not None:
+        yield previous_code, None
+        previous_code = next(previous_bnf_codes, None)
+
+
+def make_batches(iterable, batch_size=BATCH_SIZE):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# State shared by all tasks in a worker process, set by `initialize_worker`
+_worker = {}
+
+
+def initialize_worker(previous_filename, date_range, row_map, column_offset, shape):
+    _worker["previous"] = MatrixStore.from_file(previous_filename)
+    _worker["date_range"] = date_range
+    _worker["row_map"] = row_map
+    _worker["column_offset"] = column_offset
+    _worker["shape"] = shape
+
+
+def build_rows_for_batch(batch):
+    """
+    Return a list of tuples of serialized matrices, plus BNF code, ready for
+    insertion into SQLite for each presentation in `batch` which has any
+    prescribing, along with the set of rows in the previous file whose
+    prescribing was dropped (see `build_matrices`)
+    """
+    previous_matrices = get_previous_matrices([bnf_code for bnf_code, _ in batch])
+    rows = []
+    dropped_rows = set()
+    for bnf_code, entries in batch:
+        matrices = build_matrices(
+            previous_matrices.get(bnf_code),
+            entries,
+            _worker["row_map"],
+            _worker["column_offset"],
+            _worker["shape"],
+            dropped_rows,
+        )
+        if matrices is not None:
+            rows.append(tuple(map(serialize_compressed, matrices)) + (bnf_code,))
+    return rows, dropped_rows
+
+
+def get_previous_matrices(bnf_codes):
+    """
+    Return a dict mapping BNF codes to their matrices in the previous file,
+    restricted to the columns for dates which are retained in the new file
+    """
+    if _worker["date_range"] is None:
+        return {}
+    sql = """
+        SELECT bnf_code, items, quantity, actual_cost, net_cost
+        FROM presentation WHERE bnf_code IN ({})
+        """.format(
+        ",".join("?" * len(bnf_codes))
+    )
+    results = _worker["previous"].query_columns(
+        sql, _worker["date_range"], params=bnf_codes
+    )
+    return {row[0]: row[1:] for row in results}
+
+
+def build_matrices(
+    previous_matrices, entries, row_map, column_offset, shape, dropped_rows
+):
+    """
+    Return finalised items, quantity, actual_cost and net_cost matrices of the
+    given shape combining the matrices from the previous file with any new
+    entries, or None if there are no non-zero values at all
+
+    Practices are only left out of the new file if they have no prescribing in
+    its date range, so the previous file should have no prescribing in the
+    retained months for practices which aren't in the new file. But if the
+    data has been revised since the previous file was built we drop that
+    prescribing, adding the practices' rows to `dropped_rows`, rather than
+    abandon the build.
+    """
+    if previous_matrices is None and entries is None:
+        return None
+    matrices = []
+    for index, integer in enumerate(INTEGER_FIELDS.values()):
+        rows, columns, values = [], [], []
+        if previous_matrices is not None:
+            coo = scipy.sparse.coo_matrix(previous_matrices[index])
+            new_rows = row_map[coo.row]
+            keep = new_rows >= 0
+            dropped_rows.update(coo.row[~keep].tolist())
+            rows.append(new_rows[keep])
+            columns.append(coo.col[keep] + column_offset)
+            values.append(coo.data[keep])
+        if entries is not None:
+            rows.append(entries[0])
+            columns.append(entries[1])
+            values.append(entries[2 + index])
+        matrices.append(
+            build_matrix(
+                numpy.concatenate(rows),
+                numpy.concatenate(columns),
+                numpy.concatenate(values),
+                shape,
+                integer,
+            )
+        )
+    if all(matrix.nnz == 0 for matrix in matrices):
+        return None
+    return [finalise_matrix(matrix) for matrix in matrices]
@@ -43,6 +43,19 @@ SCHEMA_SQL = """
         net_cost BLOB
     );
 
+   -- This table contains totals pre-calculated over all presentations matching
+   -- each BNF chapter, section, paragraph, subparagraph and chemical prefix
+   -- (see `matrixstore.build.precalculate_bnf_prefix_totals`)
+    CREATE TABLE bnf_prefix_totals (
+        prefix TEXT,
+        items BLOB,
+        quantity BLOB,
+        actual_cost BLOB,
+        net_cost BLOB,
+
+        PRIMARY KEY (prefix)
+    );
+
     CREATE TABLE practice_statistic (
         name TEXT,
         -- The "value" column will contain the actual statistics as serialized
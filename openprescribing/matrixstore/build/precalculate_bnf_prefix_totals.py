@@ -0,0 +1,119 @@
+"""
+Pre-calculate totals for prescribing over every BNF chapter, section,
+paragraph, subparagraph and chemical. Queries which sum over a broad BNF prefix
+(e.g. all of chapter 2) otherwise need to deserialize and sum thousands of
+matrices on every request.
+
+We only store totals for prefixes which match more than one presentation: where
+a prefix matches just a single presentation there's nothing to be gained by
+storing a second copy of its data.
+
+See `matrixstore.bnf_prefix_totals` for how these totals get used.
+"""
+
+import logging
+import os.path
+import sqlite3
+
+import scipy.sparse
+from matrixstore.bnf_prefix_totals import BNF_PREFIX_LENGTHS
+from matrixstore.connection import MatrixStore
+from matrixstore.matrix_ops import finalise_matrix
+from matrixstore.serializer import serialize_compressed
+from matrixstore.sql_functions import MatrixSum
+
+logger = logging.getLogger(__name__)
+
+
+def precalculate_bnf_prefix_totals(sqlite_path):
+    if not os.path.exists(sqlite_path):
+        raise RuntimeError("No SQLite file at: {}".format(sqlite_path))
+    connection = sqlite3.connect(sqlite_path)
+    # Disable the sqlite module's magical transaction handling features because
+    # we want to use our own transactions below
+    previous_isolation_level = connection.isolation_level
+    connection.isolation_level = None
+    precalculate_bnf_prefix_totals_for_db(connection)
+    connection.isolation_level = previous_isolation_level
+    connection.commit()
+    connection.close()
+
+
+def precalculate_bnf_prefix_totals_for_db(connection):
+    matrixstore = MatrixStore(connection)
+    logger.info("Summing prescribing over BNF code prefixes")
+    presentations = matrixstore.query("""
+        SELECT
+          bnf_code, items, quantity, actual_cost, net_cost
+        FROM
+          presentation
+        WHERE
+          items IS NOT NULL
+        ORDER BY
+          bnf_code
+        """)
+    cursor = connection.cursor()
+    # We want replacing the old values to be an atomic operation. We use
+    # savepoints for this which are equivalent to transactions except they're
+    # allowed to nest so it doesn't matter if we're already inside a
+    # transaction when we get here.
+    cursor.execute("SAVEPOINT update_bnf_prefix_totals")
+    cursor.execute("DELETE FROM bnf_prefix_totals")
+    count = 0
+    for prefix, values in sum_by_bnf_prefix(presentations):
+        count += 1
+        cursor.execute(
+            """
+            INSERT INTO
+              bnf_prefix_totals (prefix, items, quantity, actual_cost, net_cost)
+            VALUES
+              (?, ?, ?, ?, ?)
+            """,
+            [prefix] + list(map(prepare_matrix_value, values)),
+        )
+    cursor.execute("RELEASE update_bnf_prefix_totals")
+    logger.info("Wrote totals for %s BNF code prefixes", count)
+
+
+def sum_by_bnf_prefix(presentations):
+    """
+    Accepts an iterable of rows of the form:
+
+        bnf_code, items, quantity, actual_cost, net_cost
+
+    sorted by BNF code, and yields pairs of the form:
+
+        bnf_prefix, [items_sum, quantity_sum, actual_cost_sum, net_cost_sum]
+
+    for every prefix in BNF_PREFIX_LENGTHS which matches more than one
+    presentation
+    """
+    # For each prefix length we keep track of the current prefix, how many
+    # presentations we've seen which match it, and the sums so far
+    current = {length: (None, 0, None) for length in BNF_PREFIX_LENGTHS}
+    for bnf_code, *matrices in presentations:
+        for length in BNF_PREFIX_LENGTHS:
+            if len(bnf_code) < length:
+                continue
+            prefix = bnf_code[:length]
+            current_prefix, count, sums = current[length]
+            if prefix != current_prefix:
+                if count > 1:
+                    yield current_prefix, [s.value() for s in sums]
+                count = 0
+                sums = [MatrixSum() for _ in matrices]
+            for matrix_sum, matrix in zip(sums, matrices):
+                matrix_sum.add(matrix)
+            current[length] = (prefix, count + 1, sums)
+    for length in BNF_PREFIX_LENGTHS:
+        prefix, count, sums = current[length]
+        if count > 1:
+            yield prefix, [s.value() for s in sums]
+
+
+def prepare_matrix_value(matrix):
+    # The summed matrices are dense, but for all but the broadest prefixes they
+    # will be fairly sparse so we convert them to whichever representation is
+    # smallest, exactly as we do for individual presentations
+    matrix = finalise_matrix(scipy.sparse.csc_matrix(matrix))
+    return serialize_compressed(matrix)
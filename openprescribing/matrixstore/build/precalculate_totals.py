@@ -35,17 +35,25 @@ def precalculate_totals(sqlite_path):
 def precalculate_totals_for_db(connection):
     matrixstore = MatrixStore(connection)
     logger.info("Summing prescribing over all presentations")
+    # We sum in a fixed order so that the (floating point) results don't
+    # depend on the order in which presentations were inserted
     values = matrixstore.query_one(
         """
         SELECT
-          MATRIX_SUM(items),
-          MATRIX_SUM(quantity),
-          MATRIX_SUM(actual_cost),
-          MATRIX_SUM(net_cost)
-        FROM
-          presentation
-        WHERE
-          items IS NOT NULL
+          PARALLEL_MATRIX_SUM(items),
+          PARALLEL_MATRIX_SUM(quantity),
+          PARALLEL_MATRIX_SUM(actual_cost),
+          PARALLEL_MATRIX_SUM(net_cost)
+        FROM (
+          SELECT
+            items, quantity, actual_cost, net_cost
+          FROM
+            presentation
+          WHERE
+            items IS NOT NULL
+          ORDER BY
+            bnf_code
+        )
         """
     )
     logger.info("Writing precalculated totals to db")
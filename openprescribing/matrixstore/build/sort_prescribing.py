@@ -0,0 +1,102 @@
+"""
+Sort and merge the CSV files of prescribing data exported from BigQuery for a
+single month into a single file, sorted by BNF code, practice and date
+
+This is an external merge sort. Each input file is parsed a chunk at a time in
+a pool of worker processes, and each chunk is sorted and written out as a
+"run" in a compact binary format (see `import_prescribing.write_run`). These
+runs are then merged into a single run covering the whole month. Because runs
+contain parsed data rather than CSV text, `import_prescribing` can read the
+output directly without any further parsing.
+
+This replaces an earlier approach of shelling out to the `sort` command, which
+was single-threaded for decompression and compression and couldn't handle
+quoted commas in the CSV.
+"""
+
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+from .import_prescribing import (
+    CHUNK_SIZE,
+    merge_by_bnf_code,
+    parse_prescribing_csv,
+    read_run,
+    write_run,
+)
+
+# The columns we sort by. Merging relies on the first of these being the BNF
+# code.
+SORT_COLUMNS = ["bnf_code", "practice", "date"]
+
+# Number of rows which get sorted in memory at once to produce each run
+RUN_SIZE = 1000000
+
+
+def sort_and_merge_prescribing_files(
+    input_filenames, output_filename, processes=None, run_size=RUN_SIZE
+):
+    """
+    Given a list of CSV files of prescribing data (which may or may not be
+    gzipped), write their contents to `output_filename` sorted by BNF code,
+    practice and date
+    """
+    directory = os.path.dirname(os.path.abspath(output_filename))
+    temp_dir = tempfile.mkdtemp(dir=directory, prefix=".tmp.runs.")
+    try:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            futures = [
+                executor.submit(
+                    sort_file_into_runs,
+                    filename,
+                    os.path.join(temp_dir, str(n)),
+                    run_size,
+                )
+                for n, filename in enumerate(input_filenames)
+            ]
+            run_filenames = [name for future in futures for name in future.result()]
+        runs = [read_run(run_filename) for run_filename in run_filenames]
+        write_run(output_filename, merge_runs(runs))
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def sort_file_into_runs(filename, prefix, run_size):
+    """
+    Sort the CSV file in chunks of `run_size` rows, writing each to its own run
+    file and returning the list of their names
+    """
+    run_filenames = []
+    for n, prescribing in enumerate(
+        parse_prescribing_csv(filename, chunk_size=run_size)
+    ):
+        run_filename = "{}.{}".format(prefix, n)
+        write_run(run_filename, split_into_chunks(sort_prescribing(prescribing)))
+        run_filenames.append(run_filename)
+    return run_filenames
+
+
+def merge_runs(runs):
+    """
+    Merge the supplied runs (each an iterable of DataFrames, sorted by
+    `SORT_COLUMNS`) into a single sorted stream of DataFrames
+    """
+    # All rows for a given BNF code end up in the same DataFrame, so we just
+    # need to sort within each of these
+    for prescribing in merge_by_bnf_code(runs):
+        yield from split_into_chunks(sort_prescribing(prescribing))
+
+
+def sort_prescribing(prescribing):
+    return prescribing.sort_values(SORT_COLUMNS, kind="stable", ignore_index=True)
+
+
+def split_into_chunks(prescribing, chunk_size=CHUNK_SIZE):
+    """
+    Split a DataFrame into chunks so that it can be read back without holding
+    the whole thing in memory
+    """
+    for start in range(0, len(prescribing), chunk_size):
+        yield prescribing.iloc[start : start + chunk_size]
@@ -2,36 +2,81 @@
 Update the prescribing data in a SQLite file using the `bnf_map` table in
 BigQuery which maps old BNF codes to their current versions
 """
+
 import logging
 import os.path
 import sqlite3
+from concurrent.futures import ProcessPoolExecutor
 
 from gcutils.bigquery import Client
 from matrixstore.matrix_ops import sparse_matrix, finalise_matrix, is_integer
 from matrixstore.serializer import deserialize, serialize_compressed
 
+from .common import map_in_order
+
 
 logger = logging.getLogger(__name__)
 
 
-def update_bnf_map(sqlite_path):
+def update_bnf_map(sqlite_path, processes=None):
     if not os.path.exists(sqlite_path):
         raise RuntimeError("No SQLite file at: {}".format(sqlite_path))
     connection = sqlite3.connect(sqlite_path)
     # Disable the sqlite module's magical transaction handling features because
     # we want to use our own transactions below
     connection.isolation_level = None
-    cursor = connection.cursor()
     bigquery_connection = Client("hscic")
     bnf_map = get_old_to_new_bnf_codes(bigquery_connection)
-    for old_code, new_code in bnf_map:
-        move_values_from_old_code_to_new(cursor, old_code, new_code)
+    update_bnf_map_for_db(connection, bnf_map, processes=processes)
+    connection.close()
+
+
+def update_bnf_map_for_db(connection, bnf_map, processes=None):
+    """
+    Move all prescribing data stored under old BNF codes in `bnf_map` (a list
+    of (old_code, new_code) pairs) to the corresponding current codes
+
+    All codes which end up at the same current code are summed together in a
+    single step (in parallel across `processes` worker processes) and all the
+    changes are written in a single transaction.
+    """
+    cursor = connection.cursor()
+    current_codes = resolve_bnf_map(bnf_map)
+    old_codes_by_target = group_by_target(current_codes)
+    cursor.execute("SAVEPOINT bnf_map_update")
+    codes_with_data = {
+        bnf_code
+        for (bnf_code,) in cursor.execute(
+            "SELECT bnf_code FROM presentation WHERE items IS NOT NULL"
+        )
+    }
+    groups = list(get_groups_with_data(old_codes_by_target, codes_with_data))
+    processes = processes or os.cpu_count() or 1
+    if processes == 1:
+        write_merged_groups(
+            cursor, map(merge_group, get_group_values(connection, groups))
+        )
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            results = map_in_order(
+                executor,
+                merge_group,
+                get_group_values(connection, groups),
+                max_pending=2 * processes,
+            )
+            write_merged_groups(cursor, results)
     # Until we've completed the BNF code update we don't know which
     # presentations actually have prescribing data, so we have to wait until
     # now to do this cleanup
     delete_presentations_with_no_prescribing(cursor)
-    connection.commit()
-    connection.close()
+    cursor.execute("RELEASE bnf_map_update")
+    logger.info(
+        "Moved prescribing data from %s old BNF codes to %s current codes "
+        "(%s of which already had data of their own)",
+        sum(len(old_codes) for _, old_codes, _ in groups),
+        len(groups),
+        sum(1 for _, _, target_has_data in groups if target_has_data),
+    )
 
 
 def get_old_to_new_bnf_codes(bigquery_connection):
@@ -43,66 +88,114 @@ def get_old_to_new_bnf_codes(bigquery_connection):
     return rows
 
 
-def move_values_from_old_code_to_new(cursor, old_code, new_code):
+def resolve_bnf_map(bnf_map):
     """
-    Move prescribing data stored under `old_code` to `new_code`
+    Given a list of (old_code, new_code) pairs, return a dict mapping each old
+    code to its current code, following chains of updates (e.g. A->B, B->C) to
+    their end
 
-    If we have data stored under both the old and new codes then sum them.
+    Codes whose chain of updates leads into a cycle (e.g. A->B, B->A) have no
+    current code so we log a warning and leave their data where it is
     """
-    old_values = get_values_for_bnf_code(cursor, old_code)
-    # If there's no prescribing under the old code then there's nothing to do
-    if not old_values:
-        return
-    new_values = get_values_for_bnf_code(cursor, new_code)
-    if not new_values:
-        logger.info(
-            "Moving prescribing data from %s to %s (new code had no existing data)",
-            old_code,
-            new_code,
-        )
-        new_values = old_values
-    else:
-        logger.info(
-            "Merging prescribing data for %s with %s (both codes have existing data)",
-            old_code,
-            new_code,
-        )
-        new_values = sum_rows([new_values, old_values])
-    # We want saving the new value and deleting the old to be an atomic
-    # operation. We use savepoints for this which are equivalent to
-    # transactions except they're allowed to nest so it doesn't matter if
-    # we're already inside a transaction when we get here.
-    cursor.execute("SAVEPOINT bnf_code_update")
-    cursor.execute(
-        "INSERT OR IGNORE INTO presentation (bnf_code) VALUES (?)", [new_code]
-    )
-    cursor.execute(
-        """
-        UPDATE presentation SET items=?, quantity=?, actual_cost=?, net_cost=?
-        WHERE bnf_code=?
-        """,
-        format_values_for_sqlite(new_values) + [new_code],
-    )
-    cursor.execute("DELETE FROM presentation WHERE bnf_code=?", [old_code])
-    cursor.execute("RELEASE bnf_code_update")
+    new_codes = {}
+    for old_code, new_code in bnf_map:
+        if old_code != new_code:
+            # Once data has been moved away from a code any later updates for
+            # that code have nothing to move, so the first update wins
+            new_codes.setdefault(old_code, new_code)
+    current_codes = {}
+    for old_code in new_codes:
+        chain = [old_code]
+        while chain[-1] in new_codes:
+            code = new_codes[chain[-1]]
+            chain.append(code)
+            if code in chain[:-1]:
+                logger.warning(
+                    "Skipping BNF map update for %s which leads into a cycle: %s",
+                    old_code,
+                    " -> ".join(chain),
+                )
+                break
+        else:
+            current_codes[old_code] = chain[-1]
+    return current_codes
+
+
+def group_by_target(current_codes):
+    """
+    Given a dict mapping old codes to current codes, return a dict mapping each
+    current code to the list of old codes which map to it
+    """
+    old_codes_by_target = {}
+    for old_code, current_code in current_codes.items():
+        old_codes_by_target.setdefault(current_code, []).append(old_code)
+    return old_codes_by_target
 
 
-def get_values_for_bnf_code(cursor, code):
+def get_groups_with_data(old_codes_by_target, codes_with_data):
     """
-    Return a list of matrices which are the prescribing values for the supplied
-    BNF code, or None if there is no prescribing data
+    Yield a (target, old_codes, target_has_data) tuple for each target code
+    where some of its old codes have prescribing data, with `old_codes`
+    including only those that do
     """
-    result = cursor.execute(
-        """
-        SELECT items, quantity, actual_cost, net_cost
-        FROM presentation
-        WHERE bnf_code=? AND items IS NOT NULL
-        """,
-        [code],
-    )
-    rows = list(result)
-    if rows:
-        return [deserialize(value) for value in rows[0]]
+    for target, old_codes in old_codes_by_target.items():
+        old_codes = [code for code in old_codes if code in codes_with_data]
+        if old_codes:
+            yield target, old_codes, target in codes_with_data
+
+
+def get_group_values(connection, groups):
+    """
+    For each group yield the target code, the old codes and the serialized
+    prescribing values for every code in the group which has data (starting
+    with the target, if it has any)
+    """
+    for target, old_codes, target_has_data in groups:
+        codes = [target] + old_codes if target_has_data else old_codes
+        values = {}
+        for bnf_code, *row in connection.execute(
+            """
+            SELECT bnf_code, items, quantity, actual_cost, net_cost
+            FROM presentation
+            WHERE bnf_code IN ({})
+            """.format(
+                ",".join(["?"] * len(codes))
+            ),
+            codes,
+        ):
+            values[bnf_code] = row
+        yield target, old_codes, [values[code] for code in codes]
+
+
+def merge_group(group):
+    """
+    Sum the serialized values in a group, returning the target code, old codes
+    and the serialized totals
+    """
+    target, old_codes, rows = group
+    # If there's only a single code with data then there's nothing to sum
+    if len(rows) == 1:
+        return target, old_codes, rows[0]
+    values = sum_rows([[deserialize(value) for value in row] for row in rows])
+    return target, old_codes, format_values_for_sqlite(values)
+
+
+def write_merged_groups(cursor, results):
+    for target, old_codes, values in results:
+        cursor.execute(
+            "INSERT OR IGNORE INTO presentation (bnf_code) VALUES (?)", [target]
+        )
+        cursor.execute(
+            """
+            UPDATE presentation SET items=?, quantity=?, actual_cost=?, net_cost=?
+            WHERE bnf_code=?
+            """,
+            list(values) + [target],
+        )
+        cursor.executemany(
+            "DELETE FROM presentation WHERE bnf_code=?",
+            [[code] for code in old_codes],
+        )
 
 
 def sum_rows(rows):
@@ -9,34 +9,303 @@ Provides a basic caching decorator with a few special features:
       should only be applied to functions whose output is purely determined by
       their arguments. If the logic of the function changes then the `version`
       argument can be incremented.
+
+    * Optionally, values can also be kept in a bounded in-process LRU cache
+      (see `local_max_bytes`) so that repeated calls within the same process
+      don't need to fetch and unpickle the value from the shared cache.
+
+    * Optionally, concurrent calls with the same arguments can be coalesced so
+      that only one process computes the value while the others wait for it
+      (see `single_flight`).
+
+    * Hit, miss and size statistics are recorded for each decorated function
+      (see `get_memoize_stats`).
+
+Also provides a `Fingerprint` class for generating `cache_key` values.
 """
 
 import functools
+import hashlib
+import struct
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
 
+import numpy
 from django.core.cache import cache as default_cache
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
 
 MISSING = object()
 BASIC_TYPES = (bool, int, float, str)
 
+# For specifying sizes of in-process caches
+MB = 1024 * 1024
+
+# How long (in seconds) a lock taken out by `get_or_set_single_flight` lasts
+# before other processes assume that its holder has crashed and take over.
+# This should be longer than the slowest computation we use it for.
+SINGLE_FLIGHT_LOCK_TIMEOUT = 5 * 60
+# How often processes waiting on a lock check whether the value is available
+SINGLE_FLIGHT_POLL_INTERVAL = 0.05
+
+
+def memoize(version=1, cache=default_cache, local_max_bytes=None, single_flight=False):
+    """
+    Memoize the decorated function (see module docstring for details)
+
+    If `local_max_bytes` is set (and non-zero) then, in addition to the shared
+    cache, values are kept in an in-process cache which holds at most this
+    many bytes, evicting the least recently used values first. Values in this
+    cache are not copied: every hit returns the very same object, so callers
+    must never modify the values returned by these functions.
+
+    If `single_flight` is True then only one process at a time will compute
+    the value for a given set of arguments, with any others waiting for the
+    result (see `get_or_set_single_flight`). This is worth doing for expensive
+    functions which are likely to be called simultaneously by many processes
+    when the cache is cold.
+    """
 
-def memoize(version=1, cache=default_cache):
     def decorator(func):
         cache_key_base = _get_cache_key_base(func, version)
+        stats = _stats.setdefault(cache_key_base, MemoizeStats())
+        if local_max_bytes:
+            local_cache = LocalCache(local_max_bytes, stats)
+        else:
+            local_cache = None
 
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
             cache_key = _get_cache_key(cache_key_base, args, kwargs)
-            result = cache.get(cache_key, default=MISSING)
-            if result is MISSING:
-                result = func(*args, **kwargs)
-                cache.set(cache_key, result)
+            if local_cache is not None:
+                local_key = _get_local_cache_key(cache_key)
+                result = local_cache.get(local_key, default=MISSING)
+                if result is not MISSING:
+                    stats.increment("local_hits")
+                    return result
+            if single_flight:
+                result, computed = get_or_set_single_flight(
+                    cache, cache_key, functools.partial(func, *args, **kwargs)
+                )
+            else:
+                result = cache.get(cache_key, default=MISSING)
+                computed = result is MISSING
+                if computed:
+                    result = func(*args, **kwargs)
+                    cache.set(cache_key, result)
+            stats.increment("misses" if computed else "hits")
+            if local_cache is not None:
+                local_cache.set(local_key, result)
             return result
 
+        wrapper.local_cache = local_cache
         return wrapper
 
     return decorator
 
 
+def get_or_set_single_flight(
+    cache,
+    key,
+    compute,
+    timeout=DEFAULT_TIMEOUT,
+    lock_timeout=SINGLE_FLIGHT_LOCK_TIMEOUT,
+    max_wait=None,
+    cache_none=True,
+):
+    """
+    Return the value stored in `cache` under `key` or, if there isn't one,
+    call `compute` and store the result with the given `timeout`
+
+    We use a lock stored in the cache itself to ensure that, across all
+    processes sharing the cache, only one call to `compute` for a given key is
+    in progress at once and the others wait for its result. Locks expire after
+    `lock_timeout` seconds so that if the process holding one crashes another
+    will take over. Each lock holds a token unique to the call which acquired
+    it so that, if our lock expires while we're still computing, we don't
+    release the lock which another process has since taken (see
+    `_delete_if_equal` for the caveats). If, for whatever reason, we wait
+    longer than `max_wait` seconds (which defaults to `lock_timeout`) without
+    getting either the value or the lock then we give up waiting and compute
+    the value ourselves.
+
+    If `cache_none` is False then a result of None is returned but not stored,
+    so it will be computed again on the next call.
+
+    Returns a pair of the form:
+
+        value, computed
+
+    where `computed` indicates whether we called `compute` ourselves.
+    """
+    lock_key = ("single-flight-lock", key)
+    token = uuid.uuid4().hex
+    if max_wait is None:
+        max_wait = lock_timeout
+    deadline = time.monotonic() + max_wait
+
+    def compute_and_store():
+        result = compute()
+        if result is not None or cache_none:
+            cache.set(key, result, timeout=timeout)
+        return result
+
+    while True:
+        result = cache.get(key, default=MISSING)
+        if result is not MISSING:
+            return result, False
+        if cache.add(lock_key, token, timeout=lock_timeout):
+            try:
+                # Another process may have stored the value between our checking
+                # the cache and acquiring the lock
+                result = cache.get(key, default=MISSING)
+                if result is not MISSING:
+                    return result, False
+                return compute_and_store(), True
+            finally:
+                _delete_if_equal(cache, lock_key, token)
+        if time.monotonic() > deadline:
+            return compute_and_store(), True
+        time.sleep(SINGLE_FLIGHT_POLL_INTERVAL)
+
+
+def _delete_if_equal(cache, key, value):
+    """
+    Delete `key` from `cache` only if it currently holds `value`
+
+    With the DiskCache backend (which we use in production) we do this inside a
+    transaction so it's atomic. Other backends give us no way of doing this, so
+    there's a small window between checking and deleting in which our lock
+    could expire and be taken by another process, whose lock we would then
+    release. The worst that can happen is that a value gets computed twice,
+    and this can only happen if the computation takes as long as the lock
+    timeout, which is why this should be kept well above the time any
+    computation takes.
+    """
+    # DiskCache's `DjangoCache` wraps a `FanoutCache` which supports
+    # transactions
+    transact = getattr(getattr(cache, "_cache", None), "transact", None)
+    if transact is None:
+        if cache.get(key) == value:
+            cache.delete(key)
+        return
+    with transact():
+        if cache.get(key) == value:
+            cache.delete(key)
+
+
+class MemoizeStats:
+    """
+    Counters for a single memoized function within the current process
+    """
+
+    def __init__(self):
+        # Requests may be handled by several threads in the same process so
+        # counters must only be updated while holding this lock
+        self.lock = threading.Lock()
+        # Values found in the in-process cache
+        self.local_hits = 0
+        # Values found in the shared cache
+        self.hits = 0
+        # Values which had to be computed
+        self.misses = 0
+        # Values evicted from the in-process cache to make room for others
+        self.local_evictions = 0
+        # Estimated size of the values currently held in the in-process cache
+        self.local_bytes = 0
+
+    def increment(self, counter):
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def as_dict(self):
+        with self.lock:
+            return {name: value for name, value in vars(self).items() if name != "lock"}
+
+
+# Maps the cache key base of each memoized function to its MemoizeStats
+_stats = {}
+
+
+def get_memoize_stats():
+    """
+    Return a dict mapping the name (and version) of each memoized function to
+    a dict of its statistics for the current process
+    """
+    return {name: stats.as_dict() for name, stats in sorted(_stats.items())}
+
+
+class LocalCache:
+    """
+    Thread-safe LRU cache which evicts values when their total estimated size
+    exceeds `max_bytes`
+    """
+
+    def __init__(self, max_bytes, stats):
+        self.max_bytes = max_bytes
+        self.stats = stats
+        # Maps keys to (value, size) pairs, least recently used first
+        self.entries = OrderedDict()
+        # We update the size and eviction counters as we go so we share the
+        # lock which protects them
+        self.lock = stats.lock
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value):
+        size = get_size(value)
+        # There's no point evicting everything else to make room for a value
+        # which won't fit anyway
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            existing = self.entries.pop(key, None)
+            if existing is not None:
+                self.stats.local_bytes -= existing[1]
+            self.entries[key] = (value, size)
+            self.stats.local_bytes += size
+            while self.stats.local_bytes > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.stats.local_bytes -= evicted_size
+                self.stats.local_evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.stats.local_bytes = 0
+
+
+def get_size(value):
+    """
+    Return an estimate of the memory used by `value` in bytes
+
+    This only needs to be good enough to stop the in-process cache growing
+    without bound so we count the data buffers of numpy arrays and scipy
+    sparse matrices (which is where almost all the memory goes) and recurse
+    into the basic container types.
+    """
+    if isinstance(value, numpy.ndarray):
+        return value.nbytes
+    elif hasattr(value, "indptr"):
+        return value.data.nbytes + value.indices.nbytes + value.indptr.nbytes
+    elif isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(map(get_size, value))
+    elif isinstance(value, dict):
+        return sys.getsizeof(value) + sum(
+            get_size(k) + get_size(v) for (k, v) in value.items()
+        )
+    else:
+        return sys.getsizeof(value)
+
+
 def _get_cache_key_base(func, version):
     return "{}.{}:{}".format(func.__module__, func.__qualname__, version)
 
@@ -47,6 +316,13 @@ def _get_cache_key(base, args, kwargs):
     return base, args, kwargs
 
 
+def _get_local_cache_key(cache_key):
+    # The key we pass to the shared cache contains lists, which can't be used
+    # as dict keys
+    base, args, kwargs = cache_key
+    return base, tuple(args), tuple(kwargs)
+
+
 def _get_object_cache_key(value):
     if isinstance(value, BASIC_TYPES):
         return value
@@ -58,3 +334,69 @@ def _get_object_cache_key(value):
             )
         )
     return cache_key
+
+
+class Fingerprint:
+    """
+    Incrementally builds a hash which identifies the state of an object for
+    caching purposes
+
+    Values are encoded unambiguously (each is tagged with its type and length)
+    before being hashed so that, for instance, `["ab", "c"]` and `["a", "bc"]`
+    produce different fingerprints. Numpy arrays are hashed using their raw
+    bytes (along with their type and shape) so we never have to format them as
+    strings, which is slow for large arrays and, because numpy elides the
+    middle of large arrays, lossy.
+
+    Example usage:
+
+    >>> fingerprint = Fingerprint()
+    >>> fingerprint.update(["some", "ids"])
+    >>> fingerprint.update(numpy.array([1, 2, 3]))
+    >>> cache_key = fingerprint.digest()
+    """
+
+    def __init__(self, *values):
+        self.hashobj = hashlib.blake2b(digest_size=16)
+        for value in values:
+            self.update(value)
+
+    def update(self, value):
+        if value is None:
+            self._write(b"N", b"")
+        elif isinstance(value, bool):
+            self._write(b"?", b"1" if value else b"0")
+        elif isinstance(value, int):
+            self._write(b"i", str(value).encode("ascii"))
+        elif isinstance(value, float):
+            self._write(b"f", struct.pack("<d", value))
+        elif isinstance(value, str):
+            self._write(b"s", value.encode("utf8"))
+        elif isinstance(value, (bytes, bytearray, memoryview)):
+            self._write(b"b", value)
+        elif isinstance(value, numpy.ndarray):
+            array = numpy.ascontiguousarray(value)
+            self._write(b"a", array.dtype.str.encode("ascii"))
+            self._write(b"S", struct.pack("<{}q".format(array.ndim), *array.shape))
+            self._write(b"d", memoryview(array).cast("B"))
+        elif isinstance(value, (list, tuple)):
+            self._write(b"l", struct.pack("<Q", len(value)))
+            for item in value:
+                self.update(item)
+        else:
+            raise TypeError("Can't fingerprint value of type {}".format(type(value)))
+
+    def _write(self, tag, data):
+        self.hashobj.update(tag)
+        self.hashobj.update(struct.pack("<Q", len(data)))
+        self.hashobj.update(data)
+
+    def digest(self):
+        return self.hashobj.digest()
+
+
+def fingerprint(*values):
+    """
+    Return the fingerprint of the supplied values (see `Fingerprint`)
+    """
+    return Fingerprint(*values).digest()
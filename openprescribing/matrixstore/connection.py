@@ -2,13 +2,26 @@ import os.path
 import sqlite3
 import urllib.parse
 
-from .serializer import deserialize
-from .sql_functions import MatrixSum
+from .cube import PresentationCube, get_cube_path
+from .hot_storage import HotStorage, get_hot_storage_path
+from .instrumentation import instrument_query
+from .row_grouper_storage import get_row_groupers_path, read_row_groupers
+from .serializer import deserialize, deserialize_columns
+from .sql_functions import MatrixSum, ParallelMatrixSum
 
 
 class MatrixStore(object):
-    def __init__(self, sqlite_connection, filename=":memory:"):
+    def __init__(self, sqlite_connection, filename=":memory:", hot_storage=None):
         self.connection = sqlite_connection
+        # Optional sidecar file holding uncompressed, memory-mapped copies of
+        # the most frequently requested matrices (see `matrixstore.hot_storage`)
+        self.hot_storage = hot_storage
+        # Maps org types to precomputed RowGrouper instances, where available
+        # (see `matrixstore.row_grouper_storage`)
+        self.row_groupers = {}
+        # Optional dense arrays of the latest few months of prescribing, where
+        # available (see `matrixstore.cube`)
+        self.cube = None
         # `cache_key` attributes are used to identify the state of an object for
         # caching purposes. Because we create MatrixStore files with unique
         # names, and because they are immutable once created, we can simply use
@@ -28,7 +41,24 @@ class MatrixStore(object):
         )
         self.dates = sorted_keys(self.date_offsets)
         self.practices = sorted_keys(self.practice_offsets)
-        self.connection.create_aggregate("MATRIX_SUM", 1, MatrixSum)
+        # BNF code prefixes for which we have precalculated totals (see
+        # `matrixstore.bnf_prefix_totals`). Files built before we started
+        # doing this won't have the table at all.
+        if self.has_table("bnf_prefix_totals"):
+            self.precalculated_bnf_prefixes = frozenset(
+                prefix
+                for (prefix,) in self.connection.execute(
+                    "SELECT prefix FROM bnf_prefix_totals"
+                )
+            )
+        else:
+            self.precalculated_bnf_prefixes = frozenset()
+        matrix_sum, parallel_matrix_sum = MatrixSum, ParallelMatrixSum
+        if hot_storage is not None:
+            matrix_sum = hot_storage.wrap_aggregate(matrix_sum)
+            parallel_matrix_sum = hot_storage.wrap_aggregate(parallel_matrix_sum)
+        self.connection.create_aggregate("MATRIX_SUM", 1, matrix_sum)
+        self.connection.create_aggregate("PARALLEL_MATRIX_SUM", 1, parallel_matrix_sum)
 
     @classmethod
     def from_file(cls, path):
@@ -50,16 +80,64 @@ class MatrixStore(object):
         # Record the name of the current file, first resolving any symlinks.
         # These files are generated with unique names which we can use as part
         # of a cache key
-        filename = os.path.basename(os.path.realpath(path))
-        return cls(connection, filename=filename)
+        real_path = os.path.realpath(path)
+        filename = os.path.basename(real_path)
+        hot_storage_path = get_hot_storage_path(real_path)
+        if os.path.exists(hot_storage_path):
+            hot_storage = HotStorage(hot_storage_path)
+        else:
+            hot_storage = None
+        matrixstore = cls(connection, filename=filename, hot_storage=hot_storage)
+        matrixstore.row_groupers = read_row_groupers(
+            get_row_groupers_path(real_path), matrixstore.practices
+        )
+        cube_path = get_cube_path(real_path)
+        if os.path.exists(cube_path):
+            matrixstore.cube = PresentationCube(cube_path)
+        return matrixstore
 
     def query(self, sql, params=()):
+        return instrument_query(sql, self._query(sql, params))
+
+    def _query(self, sql, params):
         for row in self.connection.cursor().execute(sql, params):
-            yield convert_row_types(row)
+            yield convert_row_types(self.resolve_hot_storage(row))
 
     def query_one(self, sql, params=()):
         return next(self.query(sql, params=params))
 
+    def query_columns(self, sql, date_range, params=()):
+        """
+        Like `query` but any matrices returned contain only the columns for
+        dates within `date_range` (a pair of dates, start and end inclusive)
+
+        Where the file has been built with matrices chunked by date (see
+        `matrixstore.build.chunk_presentations_by_date`) this avoids
+        decompressing data for any other dates.
+        """
+        start_date, end_date = date_range
+        start = self.date_offsets[start_date]
+        stop = self.date_offsets[end_date] + 1
+        return instrument_query(sql, self._query_columns(sql, params, start, stop))
+
+    def _query_columns(self, sql, params, start, stop):
+        for row in self.connection.cursor().execute(sql, params):
+            yield [
+                convert_value_columns(value, start, stop)
+                for value in self.resolve_hot_storage(row)
+            ]
+
+    def resolve_hot_storage(self, row):
+        if self.hot_storage is None:
+            return row
+        return list(map(self.hot_storage.resolve, row))
+
+    def has_table(self, table_name):
+        result = self.connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", [table_name]
+        )
+        return result.fetchone() is not None
+
     def close(self):
         self.connection.close()
 
@@ -78,3 +156,10 @@ def convert_value(value):
         return deserialize(value)
     else:
         return value
+
+
+def convert_value_columns(value, start, stop):
+    if isinstance(value, (bytes, memoryview)):
+        return deserialize_columns(value, start, stop)
+    else:
+        return value
@@ -0,0 +1,173 @@
+"""
+Support for a "cube" sidecar file holding dense (presentations X practices)
+arrays of quantity and net cost for each of the latest few months
+
+The all-presentation analyses (PPU savings and ghost-branded generics) need
+the values for a single month for thousands of presentations. Fetching these
+from the SQLite file means a separate query, decompression and column slice
+for each presentation. With the cube they become a few vectorised numpy
+operations over arrays which are memory-mapped directly from disk and shared
+between processes via the OS page cache.
+
+The file starts with a magic number and the length of a JSON encoded
+description of its contents, followed by the description itself and then the
+arrays, each starting on a page boundary and stored in C order.
+Only presentations with some quantity or net cost in the covered months are
+included. See `matrixstore.build.build_cube` for how these files get built.
+"""
+
+import json
+import mmap
+import struct
+
+import numpy
+import scipy.sparse
+
+CUBE_SUFFIX = ".cube"
+
+# The magic initial bytes which identify a cube file
+CUBE_FILE_MAGIC_NUMBER = b"MSPC"
+
+CUBE_FIELDS = ("quantity", "net_cost")
+
+CUBE_DTYPE = numpy.float64
+
+# See `matrixstore.hot_storage`
+PAGE_SIZE = 4096
+
+
+def get_cube_path(sqlite_path):
+    return sqlite_path + CUBE_SUFFIX
+
+
+class PresentationCube(object):
+    """
+    Read-only view of a cube file
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mmap[: len(CUBE_FILE_MAGIC_NUMBER)] != CUBE_FILE_MAGIC_NUMBER:
+            raise ValueError("Not a cube file: {}".format(path))
+        contents, data_offset = parse_header(self.mmap)
+        self.bnf_codes = contents["bnf_codes"]
+        self.practices = contents["practices"]
+        self.dates = contents["dates"]
+        self.offsets = {bnf_code: i for i, bnf_code in enumerate(self.bnf_codes)}
+        self.arrays = map_arrays(self.mmap, data_offset, contents)
+
+    def covers(self, date):
+        return date in self.dates
+
+    def get(self, field, date):
+        """
+        Return the (presentations X practices) array for the given field and
+        date, with rows in the order given by `bnf_codes`
+        """
+        return self.arrays[date, field]
+
+    def get_rows(self, field, date, bnf_codes):
+        """
+        Return a (presentations X practices) array for just those of the
+        supplied BNF codes which appear in the cube (i.e. which have any
+        prescribing in the covered months), along with a list of those codes
+        """
+        codes = [code for code in bnf_codes if code in self.offsets]
+        offsets = numpy.array([self.offsets[code] for code in codes], dtype=int)
+        return self.get(field, date)[offsets], codes
+
+    def get_grouping_matrix(self, bnf_code_groups):
+        """
+        Return a sparse (groups X presentations) matrix which, when multiplied
+        by one of the cube's arrays, gives the sum over each group of BNF codes
+        for every practice
+
+        Codes which don't appear in the cube are ignored.
+        """
+        rows = []
+        columns = []
+        for row, bnf_codes in enumerate(bnf_code_groups):
+            for code in bnf_codes:
+                if code in self.offsets:
+                    rows.append(row)
+                    columns.append(self.offsets[code])
+        return scipy.sparse.csr_matrix(
+            (numpy.ones(len(rows), dtype=CUBE_DTYPE), (rows, columns)),
+            shape=(len(bnf_code_groups), len(self.bnf_codes)),
+        )
+
+
+class CubeWriter(object):
+    """
+    Creates a new cube file with space for the given presentations, practices
+    and dates, and exposes the (initially zeroed) arrays for the caller to fill
+    """
+
+    def __init__(self, path, bnf_codes, practices, dates):
+        contents = {
+            "bnf_codes": list(bnf_codes),
+            "practices": list(practices),
+            "dates": list(dates),
+            "fields": list(CUBE_FIELDS),
+        }
+        header = encode_header(contents)
+        data_offset = round_up(len(header))
+        size = data_offset + len(dates) * len(CUBE_FIELDS) * get_array_size(contents)
+        with open(path, "wb") as f:
+            f.write(header)
+            f.truncate(size)
+        self.buffer = numpy.memmap(path, dtype=numpy.uint8, mode="r+")
+        self.arrays = map_arrays(self.buffer, data_offset, contents)
+
+    def close(self):
+        self.buffer.flush()
+        self.arrays = self.buffer = None
+
+
+def encode_header(contents):
+    description = json.dumps(contents, separators=(",", ":")).encode("utf8")
+    return CUBE_FILE_MAGIC_NUMBER + struct.pack("<I", len(description)) + description
+
+
+def parse_header(data):
+    """
+    Return the description of the file's contents and the offset at which the
+    arrays start
+    """
+    start = len(CUBE_FILE_MAGIC_NUMBER)
+    (length,) = struct.unpack_from("<I", data, start)
+    start += 4
+    contents = json.loads(data[start : start + length].decode("utf8"))
+    return contents, round_up(start + length)
+
+
+def map_arrays(buffer, data_offset, contents):
+    """
+    Return a dict mapping (date, field) pairs to arrays which are views onto
+    the supplied buffer
+    """
+    shape = (len(contents["bnf_codes"]), len(contents["practices"]))
+    array_size = get_array_size(contents)
+    arrays = {}
+    offset = data_offset
+    for date in contents["dates"]:
+        for field in contents["fields"]:
+            if array_size:
+                array = numpy.frombuffer(
+                    buffer, dtype=CUBE_DTYPE, count=shape[0] * shape[1], offset=offset
+                ).reshape(shape)
+            else:
+                array = numpy.zeros(shape, dtype=CUBE_DTYPE)
+            arrays[date, field] = array
+            offset += array_size
+    return arrays
+
+
+def get_array_size(contents):
+    itemsize = numpy.dtype(CUBE_DTYPE).itemsize
+    return round_up(len(contents["bnf_codes"]) * len(contents["practices"]) * itemsize)
+
+
+def round_up(size):
+    return size + (-size % PAGE_SIZE)
@@ -49,19 +49,49 @@ def latest_prescribing_date():
     return get_db().dates[-1]
 
 
+# All the org types for which `get_row_grouper` can return a RowGrouper
+ORG_TYPES = (
+    "practice",
+    "standard_practice",
+    "ccg",
+    "standard_ccg",
+    "pcn",
+    "stp",
+    "regional_team",
+    "all_practices",
+    "all_standard_practices",
+)
+
+
 @memoize
 def get_row_grouper(org_type):
     """
     Return a "row grouper" function which will group the rows of a practice
     level matrix by the supplied `org_type`
 
+    Where the live MatrixStore file has precomputed row groupers (see the
+    `matrixstore_build_row_groupers` command) we use those, otherwise we build
+    them from the database.
+
     Note that the function is memoized so that if org relationships are changed
     in the database then the application will need to be restarted to see the
-    changes.
+    changes (or, where there are precomputed row groupers, these will need to
+    be regenerated).
+    """
+    db = get_db()
+    if org_type in db.row_groupers:
+        return db.row_groupers[org_type]
+    return build_row_grouper(org_type, db.practice_offsets)
+
+
+def build_row_grouper(org_type, practice_offsets):
+    """
+    Build a RowGrouper for the supplied `org_type` using the org relationships
+    currently in the database
     """
     # Get the mapping from practice codes to IDs of groups
     if org_type == "practice":
-        mapping = _practice_to_practice_map()
+        mapping = _practice_to_practice_map(practice_offsets)
     elif org_type == "standard_practice":
         mapping = _practice_to_standard_practice_map()
     elif org_type == "ccg":
@@ -75,26 +105,23 @@ def get_row_grouper(org_type):
     elif org_type == "regional_team":
         mapping = _practice_to_regional_team_map()
     elif org_type == "all_practices":
-        mapping = _group_all(_practice_to_practice_map())
+        mapping = _group_all(_practice_to_practice_map(practice_offsets))
     elif org_type == "all_standard_practices":
         mapping = _group_all(_practice_to_standard_practice_map())
     else:
         raise ValueError("Unhandled org_type: " + org_type)
     return RowGrouper(
         (offset, mapping[practice_code])
-        for practice_code, offset in get_db().practice_offsets.items()
+        for practice_code, offset in practice_offsets.items()
         if practice_code in mapping
     )
 
 
-def _practice_to_practice_map():
+def _practice_to_practice_map(practice_offsets):
     # For practice level data we just map each practice code to itself. This
     # means that we're not really doing any "grouping" in a meaningful sense,
     # but it simplifies the code by keeping things consistent.
-    return {
-        practice_code: practice_code
-        for practice_code in get_db().practice_offsets.keys()
-    }
+    return {practice_code: practice_code for practice_code in practice_offsets.keys()}
 
 
 def _practice_to_standard_practice_map():
@@ -0,0 +1,129 @@
+"""
+Support for storing the matrices of the most frequently requested
+presentations uncompressed in a "hot storage" sidecar file which lives
+alongside the SQLite file and is memory-mapped when the file is opened
+
+Ordinarily every value we read has to be decompressed into a freshly allocated
+buffer, which means that each web worker ends up holding its own private copy
+of the data. Values in hot storage are read directly from the mmap so they
+cost nothing to "deserialize", and all processes on a host share a single copy
+of the data via the OS page cache.
+
+In the SQLite file itself, the values for hot presentations are replaced with
+small references which give the offset and length of the data within the
+sidecar, along with an ID which ties them to that specific sidecar file.
+
+Note that matrices backed by hot storage are read-only.
+"""
+
+import hashlib
+import mmap
+import struct
+
+from .serializer import HOT_STORAGE_REFERENCE_MAGIC_NUMBER, starts_with
+
+HOT_STORAGE_SUFFIX = ".hot"
+
+# The magic initial bytes which identify a hot storage sidecar file
+HOT_STORAGE_FILE_MAGIC_NUMBER = b"MSHS"
+
+# Each value is written starting at a page boundary. We use a fixed size
+# rather than `mmap.PAGESIZE` so that the output doesn't depend on the machine
+# on which it was built.
+PAGE_SIZE = 4096
+
+STORAGE_ID_LENGTH = 16
+
+REFERENCE_FORMAT = "<{}sQQ".format(STORAGE_ID_LENGTH)
+
+
+def get_hot_storage_path(sqlite_path):
+    return sqlite_path + HOT_STORAGE_SUFFIX
+
+
+class HotStorage(object):
+    """
+    Read-only view of a hot storage sidecar file
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.mmap[: len(HOT_STORAGE_FILE_MAGIC_NUMBER)] != (
+            HOT_STORAGE_FILE_MAGIC_NUMBER
+        ):
+            raise ValueError("Not a hot storage file: {}".format(path))
+        start = len(HOT_STORAGE_FILE_MAGIC_NUMBER)
+        self.storage_id = self.mmap[start : start + STORAGE_ID_LENGTH]
+        self.buffer = memoryview(self.mmap)
+
+    def resolve(self, value):
+        """
+        If `value` is a reference to data in hot storage then return a
+        zero-copy view of that data, otherwise return `value` unchanged
+        """
+        if not isinstance(value, (bytes, memoryview)):
+            return value
+        if not starts_with(value, HOT_STORAGE_REFERENCE_MAGIC_NUMBER):
+            return value
+        storage_id, offset, length = parse_reference(value)
+        if storage_id != self.storage_id:
+            raise ValueError("Reference to data in a different hot storage file")
+        return self.buffer[offset : offset + length]
+
+    def wrap_aggregate(self, aggregate_class):
+        """
+        Return a subclass of the supplied SQLite aggregate class which resolves
+        any references to hot storage before handling them
+        """
+        resolve = self.resolve
+
+        def step(aggregate, value):
+            return aggregate_class.step(aggregate, resolve(value))
+
+        return type(aggregate_class.__name__, (aggregate_class,), {"step": step})
+
+
+class HotStorageWriter(object):
+    """
+    Writes serialized (uncompressed) values to a new hot storage file,
+    returning references to them which can be stored in the SQLite file
+    instead of the values themselves
+
+    The ID of the file is derived from a hash of its contents so that files
+    built from the same data are byte-for-byte identical. This means we don't
+    know the ID until all values have been written, so `add` returns the
+    offset and length and `close` returns the ID; use `make_reference` to
+    combine these.
+    """
+
+    def __init__(self, path):
+        self.file = open(path, "wb")
+        self.hasher = hashlib.sha256()
+        # Reserve the first page for the header, which we write on closing
+        self.file.write(bytes(PAGE_SIZE))
+
+    def add(self, data):
+        offset = self.file.tell()
+        self.file.write(data)
+        self.file.write(bytes(-len(data) % PAGE_SIZE))
+        self.hasher.update(data)
+        return offset, len(data)
+
+    def close(self):
+        storage_id = self.hasher.digest()[:STORAGE_ID_LENGTH]
+        self.file.seek(0)
+        self.file.write(HOT_STORAGE_FILE_MAGIC_NUMBER + storage_id)
+        self.file.close()
+        return storage_id
+
+
+def make_reference(storage_id, offset, length):
+    return HOT_STORAGE_REFERENCE_MAGIC_NUMBER + struct.pack(
+        REFERENCE_FORMAT, storage_id, offset, length
+    )
+
+
+def parse_reference(value):
+    start = len(HOT_STORAGE_REFERENCE_MAGIC_NUMBER)
+    return struct.unpack_from(REFERENCE_FORMAT, value, start)
@@ -0,0 +1,221 @@
+"""
+Lightweight instrumentation of the time spent in MatrixStore code while
+handling a request
+
+When enabled (see `MATRIXSTORE_INSTRUMENTATION` in settings) the
+`matrixstore_timing_middleware` creates a `Recorder` for each request and
+installs it for the current thread. While it is installed we record:
+
+ * every call to `MatrixStore.query` and `MatrixStore.query_columns`, along
+   with the SQL, the number of rows returned and the number of bytes of LZ4
+   data decompressed while producing those rows;
+
+ * every call to `RowGrouper.sum` and `RowGrouper.sum_one_group`;
+
+ * the total time spent in LZ4 decompression.
+
+Totals are returned to the client in a `Server-Timing` header and any single
+call which takes longer than `MATRIXSTORE_SLOW_QUERY_THRESHOLD_MS` is written
+to the "matrixstore.slow_queries" log.
+
+When no recorder is installed each hook costs a single thread-local lookup.
+
+Note that query timings include any decompression needed to produce the
+results, so the totals overlap. Decompression done in `ParallelMatrixSum`'s
+worker threads is attributed to the request which submitted it, and its
+duration is summed across threads so it can exceed the wall-clock time of the
+request.
+"""
+
+import contextlib
+import functools
+import logging
+import threading
+import time
+
+slow_query_logger = logging.getLogger("matrixstore.slow_queries")
+
+QUERY = "query"
+ROW_GROUPER = "row_grouper"
+DECOMPRESS = "decompress"
+
+_local = threading.local()
+
+
+def get_recorder():
+    """
+    Return the Recorder installed for the current thread, or None
+    """
+    return getattr(_local, "recorder", None)
+
+
+@contextlib.contextmanager
+def recording(recorder):
+    """
+    Install `recorder` for the current thread for the duration of the block
+    """
+    previous = get_recorder()
+    _local.recorder = recorder
+    try:
+        yield recorder
+    finally:
+        _local.recorder = previous
+
+
+def bind(function):
+    """
+    Return a version of `function` which runs with the current thread's
+    recorder installed, for handing work off to other threads
+    """
+    recorder = get_recorder()
+    if recorder is None:
+        return function
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with recording(recorder):
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
+def instrument_query(sql, rows):
+    """
+    Wrap the iterator of `rows` returned by `sql` so that it gets recorded,
+    if there's a recorder installed
+    """
+    recorder = get_recorder()
+    if recorder is None:
+        return rows
+    return recorder.record_query(sql, rows)
+
+
+def instrument_row_grouper(method):
+    """
+    Decorator for RowGrouper methods which records their timings, if there's a
+    recorder installed
+    """
+    description = "RowGrouper.{}".format(method.__name__)
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        recorder = get_recorder()
+        if recorder is None:
+            return method(*args, **kwargs)
+        start = time.perf_counter()
+        result = method(*args, **kwargs)
+        duration = time.perf_counter() - start
+        rows = result.shape[0] if result.ndim > 1 else 1
+        recorder.record(ROW_GROUPER, description, rows, 0, duration)
+        return result
+
+    return wrapper
+
+
+class Stats:
+    def __init__(self):
+        self.calls = 0
+        self.rows = 0
+        self.bytes_decompressed = 0
+        self.duration = 0.0
+
+
+class Recorder:
+    """
+    Accumulates timings for a single request
+
+    `slow_threshold` is in seconds; calls which take at least this long are
+    logged individually. A value of None disables the slow-query log.
+    """
+
+    def __init__(self, slow_threshold=None, label=""):
+        self.slow_threshold = slow_threshold
+        self.label = label
+        self.stats = {kind: Stats() for kind in (QUERY, ROW_GROUPER, DECOMPRESS)}
+        # Work can be recorded from several threads at once (see `bind`) so all
+        # updates to the stats must hold this lock
+        self.lock = threading.Lock()
+
+    def record(self, kind, description, rows, bytes_decompressed, duration):
+        with self.lock:
+            stats = self.stats[kind]
+            stats.calls += 1
+            stats.rows += rows
+            stats.bytes_decompressed += bytes_decompressed
+            stats.duration += duration
+        if self.slow_threshold is not None and duration >= self.slow_threshold:
+            slow_query_logger.warning(
+                "%.1fms %s (%d rows, %d bytes decompressed) %s: %s",
+                duration * 1000,
+                kind,
+                rows,
+                bytes_decompressed,
+                self.label,
+                " ".join(description.split()),
+            )
+
+    def record_decompression(self, num_bytes, duration):
+        with self.lock:
+            stats = self.stats[DECOMPRESS]
+            stats.calls += 1
+            stats.bytes_decompressed += num_bytes
+            stats.duration += duration
+
+    def record_query(self, sql, rows):
+        """
+        Iterate over `rows`, recording the time taken to produce each row and
+        the number of bytes decompressed while doing so
+
+        Only time spent inside the iterator counts, not time the caller spends
+        between rows. The call is recorded once the iterator is exhausted or
+        discarded.
+        """
+        decompressed = self.stats[DECOMPRESS]
+        num_rows = 0
+        num_bytes = 0
+        duration = 0.0
+        rows = iter(rows)
+        try:
+            while True:
+                bytes_before = decompressed.bytes_decompressed
+                start = time.perf_counter()
+                try:
+                    row = next(rows)
+                except StopIteration:
+                    break
+                finally:
+                    duration += time.perf_counter() - start
+                    num_bytes += decompressed.bytes_decompressed - bytes_before
+                num_rows += 1
+                yield row
+        finally:
+            self.record(QUERY, sql, num_rows, num_bytes, duration)
+
+    def server_timing(self):
+        """
+        Return the value of a `Server-Timing` header summarising the calls
+        recorded (durations in milliseconds)
+        """
+        metrics = [
+            (
+                "matrixstore-query",
+                self.stats[QUERY],
+                "{0.calls} queries returning {0.rows} rows",
+            ),
+            (
+                "matrixstore-decompress",
+                self.stats[DECOMPRESS],
+                "{0.calls} values ({0.bytes_decompressed} bytes)",
+            ),
+            (
+                "matrixstore-row-grouper",
+                self.stats[ROW_GROUPER],
+                "{0.calls} calls",
+            ),
+        ]
+        return ", ".join(
+            '{};dur={:.1f};desc="{}"'.format(
+                name, stats.duration * 1000, description.format(stats)
+            )
+            for name, stats, description in metrics
+        )
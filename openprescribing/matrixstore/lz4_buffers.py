@@ -0,0 +1,161 @@
+"""
+Decompression of LZ4 frames into caller-provided buffers
+
+The `lz4` package always allocates a fresh buffer for the output of each call
+to `lz4.frame.decompress`. When summing thousands of large matrices, each of
+which we need only briefly, that means thousands of large allocations and
+frees which we can avoid by decompressing into a buffer which gets reused.
+
+The `lz4` package doesn't expose an API for doing this, but its frame module
+is a statically linked copy of the LZ4 library which exports the underlying C
+functions, so we call these directly via `ctypes`. This means we use exactly
+the same version of LZ4 as the rest of the code. Where this isn't possible
+(e.g. on a build of `lz4` which doesn't export these symbols) `AVAILABLE` is
+False and callers should fall back to `lz4.frame.decompress`.
+
+As these symbols aren't part of the package's public API the version of `lz4`
+is pinned in `requirements.in`, and `matrixstore.tests.test_serializer` fails
+if they stop being available so that an upgrade can't silently disable this.
+
+`ctypes` releases the GIL during foreign function calls so, as with
+`lz4.frame.decompress`, decompression can run in parallel across threads.
+"""
+
+import ctypes
+import struct
+import threading
+
+import lz4.frame
+import numpy
+
+# See: https://github.com/lz4/lz4/blob/dev/lib/lz4frame.h
+LZ4F_VERSION = 100
+
+# Offsets within the frame header, see:
+# https://github.com/lz4/lz4/blob/dev/doc/lz4_Frame_format.md
+FLG_OFFSET = 4
+CONTENT_SIZE_FLAG = 0x08
+CONTENT_SIZE_OFFSET = 6
+
+
+class LZ4BufferError(ValueError):
+    pass
+
+
+def _load_library():
+    try:
+        library = ctypes.CDLL(lz4.frame._frame.__file__)
+        create_context = library.LZ4F_createDecompressionContext
+        free_context = library.LZ4F_freeDecompressionContext
+        reset_context = library.LZ4F_resetDecompressionContext
+        decompress = library.LZ4F_decompress
+        is_error = library.LZ4F_isError
+        get_error_name = library.LZ4F_getErrorName
+    except (OSError, AttributeError):
+        return None
+    create_context.argtypes = [ctypes.POINTER(ctypes.c_void_p), ctypes.c_uint]
+    create_context.restype = ctypes.c_size_t
+    free_context.argtypes = [ctypes.c_void_p]
+    free_context.restype = ctypes.c_size_t
+    reset_context.argtypes = [ctypes.c_void_p]
+    reset_context.restype = None
+    decompress.argtypes = [
+        ctypes.c_void_p,
+        ctypes.c_void_p,
+        ctypes.POINTER(ctypes.c_size_t),
+        ctypes.c_void_p,
+        ctypes.POINTER(ctypes.c_size_t),
+        ctypes.c_void_p,
+    ]
+    decompress.restype = ctypes.c_size_t
+    is_error.argtypes = [ctypes.c_size_t]
+    is_error.restype = ctypes.c_uint
+    get_error_name.argtypes = [ctypes.c_size_t]
+    get_error_name.restype = ctypes.c_char_p
+    return library
+
+
+_library = _load_library()
+
+AVAILABLE = _library is not None
+
+_local = threading.local()
+
+
+class DecompressionContext:
+    """
+    Wraps an LZ4F decompression context, which can be reused between frames
+    but not shared between threads
+    """
+
+    def __init__(self):
+        self.pointer = ctypes.c_void_p()
+        check(_library.LZ4F_createDecompressionContext(self.pointer, LZ4F_VERSION))
+        # Keep a reference to this as module globals may already have been
+        # cleared by the time we get garbage collected at shutdown
+        self._free = _library.LZ4F_freeDecompressionContext
+
+    def __del__(self):
+        if self.pointer:
+            self._free(self.pointer)
+
+    def reset(self):
+        _library.LZ4F_resetDecompressionContext(self.pointer)
+
+
+def get_context():
+    context = getattr(_local, "context", None)
+    if context is None:
+        context = _local.context = DecompressionContext()
+    return context
+
+
+def get_content_size(data):
+    """
+    Return the uncompressed size recorded in the header of the LZ4 frame in
+    `data` or None if the frame doesn't record it
+
+    `lz4.frame.compress` records the size by default, so all frames we write
+    include it.
+    """
+    flags = data[FLG_OFFSET]
+    if not flags & CONTENT_SIZE_FLAG:
+        return None
+    return struct.unpack_from("<Q", data, CONTENT_SIZE_OFFSET)[0]
+
+
+def decompress_into(data, buffer):
+    """
+    Decompress the single LZ4 frame in `data` into the start of `buffer` (a
+    writable object supporting the buffer protocol, which must be large
+    enough to hold the output) and return the number of bytes written
+    """
+    source = numpy.frombuffer(data, dtype=numpy.uint8)
+    destination = numpy.frombuffer(buffer, dtype=numpy.uint8)
+    source_size = ctypes.c_size_t(len(source))
+    destination_size = ctypes.c_size_t(len(destination))
+    context = get_context()
+    result = _library.LZ4F_decompress(
+        context.pointer,
+        destination.ctypes.data,
+        destination_size,
+        source.ctypes.data,
+        source_size,
+        None,
+    )
+    # A result of zero means that we've reached the end of the frame. Anything
+    # else means that the frame was truncated or the buffer too small.
+    if result != 0 or source_size.value != len(source):
+        context.reset()
+        check(result)
+        raise LZ4BufferError(
+            "Could not decompress frame of {} bytes into buffer of {} bytes".format(
+                len(source), len(destination)
+            )
+        )
+    return destination_size.value
+
+
+def check(result):
+    if _library.LZ4F_isError(result):
+        raise LZ4BufferError(_library.LZ4F_getErrorName(result).decode("ascii"))
@@ -0,0 +1,64 @@
+"""
+Runs benchmarks of the MatrixStore's hot paths against a synthetic MatrixStore
+and outputs the results as JSON (see `matrixstore.tests.benchmarks`)
+
+To check for regressions, run this with the same options on two different
+commits and compare the results.
+"""
+
+import json
+
+from django.core.management import BaseCommand
+from matrixstore.tests.benchmarks import (
+    BENCHMARKS,
+    DEFAULT_SIZE,
+    Fixture,
+    run_benchmarks,
+)
+
+
+class Command(BaseCommand):
+    help = __doc__
+
+    def add_arguments(self, parser):
+        for name, default in DEFAULT_SIZE.items():
+            parser.add_argument(
+                "--{}".format(name),
+                type=int,
+                default=default,
+                help="Number of {} in the synthetic MatrixStore".format(name),
+            )
+        parser.add_argument("--seed", type=int, default=1)
+        parser.add_argument(
+            "--repeat", type=int, default=5, help="Number of times to run each"
+        )
+        parser.add_argument(
+            "--benchmark",
+            action="append",
+            dest="benchmarks",
+            choices=sorted(BENCHMARKS),
+            help="Benchmark to run (can be repeated; default: all)",
+        )
+        parser.add_argument(
+            "--output", help="File to write results to (default: stdout)"
+        )
+
+    def handle(
+        self,
+        practices,
+        months,
+        presentations,
+        seed,
+        repeat,
+        benchmarks=None,
+        output=None,
+        **kwargs
+    ):
+        fixture = Fixture(practices, months, presentations, seed=seed)
+        results = run_benchmarks(fixture, names=benchmarks, repeat=repeat)
+        results_json = json.dumps(results, indent=2)
+        if output:
+            with open(output, "w") as f:
+                f.write(results_json)
+        else:
+            self.stdout.write(results_json)
@@ -9,6 +9,12 @@ import sqlite3
 
 from django.conf import settings
 from django.core.management import BaseCommand
+from matrixstore.build.build_cube import build_cube
+from matrixstore.build.build_hot_storage import build_hot_storage
+from matrixstore.build.build_row_groupers import build_row_groupers
+from matrixstore.build.chunk_presentations_by_date import (
+    chunk_presentations_by_date,
+)
 from matrixstore.build.common import get_temp_filename
 from matrixstore.build.dates import DEFAULT_NUM_MONTHS
 from matrixstore.build.download_practice_stats import download_practice_stats
@@ -16,9 +22,20 @@ from matrixstore.build.download_prescribing import download_prescribing
 from matrixstore.build.generate_filename import generate_filename
 from matrixstore.build.import_practice_stats import import_practice_stats
 from matrixstore.build.import_prescribing import import_prescribing
+from matrixstore.build.import_prescribing_incremental import (
+    get_dates_missing_from_previous,
+    get_storage_options,
+    import_prescribing_incremental,
+)
 from matrixstore.build.init_db import init_db
+from matrixstore.build.precalculate_bnf_prefix_totals import (
+    precalculate_bnf_prefix_totals,
+)
 from matrixstore.build.precalculate_totals import precalculate_totals
 from matrixstore.build.update_bnf_map import update_bnf_map
+from matrixstore.cube import get_cube_path
+from matrixstore.hot_storage import get_hot_storage_path
+from matrixstore.row_grouper_storage import get_row_groupers_path
 
 logger = logging.getLogger(__name__)
 
@@ -35,14 +52,92 @@ class Command(BaseCommand):
             ),
             default=DEFAULT_NUM_MONTHS,
         )
+        parser.add_argument(
+            "--months-per-chunk",
+            help=(
+                "Split each presentation's matrices by date into separately "
+                "compressed chunks of this many months (default: no chunking)"
+            ),
+            type=int,
+        )
+        parser.add_argument(
+            "--hot-presentations",
+            help=(
+                "Store uncompressed copies of the matrices for this many of the "
+                "most prescribed presentations in a memory-mapped sidecar file "
+                "(default: none)"
+            ),
+            type=int,
+        )
+        parser.add_argument(
+            "--cube-months",
+            help=(
+                "Store dense arrays of quantity and net cost for this many of "
+                "the latest months in a memory-mapped sidecar file, for the "
+                "analyses which cover every presentation (default: none)"
+            ),
+            type=int,
+        )
+        parser.add_argument(
+            "--row-groupers",
+            help=(
+                "Write row groupers, built from the org relationships currently "
+                "in the database, to a sidecar file so that web workers don't "
+                "need to build them at startup. The sidecar must be regenerated "
+                "with `matrixstore_build_row_groupers` whenever org "
+                "relationships change (default: don't write one)"
+            ),
+            action="store_true",
+        )
+        parser.add_argument(
+            "--incremental",
+            help=(
+                "Reuse the data in the live MatrixStore file and only import "
+                "prescribing for months which it doesn't cover"
+            ),
+            action="store_true",
+        )
+        parser.add_argument(
+            "--processes",
+            help=(
+                "Number of worker processes to use for an incremental build "
+                "(default: number of CPUs)"
+            ),
+            type=int,
+        )
         parser.add_argument(
             "--quiet", help="Don't emit logging output", action="store_true"
         )
 
-    def handle(self, end_date, months=None, quiet=False, **kwargs):
+    def handle(
+        self,
+        end_date,
+        months=None,
+        months_per_chunk=None,
+        hot_presentations=None,
+        cube_months=None,
+        row_groupers=False,
+        incremental=False,
+        processes=None,
+        quiet=False,
+        **kwargs
+    ):
+        if incremental:
+            previous_file = os.path.realpath(settings.MATRIXSTORE_LIVE_FILE)
+        else:
+            previous_file = None
         log_level = "INFO" if not quiet else "ERROR"
         with LogToStream("matrixstore", self.stdout, log_level):
-            return build(end_date, months=months)
+            return build(
+                end_date,
+                months=months,
+                months_per_chunk=months_per_chunk,
+                hot_presentations=hot_presentations,
+                cube_months=cube_months,
+                row_groupers=row_groupers,
+                previous_file=previous_file,
+                processes=processes,
+            )
 
 
 class LogToStream(object):
@@ -72,24 +167,90 @@ class LogToStream(object):
         self.logger.removeHandler(self.handler)
 
 
-def build(end_date, months=None):
+def build(
+    end_date,
+    months=None,
+    months_per_chunk=None,
+    hot_presentations=None,
+    cube_months=None,
+    row_groupers=False,
+    previous_file=None,
+    processes=None,
+):
     directory = settings.MATRIXSTORE_BUILD_DIR
     sqlite_temp = get_temp_filename(os.path.join(directory, "matrixstore.sqlite"))
     init_db(end_date, sqlite_temp, months=months)
     download_practice_stats(end_date, months=months)
     import_practice_stats(sqlite_temp)
-    download_prescribing(end_date, months=months)
-    import_prescribing(sqlite_temp)
-    update_bnf_map(sqlite_temp)
+    if previous_file:
+        months_per_chunk, hot_presentations = get_storage_options_for_incremental(
+            previous_file, months_per_chunk, hot_presentations
+        )
+        # We only need CSV files for the months at the end of the range which
+        # aren't covered by the previous file
+        new_dates = get_dates_missing_from_previous(sqlite_temp, previous_file)
+        if new_dates:
+            download_prescribing(end_date, months=len(new_dates))
+        import_prescribing_incremental(sqlite_temp, previous_file, processes=processes)
+    else:
+        download_prescribing(end_date, months=months)
+        import_prescribing(sqlite_temp)
+    update_bnf_map(sqlite_temp, processes=processes)
     precalculate_totals(sqlite_temp)
+    precalculate_bnf_prefix_totals(sqlite_temp)
+    if months_per_chunk:
+        chunk_presentations_by_date(sqlite_temp, months_per_chunk)
+    # This needs to read the matrices so must happen before any are moved to
+    # hot storage
+    if cube_months:
+        build_cube(sqlite_temp, cube_months)
+    if hot_presentations:
+        build_hot_storage(sqlite_temp, hot_presentations)
     vacuum_database(sqlite_temp)
+    if row_groupers:
+        build_row_groupers(sqlite_temp)
     basename = generate_filename(sqlite_temp)
     filename = os.path.join(directory, basename)
     logger.info("Moving file to final location: %s", filename)
     os.rename(sqlite_temp, filename)
+    if hot_presentations:
+        # The hot storage file must always live alongside its SQLite file
+        os.rename(get_hot_storage_path(sqlite_temp), get_hot_storage_path(filename))
+    if cube_months:
+        os.rename(get_cube_path(sqlite_temp), get_cube_path(filename))
+    if row_groupers:
+        os.rename(get_row_groupers_path(sqlite_temp), get_row_groupers_path(filename))
     return filename
 
 
+def get_storage_options_for_incremental(
+    previous_file, months_per_chunk, hot_presentations
+):
+    """
+    Return the `months_per_chunk` and `hot_presentations` options for an
+    incremental build, taking any which aren't supplied from the previous file
+
+    We raise an error if the supplied options don't match those of the previous
+    file, as it's easy to forget to pass them and a file stored differently from
+    the one it replaces may perform very differently.
+    """
+    previous_options = get_storage_options(previous_file)
+    options = {
+        "months_per_chunk": months_per_chunk,
+        "hot_presentations": hot_presentations,
+    }
+    for name, value in options.items():
+        if value is None:
+            options[name] = previous_options[name]
+        elif value != previous_options[name]:
+            raise RuntimeError(
+                "Option {} is {} but previous file {} was built with {}".format(
+                    name, value, previous_file, previous_options[name]
+                )
+            )
+    return options["months_per_chunk"], options["hot_presentations"]
+
+
 def vacuum_database(sqlite_path):
     """
     Rebuild the database file, repacking it into the minimal amount of space
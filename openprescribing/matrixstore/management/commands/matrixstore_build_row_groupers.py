@@ -0,0 +1,35 @@
+"""
+Builds the row groupers (which map practices to CCGs, PCNs, STPs etc.) for a
+MatrixStore file using the org relationships currently in the database and
+writes them to a sidecar file alongside it, so that web workers can load them
+without querying the database. By default it uses the live MatrixStore file.
+
+This happens automatically when a new MatrixStore file is built, so it only
+needs running when org relationships change; there's no need to rebuild the
+MatrixStore file itself. As with any other change to the MatrixStore, the
+application will need to be restarted to pick up the new data.
+"""
+
+import os
+
+from django.conf import settings
+from django.core.management import BaseCommand
+from matrixstore.build.build_row_groupers import build_row_groupers
+
+
+class Command(BaseCommand):
+    help = __doc__
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--filename",
+            help="Name of MatrixStore file in MATRIXSTORE_BUILD_DIR (default: live)",
+        )
+
+    def handle(self, filename=None, **kwargs):
+        if filename:
+            path = os.path.join(settings.MATRIXSTORE_BUILD_DIR, filename)
+        else:
+            path = settings.MATRIXSTORE_LIVE_FILE
+        output_path = build_row_groupers(os.path.realpath(path))
+        self.stdout.write("Wrote row groupers to: {}".format(output_path))
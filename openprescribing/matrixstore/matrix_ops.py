@@ -116,6 +116,102 @@ def smallest_int_type_for_range(minimum, maximum):
         return numpy.int64
 
 
+def to_dense(matrix):
+    """
+    Return a dense `ndarray` version of `matrix` (which may be sparse)
+    """
+    if scipy.sparse.issparse(matrix):
+        return matrix.toarray()
+    return numpy.asarray(matrix)
+
+
+def hstack_matrices(matrices):
+    """
+    Stack a list of matrices (all either dense or sparse CSC) horizontally
+    """
+    if len(matrices) == 1:
+        return matrices[0]
+    if isinstance(matrices[0], csc_matrix):
+        return scipy.sparse.hstack(matrices, format="csc")
+    else:
+        return numpy.hstack(matrices)
+
+
+def nan_centile(matrix, centile, axis=0, method="linear"):
+    """
+    Return the given centile of the values in `matrix` along `axis`, ignoring
+    any NaNs
+
+    For floating point input this gives identical results, of the same type,
+    to `numpy.nanpercentile` for the "linear" and "lower" methods (the only
+    ones we use). For integer input we always return float64, whereas numpy
+    returns integers for the "lower" method.
+
+    It is considerably faster than numpy on the matrices we typically have,
+    where many values are NaN (e.g. the price-per-unit for practices which
+    didn't prescribe a presentation). Rather than copying and sorting each
+    column separately, we drop all the NaNs in one operation and then use
+    `numpy.partition` to select just the values we need from what remains of
+    each column. Any columns with no values give a centile of NaN (without the
+    warning numpy emits).
+    """
+    if method not in ("linear", "lower"):
+        raise ValueError("Unsupported method: {}".format(method))
+    matrix = numpy.asarray(matrix)
+    # Arrange the values so that each row holds those for one centile
+    values = numpy.moveaxis(matrix, axis, -1)
+    result_shape = values.shape[:-1]
+    values = values.reshape(numpy.prod(result_shape, dtype=int), values.shape[-1])
+    not_nan = ~numpy.isnan(values)
+    counts = numpy.count_nonzero(not_nan, axis=1)
+    # This leaves the values for each row as a contiguous run in a flat array
+    remaining = values[not_nan]
+    ends = numpy.cumsum(counts)
+    starts = ends - counts
+    # Find the positions (within the sorted run of values for each row) of the
+    # values we need, calculated exactly as numpy does
+    dtype = values.dtype
+    quantile = numpy.true_divide(centile, dtype.type(100) if dtype.kind == "f" else 100)
+    # Like numpy, we work (and return results) in the precision of the input
+    # where it's floating point, and in float64 otherwise
+    result_dtype = quantile.dtype
+    virtual_index = (counts - 1).astype(result_dtype) * quantile
+    lower = numpy.floor(virtual_index).astype(numpy.intp)
+    if method == "lower":
+        upper = lower
+    else:
+        upper = lower + 1
+        at_end = virtual_index >= counts - 1
+        lower[at_end] = -1
+        upper[at_end] = -1
+        gamma = virtual_index - lower
+    lower_values = numpy.full(len(values), numpy.nan, dtype=result_dtype)
+    upper_values = numpy.full(len(values), numpy.nan, dtype=result_dtype)
+    rows = zip(starts.tolist(), ends.tolist(), lower.tolist(), upper.tolist())
+    for row, (start, end, lower_offset, upper_offset) in enumerate(rows):
+        if start == end:
+            continue
+        run = remaining[start:end]
+        run.partition(sorted({lower_offset % len(run), upper_offset % len(run)}))
+        lower_values[row] = run[lower_offset]
+        upper_values[row] = run[upper_offset]
+    if method == "lower":
+        result = lower_values
+    else:
+        # This is the interpolation numpy uses (see `numpy.lib._lerp`). Rows
+        # with no values, or with infinite values, produce NaNs here as they
+        # do in numpy, but we don't want the warnings that go with them.
+        gamma = gamma.astype(result_dtype, copy=False)
+        with numpy.errstate(invalid="ignore"):
+            difference = upper_values - lower_values
+            result = lower_values + difference * gamma
+            numpy.subtract(
+                upper_values, difference * (1 - gamma), out=result, where=gamma >= 0.5
+            )
+    result = result.reshape(result_shape)
+    return result[()] if result.ndim == 0 else result
+
+
 def get_submatrix(matrix, rows=slice(None, None), cols=slice(None, None)):
     """
     Return a submatrix sliced by the supplied rows and columns, with a special
@@ -0,0 +1,58 @@
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+
+from .instrumentation import Recorder, recording
+
+
+def matrixstore_timing_middleware(get_response):
+    """
+    Record the time each request spends in MatrixStore code and report it in a
+    `Server-Timing` header (see `matrixstore.instrumentation`)
+
+    When `MATRIXSTORE_INSTRUMENTATION` is off Django drops this middleware
+    entirely so it costs nothing.
+
+    For streaming responses most of the work happens while the body is being
+    sent, after the headers have gone, so we record (and log slow queries)
+    while streaming but don't add a `Server-Timing` header as it would only
+    cover the time taken to start the response.
+    """
+    if not settings.MATRIXSTORE_INSTRUMENTATION:
+        raise MiddlewareNotUsed()
+    threshold_ms = settings.MATRIXSTORE_SLOW_QUERY_THRESHOLD_MS
+    slow_threshold = threshold_ms / 1000 if threshold_ms is not None else None
+
+    def middleware(request):
+        recorder = Recorder(slow_threshold=slow_threshold, label=request.path)
+        with recording(recorder):
+            response = get_response(request)
+        if response.streaming:
+            response.streaming_content = record_while_streaming(
+                recorder, response.streaming_content
+            )
+            return response
+        server_timing = recorder.server_timing()
+        if response.has_header("Server-Timing"):
+            server_timing = response["Server-Timing"] + ", " + server_timing
+        response["Server-Timing"] = server_timing
+        return response
+
+    return middleware
+
+
+def record_while_streaming(recorder, content):
+    """
+    Yield each chunk of `content` with `recorder` installed while producing it
+
+    We only install the recorder while each chunk is being produced, and not
+    while it's being sent, to avoid recording anything the server does between
+    chunks.
+    """
+    content = iter(content)
+    while True:
+        with recording(recorder):
+            try:
+                chunk = next(content)
+            except StopIteration:
+                return
+        yield chunk
@@ -5,7 +5,8 @@ Invoke with:
 ./manage.py shell -c 'from matrixstore.profile import profile; profile()'
 
 Currently set up to profile the total spending code, but easy to adapt to
-profile other functions (e.g. PPU savings - see commented out code)
+profile other functions (e.g. PPU savings - see commented out code). For timing
+comparisons between commits use the `matrixstore_benchmark` command instead.
 """
 
 import datetime
@@ -13,13 +14,13 @@ import time
 from cProfile import Profile
 
 # from frontend.price_per_unit.savings import get_all_savings_for_orgs
-from api.views_spending import _get_total_prescribing_entries
+from api.views_spending import AllEngland, _get_prescribing_entries
 
 
 def test():
     # get_all_savings_for_orgs("2019-11-01", "ccg", ["99C"])
     # get_all_savings_for_orgs("2019-11-01", "all_standard_practices", [None])
-    list(_get_total_prescribing_entries(["02"]))
+    list(_get_prescribing_entries(["02"], [AllEngland()], "all_practices"))
 
 
 def profile():
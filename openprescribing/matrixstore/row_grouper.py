@@ -1,9 +1,11 @@
-import hashlib
 from collections import defaultdict
 
 import numpy
 import scipy.sparse
 
+from .cachelib import fingerprint
+from .instrumentation import instrument_row_grouper
+
 
 class UnknownGroupError(KeyError):
     pass
@@ -78,12 +80,29 @@ class RowGrouper(object):
             )
         else:
             self._single_row_groups_selector = None
+        # For the general case we sum groups by multiplying by a sparse
+        # "indicator" matrix of shape (groups X rows) which has a 1 wherever a
+        # row belongs to a group. We store the indices in CSR format here and
+        # build the actual matrix when we know the shape and type of the matrix
+        # we're grouping (see `_get_indicator_matrix`).
+        self._indicator_indptr = numpy.cumsum(
+            [0] + [len(selector) for selector in self._group_selectors.values()],
+            dtype=numpy.int64,
+        )
+        self._indicator_indices = numpy.concatenate(
+            [numpy.array([], dtype=numpy.int64)]
+            + [selector for selector in self._group_selectors.values()]
+        ).astype(numpy.int64)
         # `cache_key` is used to identify the state of this RowGrouper for
         # caching purposes i.e.  RowGrouper instances should have the same
-        # cache_key if and only if they have same group configuration
-        hashobj = hashlib.md5(str(self._group_selectors).encode("utf8"))
-        self.cache_key = hashobj.digest()
+        # cache_key if and only if they have same group configuration. The
+        # indicator indices and offsets fully determine which rows belong to
+        # each group.
+        self.cache_key = fingerprint(
+            self.ids, self._indicator_indptr, self._indicator_indices
+        )
 
+    @instrument_row_grouper
     def sum(self, matrix, group_ids=None):
         """
         Sum rows of matrix column-wise, according to their group
@@ -105,40 +124,58 @@ class RowGrouper(object):
             # Otherwise build a selector containing just the rows we want
             else:
                 row_selector = numpy.array(
-                    [self._group_selectors[group_id][0] for group_id in group_ids]
+                    [self._group_selectors[group_id][0] for group_id in group_ids],
+                    dtype=int,
                 )
                 return matrix[row_selector]
 
-        # If we can't take the fast path then build a list of row selectors for
-        # each group we want
+        # Otherwise we do the grouping as a single sparse matrix product. Where
+        # the input is a sparse matrix this also avoids ever having to convert
+        # it to a dense one.
+        indicator = self._get_indicator_matrix(matrix.shape[0], matrix.dtype)
         if group_ids is not None:
-            row_selectors = [self._group_selectors[group_id] for group_id in group_ids]
-        else:
-            row_selectors = self._group_selectors.values()
-
-        # Initialise an array to contain the output
-        rows = len(row_selectors)
-        columns = matrix.shape[1]
-        grouped_output = numpy.empty((rows, columns), dtype=matrix.dtype)
-
-        # This is awkward. We always want to return an `ndarray` even if the
-        # input type is `matrix`. But where the input is a `matrix` the `out`
-        # argument to `numpy.sum` below must be a `matrix` also. So we need a
-        # view on our output array which matches the type of the input array,
-        # while leaving the actual `grouped_output` return value always of type
-        # `ndarray`.  See the `is_matrix` docstring for more detail.
-        if is_matrix(matrix):
-            output_view = numpy.asmatrix(grouped_output)
-        else:
-            output_view = grouped_output
+            group_offsets = [self._get_group_offset(group_id) for group_id in group_ids]
+            indicator = indicator[group_offsets]
+        grouped_output = indicator @ matrix
+        # We always want to return an `ndarray` even if the input was a sparse
+        # matrix or of `matrix` type. See the `is_matrix` docstring for more
+        # detail.
+        if scipy.sparse.issparse(grouped_output):
+            grouped_output = grouped_output.toarray()
+        return numpy.asarray(grouped_output)
+
+    def _get_indicator_matrix(self, rows, dtype):
+        """
+        Return the sparse (groups X rows) matrix which, when multiplied by a
+        matrix of shape (rows X columns), gives the sums for each group
 
-        for row_offset, row_selector in enumerate(row_selectors):
-            # Get the rows to be summed
-            row_group = matrix[row_selector]
-            # Sum them and write the result into the output array
-            numpy.sum(row_group, axis=0, out=output_view[row_offset])
-        return grouped_output
+        We use the same type as the input matrix so that the output type
+        matches it too.
+        """
+        data = numpy.ones(len(self._indicator_indices), dtype=dtype)
+        return scipy.sparse.csr_matrix(
+            (data, self._indicator_indices, self._indicator_indptr),
+            shape=(len(self.ids), rows),
+        )
 
+    def get_group_assignments(self):
+        """
+        Return a list of (row_offset, group_id) pairs which, when passed to the
+        constructor, give an identical RowGrouper
+        """
+        return [
+            (row_offset, group_id)
+            for group_id, selector in self._group_selectors.items()
+            for row_offset in selector.tolist()
+        ]
+
+    def _get_group_offset(self, group_id):
+        try:
+            return self.offsets[group_id]
+        except KeyError:
+            raise UnknownGroupError(group_id)
+
+    @instrument_row_grouper
     def sum_one_group(self, matrix, group_id):
         """
         Sum the rows of matrix (column-wise) which belong to the specified
@@ -0,0 +1,88 @@
+"""
+Support for storing precomputed row groupers for every org type in a sidecar
+file which lives alongside the SQLite file
+
+Building the row groupers requires several queries against the `Practice`
+table followed by a fair amount of work in Python. Doing this at startup in
+every web worker is wasteful, so instead we do it once when the MatrixStore
+file is built (or later on, using the `matrixstore_build_row_groupers`
+command) and have workers load the results with a single read.
+
+These groupings aren't stored in the SQLite file itself so that they can be
+regenerated when org relationships change, without rebuilding the matrices.
+
+Rather than pickling `RowGrouper` instances, whose attributes change as the
+class evolves, we store just the plain data needed to rebuild them: the
+(row_offset, group_id) assignments for each org type. Files written in any
+other format are ignored, in which case the row groupers get built from the
+database as usual.
+"""
+
+import logging
+import os
+
+from .row_grouper import RowGrouper
+from .serializer import deserialize, serialize_compressed
+
+logger = logging.getLogger(__name__)
+
+ROW_GROUPERS_SUFFIX = ".row_groupers"
+
+# Increment this if the structure of the stored data changes
+FORMAT_VERSION = 1
+
+
+def get_row_groupers_path(sqlite_path):
+    return sqlite_path + ROW_GROUPERS_SUFFIX
+
+
+def write_row_groupers(path, practices, row_groupers):
+    """
+    Write a dict mapping org types to RowGrouper instances to `path`
+
+    `practices` is the list of practice codes, in row order, of the MatrixStore
+    file for which the row groupers were built
+    """
+    data = serialize_compressed(
+        {
+            "format_version": FORMAT_VERSION,
+            "practices": list(practices),
+            "group_assignments": {
+                org_type: row_grouper.get_group_assignments()
+                for org_type, row_grouper in row_groupers.items()
+            },
+        }
+    )
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def read_row_groupers(path, practices):
+    """
+    Return the dict of row groupers stored at `path`, or an empty dict if the
+    file doesn't exist, can't be read, or was built for a different set of
+    practices (in which case the row offsets it contains will be wrong)
+    """
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "rb") as f:
+            stored = deserialize(f.read())
+        format_version = stored.get("format_version")
+    except Exception:
+        logger.warning("Ignoring unreadable row groupers file: %s", path, exc_info=True)
+        return {}
+    if format_version != FORMAT_VERSION:
+        logger.warning(
+            "Ignoring row groupers file with format version %s: %s",
+            format_version,
+            path,
+        )
+        return {}
+    if stored["practices"] != list(practices):
+        logger.warning("Ignoring row groupers built for different practices: %s", path)
+        return {}
+    return {
+        org_type: RowGrouper(group_assignments)
+        for org_type, group_assignments in stored["group_assignments"].items()
+    }
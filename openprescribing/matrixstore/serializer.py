@@ -1,12 +1,35 @@
 import pickle
 import struct
+import threading
+import time
 
 import lz4.frame
+import numpy
+
+from . import lz4_buffers
+from .instrumentation import get_recorder
+from .matrix_ops import get_submatrix, hstack_matrices
 
 # The magic intial bytes which tell us that a given binary chunk is LZ4
 # compressed data
 LZ4_MAGIC_NUMBER = struct.pack("<I", 0x184D2204)
 
+# The magic initial bytes which tell us that a given binary chunk is a matrix
+# which has been split by column into separately compressed blocks (see
+# `serialize_chunked`)
+CHUNKED_MAGIC_NUMBER = b"MSCB"
+
+# The magic initial bytes which tell us that a given binary chunk is not
+# itself a matrix but a reference to one stored in a hot storage sidecar file
+# (see `matrixstore.hot_storage`)
+HOT_STORAGE_REFERENCE_MAGIC_NUMBER = b"MSHR"
+
+# Values larger than this are never decompressed into the per-thread scratch
+# buffers used by `deserialize_transient`, so that a single unusually large
+# value doesn't leave every thread holding on to a buffer of that size. This
+# comfortably covers the matrices for all the months we keep.
+MAX_SCRATCH_BUFFER_SIZE = 32 * 1024 * 1024
+
 
 def serialize(obj):
     """
@@ -57,15 +80,197 @@ def serialize_compressed(obj):
     return lz4.frame.compress(data, compression_level=10, return_bytearray=True)
 
 
-def deserialize(data):
+def deserialize(data, buffer=None):
     """
     Deserialize binary data, whether compressed or uncompressed
+
+    If a writable `buffer` is supplied, and it's large enough, then compressed
+    data is decompressed into it rather than into a newly allocated buffer and
+    the result is a zero-copy view onto the buffer. Callers are responsible for
+    not reusing the buffer while the result is still needed.
     """
-    if data.startswith(LZ4_MAGIC_NUMBER):
-        data = lz4.frame.decompress(data, return_bytearray=True)
+    if starts_with(data, LZ4_MAGIC_NUMBER):
+        data = decompress(data, buffer)
+    elif starts_with(data, CHUNKED_MAGIC_NUMBER):
+        return deserialize_columns(data, 0, None)
+    elif starts_with(data, HOT_STORAGE_REFERENCE_MAGIC_NUMBER):
+        raise ValueError(
+            "Data is stored in a hot storage file which has not been loaded"
+        )
     return deserialize_uncompressed(data)
 
 
+def deserialize_transient(data):
+    """
+    Deserialize binary data which is only needed briefly (e.g. while adding it
+    to a running total)
+
+    Compressed data is decompressed into a scratch buffer belonging to the
+    current thread, which is overwritten by the next call on the same thread.
+    The result must therefore be finished with before then. This saves a large
+    allocation and free for each value when summing thousands of matrices.
+    """
+    size = get_uncompressed_size(data)
+    if size is None or size > MAX_SCRATCH_BUFFER_SIZE:
+        return deserialize(data)
+    return deserialize(data, get_scratch_buffer(size))
+
+
+def decompress(data, buffer=None):
+    size = get_uncompressed_size(data) if buffer is not None else None
+    if size is not None and size <= len(buffer):
+        output = buffer[:size]
+    else:
+        output = None
+    recorder = get_recorder()
+    if recorder is not None:
+        start = time.perf_counter()
+    if output is None:
+        output = lz4.frame.decompress(data, return_bytearray=True)
+    else:
+        lz4_buffers.decompress_into(data, output)
+    if recorder is not None:
+        recorder.record_decompression(len(output), time.perf_counter() - start)
+    return output
+
+
+def get_uncompressed_size(data):
+    """
+    Return the size of `data` once decompressed, if it's LZ4 compressed and we
+    can decompress it into a buffer of our own (see `lz4_buffers`), otherwise
+    return None
+    """
+    if not lz4_buffers.AVAILABLE or not starts_with(data, LZ4_MAGIC_NUMBER):
+        return None
+    return lz4_buffers.get_content_size(data)
+
+
+def get_scratch_buffer(size):
+    """
+    Return a writable memoryview of `size` bytes onto the current thread's
+    scratch buffer
+
+    The underlying buffer grows as needed and is never shrunk, so each thread
+    ends up holding on to a buffer the size of the largest value it has
+    decompressed, up to `MAX_SCRATCH_BUFFER_SIZE`.
+    """
+    scratch = getattr(_scratch, "buffer", None)
+    if scratch is None or len(scratch) < size:
+        # We can't resize the existing buffer as there may still be views onto
+        # it, so we replace it instead. Rounding up to a power of two avoids
+        # replacing it over and over again as sizes creep up.
+        new_size = max(size, min(1 << (size - 1).bit_length(), MAX_SCRATCH_BUFFER_SIZE))
+        scratch = _scratch.buffer = bytearray(new_size)
+    return memoryview(scratch)[:size]
+
+
+_scratch = threading.local()
+
+
+def serialize_chunked(matrix, columns_per_chunk):
+    """
+    Serialize a matrix by splitting it into blocks of `columns_per_chunk`
+    columns and compressing each block separately
+
+    This means that readers who only want a few columns (e.g. a single month)
+    need only decompress the blocks which contain those columns: see
+    `deserialize_columns`.
+    """
+    num_columns = matrix.shape[1]
+    blocks = [
+        serialize_compressed(get_column_block(matrix, start, start + columns_per_chunk))
+        for start in range(0, num_columns, columns_per_chunk)
+    ]
+    header = serialize_ints([columns_per_chunk, num_columns])
+    return b"".join([CHUNKED_MAGIC_NUMBER, header, serialize_buffers(blocks)])
+
+
+def deserialize_columns(data, start, stop):
+    """
+    Deserialize just the columns from `start` up to (but not including) `stop`
+    of a serialized matrix (a `stop` of None means "to the end")
+
+    Where the matrix was serialized using `serialize_chunked` we only decompress
+    the blocks we need, otherwise we deserialize the whole thing and then slice
+    out the relevant columns. Either way, we decompress into the current
+    thread's scratch buffer and copy out just the columns we need.
+    """
+    if not starts_with(data, CHUNKED_MAGIC_NUMBER):
+        blocks = [data]
+        first_block = 0
+        columns_per_chunk = None
+    else:
+        data = memoryview(data)[len(CHUNKED_MAGIC_NUMBER) :]
+        (columns_per_chunk, num_columns), offset = deserialize_ints(data)
+        if stop is None:
+            stop = num_columns
+        first_block = start // columns_per_chunk
+        last_block = (stop - 1) // columns_per_chunk
+        blocks = deserialize_buffers(data[offset:])[first_block : last_block + 1]
+    buffers = get_scratch_buffers(blocks)
+    matrices = []
+    for n, (block, buffer) in enumerate(zip(blocks, buffers), start=first_block):
+        matrix = deserialize(block, buffer)
+        if columns_per_chunk is None:
+            cols = slice(start, stop)
+        else:
+            block_start = n * columns_per_chunk
+            cols = slice(
+                max(start - block_start, 0),
+                min(stop - block_start, columns_per_chunk),
+            )
+        matrices.append(get_submatrix(matrix, cols=cols))
+    matrix = hstack_matrices(matrices)
+    # Where we've just taken a view onto the decompressed data (rather than
+    # slicing or stacking, which copy) we need to copy it out of the buffer
+    if buffers[0] is not None and shares_memory(matrix, buffers[0].obj):
+        matrix = matrix.copy()
+    return matrix
+
+
+def get_scratch_buffers(values):
+    """
+    Return a list of separate regions of the current thread's scratch buffer
+    into which each of the supplied values can be decompressed
+
+    If any of the values can't be decompressed in this way, return a list of
+    Nones instead.
+    """
+    sizes = [get_uncompressed_size(value) for value in values]
+    if None in sizes:
+        return [None] * len(values)
+    scratch = get_scratch_buffer(sum(sizes))
+    buffers = []
+    offset = 0
+    for size in sizes:
+        buffers.append(scratch[offset : offset + size])
+        offset += size
+    return buffers
+
+
+def shares_memory(matrix, buffer):
+    if isinstance(matrix, numpy.ndarray):
+        arrays = [matrix]
+    else:
+        arrays = [matrix.data, matrix.indices, matrix.indptr]
+    buffer = numpy.frombuffer(buffer, dtype=numpy.uint8)
+    return any(numpy.may_share_memory(array, buffer) for array in arrays)
+
+
+def starts_with(data, prefix):
+    # Works for memoryviews (which have no `startswith` method) as well as bytes
+    return bytes(data[: len(prefix)]) == prefix
+
+
+def get_column_block(matrix, start, stop):
+    block = get_submatrix(matrix, cols=slice(start, stop))
+    # Dense column slices are views onto non-contiguous memory which would get
+    # pickled in the slower, copying fashion so we make them contiguous first
+    if isinstance(block, numpy.ndarray):
+        block = numpy.ascontiguousarray(block)
+    return block
+
+
 def serialize_buffers(buffers):
     """
     Serialize a list of binary data objects to bytes
@@ -0,0 +1,110 @@
+"""
+Benchmark comparing the practice statistics import against the original
+implementation which parsed rows one at a time and assigned each value to a
+LIL matrix
+
+Invoke with:
+./manage.py shell -c 'from matrixstore.tests.benchmark_import_practice_stats import run; run()'
+
+The fixture is generated by `DataFactory` at roughly the scale of real data:
+around 7,000 practices and 60 months of data, with one gzipped CSV file per
+month as produced by `download_practice_stats`. Generating it takes a little
+while so pass a `fixture_dir` to reuse it between runs.
+"""
+
+import glob
+import gzip
+import os
+import tempfile
+import time
+import tracemalloc
+
+from matrixstore.build.import_practice_stats import (
+    build_matrices,
+    parse_practice_statistics_csv,
+)
+from matrixstore.csv_utils import dicts_to_csv
+from matrixstore.serializer import serialize_compressed
+from matrixstore.tests.build.test_import_practice_stats import (
+    legacy_build_matrices,
+    legacy_parse_practice_statistics_csv,
+)
+from matrixstore.tests.data_factory import DataFactory
+
+NUM_PRACTICES = 7000
+NUM_MONTHS = 60
+
+
+def run(fixture_dir=None, num_practices=NUM_PRACTICES, num_months=NUM_MONTHS):
+    fixture_dir = fixture_dir or tempfile.mkdtemp()
+    filenames, practices, dates = create_fixture(fixture_dir, num_practices, num_months)
+    print("Importing {} practices x {} months".format(len(practices), len(dates)))
+
+    def new():
+        statistics = (
+            chunk
+            for filename in filenames
+            for chunk in parse_practice_statistics_csv(filename, compression="gzip")
+        )
+        return list(build_matrices(statistics, practices, dates))
+
+    def legacy():
+        statistics = (
+            row
+            for filename in filenames
+            for row in legacy_parse_practice_statistics_csv(gzip.open(filename, "rt"))
+        )
+        return list(legacy_build_matrices(statistics, practices, dates))
+
+    print("{:<8} {:>10} {:>16}".format("impl", "time (s)", "peak memory (MB)"))
+    results = {}
+    for name, function in [("legacy", legacy), ("new", new)]:
+        start = time.perf_counter()
+        results[name] = function()
+        duration = time.perf_counter() - start
+        print("{:<8} {:>10.2f} {:>16.1f}".format(name, duration, peak_memory(function)))
+    assert serialize(results["new"]) == serialize(results["legacy"])
+
+
+def create_fixture(fixture_dir, num_practices, num_months):
+    """
+    Write one gzipped CSV file of practice statistics per month to
+    `fixture_dir` (unless they already exist) and return the filenames along
+    with mappings of practice codes and dates to their offsets
+    """
+    factory = DataFactory()
+    months = factory.create_months("2015-01-01", num_months)
+    practices = factory.create_practices(num_practices)
+    filenames = sorted(glob.glob(os.path.join(fixture_dir, "*_practice_stats.csv.gz")))
+    if len(filenames) != num_months:
+        filenames = []
+        for month in months:
+            statistics = [
+                factory.create_statistics_for_one_practice_and_month(practice, month)
+                for practice in practices
+            ]
+            filename = os.path.join(
+                fixture_dir, "{}_practice_stats.csv.gz".format(month[:10])
+            )
+            with gzip.open(filename, "wt") as f:
+                f.writelines(dicts_to_csv(statistics))
+            filenames.append(filename)
+    practice_offsets = {p["code"]: i for i, p in enumerate(practices)}
+    date_offsets = {month[:10]: i for i, month in enumerate(months)}
+    return filenames, practice_offsets, date_offsets
+
+
+def peak_memory(function):
+    """
+    Return the peak memory allocated while running `function` in MB
+    """
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1] / 1024 / 1024
+    finally:
+        tracemalloc.stop()
+
+
+def serialize(matrices):
+    return [(name, serialize_compressed(matrix)) for name, matrix in matrices]
@@ -0,0 +1,92 @@
+"""
+Benchmark comparing `RowGrouper.sum` against the original implementation
+which looped over each group in Python
+
+Invoke with:
+./manage.py shell -c 'from matrixstore.tests.benchmark_row_grouper import run; run()'
+
+The shapes and group sizes are roughly those of real data: around 7,000
+practices and 60 months of data, grouped into PCNs, CCGs and STPs.
+"""
+
+import timeit
+
+import numpy
+import scipy.sparse
+from matrixstore.row_grouper import RowGrouper, is_matrix
+
+NUM_PRACTICES = 7000
+NUM_MONTHS = 60
+
+GROUP_SIZES = {
+    "pcn": 1250,
+    "ccg": 106,
+    "stp": 42,
+}
+
+
+def run(repeat=5, number=10):
+    random = numpy.random.default_rng(seed=1)
+    matrices = {
+        "dense": random.integers(0, 500, size=(NUM_PRACTICES, NUM_MONTHS)),
+        "sparse": scipy.sparse.random(
+            NUM_PRACTICES,
+            NUM_MONTHS,
+            density=0.05,
+            format="csc",
+            random_state=1,
+            data_rvs=lambda n: random.integers(1, 500, size=n),
+        ).astype(numpy.int64),
+    }
+    print(
+        "{:<6} {:<7} {:>12} {:>12} {:>8}".format(
+            "org", "matrix", "loop (ms)", "sum (ms)", "speedup"
+        )
+    )
+    for org_type, num_groups in GROUP_SIZES.items():
+        row_grouper = RowGrouper(
+            (row, "group_{}".format(group))
+            for row, group in enumerate(random.integers(0, num_groups, NUM_PRACTICES))
+        )
+        for matrix_type, matrix in matrices.items():
+            expected = loop_sum(row_grouper, matrix)
+            assert numpy.array_equal(row_grouper.sum(matrix), expected)
+            loop_time = best_time(lambda: loop_sum(row_grouper, matrix), repeat, number)
+            sum_time = best_time(lambda: row_grouper.sum(matrix), repeat, number)
+            print(
+                "{:<6} {:<7} {:>12.3f} {:>12.3f} {:>7.1f}x".format(
+                    org_type,
+                    matrix_type,
+                    loop_time * 1000,
+                    sum_time * 1000,
+                    loop_time / sum_time,
+                )
+            )
+
+
+def best_time(function, repeat, number):
+    return min(timeit.repeat(function, repeat=repeat, number=number)) / number
+
+
+def loop_sum(row_grouper, matrix, group_ids=None):
+    """
+    The original implementation of `RowGrouper.sum` for the case where groups
+    can contain more than one row
+    """
+    if group_ids is not None:
+        row_selectors = [
+            row_grouper._group_selectors[group_id] for group_id in group_ids
+        ]
+    else:
+        row_selectors = row_grouper._group_selectors.values()
+    rows = len(row_selectors)
+    columns = matrix.shape[1]
+    grouped_output = numpy.empty((rows, columns), dtype=matrix.dtype)
+    if is_matrix(matrix):
+        output_view = numpy.asmatrix(grouped_output)
+    else:
+        output_view = grouped_output
+    for row_offset, row_selector in enumerate(row_selectors):
+        row_group = matrix[row_selector]
+        numpy.sum(row_group, axis=0, out=output_view[row_offset])
+    return grouped_output
@@ -0,0 +1,341 @@
+"""
+Benchmarks for the code paths which do the bulk of the work when serving
+MatrixStore-backed pages and API calls
+
+Invoke with:
+./manage.py matrixstore_benchmark --output results.json
+
+Each benchmark runs against a synthetic MatrixStore of configurable size,
+generated by `DataFactory`, so results are only comparable between runs which
+use the same size and seed (both of which are recorded in the output along with
+the current commit). Anything which would normally come from Postgres (org
+relationships, substitution sets, tariff prices, presentation names) is
+generated from the same data.
+
+All caching is disabled while benchmarks run so that we time the actual
+calculations rather than cache lookups.
+"""
+
+import contextlib
+import datetime
+import platform
+import statistics
+import subprocess
+import time
+import warnings
+from collections import namedtuple
+
+import mock
+import numpy
+import scipy
+from api.views_spending import _get_prescribing_entries
+from django.core.cache.backends.base import CacheKeyWarning
+from django.test import override_settings
+from frontend import ghost_branded_generics
+from frontend.price_per_unit import savings
+from frontend.price_per_unit.substitution_sets import DictWithCacheID, SubstitutionSet
+from matrixstore.matrix_ops import get_submatrix
+from matrixstore.row_grouper import RowGrouper
+from matrixstore.serializer import deserialize
+from matrixstore.sql_functions import MatrixSum
+from matrixstore.tests.data_factory import DataFactory
+from matrixstore.tests.matrixstore_factory import (
+    matrixstore_from_data_factory,
+    patch_global_matrixstore,
+)
+
+# Default size of the synthetic MatrixStore. Real files have around 7,000
+# practices, 60 months and 20,000 presentations but generating data on that
+# scale with `DataFactory` takes a long time, so the defaults are smaller.
+DEFAULT_SIZE = {"practices": 1000, "months": 12, "presentations": 200}
+
+# Number of practices in each group for the synthetic org hierarchy. These give
+# roughly the same number of groups per practice as real data.
+PRACTICES_PER_GROUP = {"pcn": 6, "ccg": 65, "stp": 170}
+
+# Number of presentations in each synthetic substitution set
+PRESENTATIONS_PER_SUBSTITUTION_SET = 4
+
+# Fake org objects for passing to `_get_prescribing_entries`
+Org = namedtuple("Org", "pk name")
+
+BENCHMARKS = {}
+
+
+def benchmark(setup):
+    """
+    Register a benchmark
+
+    The decorated function accepts a `Fixture` and returns the function to be
+    timed
+    """
+    BENCHMARKS[setup.__name__] = setup
+    return setup
+
+
+class Fixture:
+    """
+    A synthetic MatrixStore along with all the other data needed to run
+    benchmarks against it
+    """
+
+    def __init__(self, practices, months, presentations, seed=1):
+        self.size = {
+            "practices": practices,
+            "months": months,
+            "presentations": presentations,
+            "seed": seed,
+        }
+        factory = DataFactory(seed=seed)
+        self.months = factory.create_months("2020-01-01", months)
+        self.practices = factory.create_practices(practices)
+        self.presentations = factory.create_presentations(presentations)
+        factory.create_prescribing(self.presentations, self.practices, self.months)
+        self.db = matrixstore_from_data_factory(factory)
+        self.date = self.db.dates[-1]
+        self.db.row_groupers = self.build_row_groupers(factory.random)
+        bnf_codes = [p["bnf_code"] for p in self.presentations]
+        n = PRESENTATIONS_PER_SUBSTITUTION_SET
+        self.substitution_sets = DictWithCacheID(
+            [
+                (codes[0], SubstitutionSet(codes[0], codes))
+                for codes in (bnf_codes[i : i + n] for i in range(0, len(bnf_codes), n))
+            ]
+        )
+        self.generic_bnf_codes = [
+            p["bnf_code"] for p in self.presentations if p["is_generic"]
+        ]
+
+    def build_row_groupers(self, random):
+        offsets = list(self.db.practice_offsets.values())
+        random.shuffle(offsets)
+        row_groupers = {
+            "practice": RowGrouper(
+                (o, code) for code, o in self.db.practice_offsets.items()
+            ),
+            "all_practices": RowGrouper((o, None) for o in offsets),
+        }
+        for org_type, group_size in PRACTICES_PER_GROUP.items():
+            row_groupers[org_type] = RowGrouper(
+                (offset, "{}{:04}".format(org_type, i // group_size))
+                for i, offset in enumerate(offsets)
+            )
+        # We don't distinguish between standard and non-standard practices
+        row_groupers["standard_practice"] = row_groupers["practice"]
+        row_groupers["standard_ccg"] = row_groupers["ccg"]
+        row_groupers["all_standard_practices"] = row_groupers["all_practices"]
+        return row_groupers
+
+    def get_orgs(self, org_type):
+        return [Org(pk, pk) for pk in sorted(self.db.row_groupers[org_type].offsets)]
+
+    @contextlib.contextmanager
+    def patched(self):
+        """
+        Make the fixture available via the usual global accessors, stub out
+        anything which would otherwise need Postgres and disable caching
+
+        The MatrixStore is closed on exit so this can only be used once
+        """
+        patches = [
+            mock.patch(
+                "frontend.price_per_unit.savings.get_substitution_sets",
+                return_value=self.substitution_sets,
+            ),
+            mock.patch(
+                "frontend.ghost_branded_generics.get_bnf_codes_with_single_tariff_price",
+                return_value=self.generic_bnf_codes,
+            ),
+            mock.patch(
+                "frontend.models.Presentation.names_for_bnf_codes", return_value={}
+            ),
+            override_settings(
+                CACHES={
+                    "default": {
+                        "BACKEND": "django.core.cache.backends.dummy.DummyCache"
+                    }
+                }
+            ),
+        ]
+        stop_patching = patch_global_matrixstore(self.db)
+        try:
+            with contextlib.ExitStack() as stack:
+                for patch in patches:
+                    stack.enter_context(patch)
+                # Our cache keys aren't valid memcached keys, which the dummy
+                # cache warns about
+                stack.enter_context(warnings.catch_warnings())
+                warnings.simplefilter("ignore", CacheKeyWarning)
+                yield
+        finally:
+            stop_patching()
+
+
+def run_benchmarks(fixture, names=None, repeat=5):
+    """
+    Run the named benchmarks (or all of them) against the fixture, returning a
+    JSON-serializable dict of results
+    """
+    names = names or list(BENCHMARKS)
+    unknown = set(names) - set(BENCHMARKS)
+    if unknown:
+        raise ValueError("Unknown benchmarks: {}".format(", ".join(sorted(unknown))))
+    results = {}
+    with fixture.patched():
+        for name in names:
+            function = BENCHMARKS[name](fixture)
+            times = []
+            for _ in range(repeat):
+                clear_local_caches()
+                start = time.perf_counter()
+                function()
+                times.append(time.perf_counter() - start)
+            results[name] = {
+                "min": min(times),
+                "median": statistics.median(times),
+                "mean": statistics.mean(times),
+                "times": times,
+            }
+    return {
+        "metadata": get_metadata(fixture, repeat),
+        "benchmarks": results,
+    }
+
+
+def clear_local_caches():
+    """
+    Clear the in-process caches of all memoized functions we benchmark
+    """
+    for function in [
+        savings.get_total_savings_for_org_type,
+        savings.get_quantities_and_net_costs_at_date,
+        ghost_branded_generics.get_inferred_tariff_prices,
+        ghost_branded_generics.get_total_ghost_branded_generic_spending_per_practice,
+    ]:
+        if function.local_cache is not None:
+            function.local_cache.clear()
+
+
+def get_metadata(fixture, repeat):
+    return {
+        "commit": get_git_commit(),
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "numpy": numpy.__version__,
+        "scipy": scipy.__version__,
+        "fixture": fixture.size,
+        "repeat": repeat,
+    }
+
+
+def get_git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_all_matrices(db, field):
+    return [value for (value,) in db.query("SELECT {} FROM presentation".format(field))]
+
+
+@benchmark
+def matrix_sum(fixture):
+    matrices = get_all_matrices(fixture.db, "net_cost")
+
+    def run():
+        matrix_sum = MatrixSum()
+        for matrix in matrices:
+            matrix_sum.add(matrix)
+        return matrix_sum.value()
+
+    return run
+
+
+@benchmark
+def row_grouper_sum(fixture):
+    row_grouper = fixture.db.row_groupers["ccg"]
+    matrices = get_all_matrices(fixture.db, "items")
+
+    def run():
+        for matrix in matrices:
+            row_grouper.sum(matrix)
+
+    return run
+
+
+@benchmark
+def get_submatrix_single_month(fixture):
+    matrices = get_all_matrices(fixture.db, "quantity")
+    offset = fixture.db.date_offsets[fixture.date]
+    cols = slice(offset, offset + 1)
+
+    def run():
+        for matrix in matrices:
+            get_submatrix(matrix, cols=cols)
+
+    return run
+
+
+@benchmark
+def deserialize_all(fixture):
+    # Get the raw bytes, rather than the deserialized matrices
+    sql = "SELECT net_cost FROM presentation"
+    values = [value for (value,) in fixture.db.connection.execute(sql)]
+
+    def run():
+        for value in values:
+            deserialize(value)
+
+    return run
+
+
+@benchmark
+def total_savings_for_org_type(fixture):
+    def run():
+        return savings.get_total_savings_for_org_type(
+            db=fixture.db,
+            substitution_sets=fixture.substitution_sets,
+            date=fixture.date,
+            group_by_org=fixture.db.row_groupers["ccg"],
+            min_saving=savings.CONFIG_MIN_SAVINGS_FOR_ORG_TYPE["ccg"],
+            practice_group_by_org=fixture.db.row_groupers["standard_practice"],
+            target_centile=savings.CONFIG_TARGET_CENTILE,
+        )
+
+    return run
+
+
+@benchmark
+def all_savings_for_orgs(fixture):
+    org_ids = sorted(fixture.db.row_groupers["ccg"].offsets)[:5]
+
+    def run():
+        return savings.get_all_savings_for_orgs(fixture.date, "ccg", org_ids)
+
+    return run
+
+
+@benchmark
+def ghost_branded_generic_spending(fixture):
+    org_ids = sorted(fixture.db.row_groupers["ccg"].offsets)[:5]
+
+    def run():
+        return ghost_branded_generics.get_ghost_branded_generic_spending(
+            fixture.date, "ccg", org_ids
+        )
+
+    return run
+
+
+@benchmark
+def prescribing_entries(fixture):
+    orgs = fixture.get_orgs("ccg")
+    bnf_code_prefixes = [fixture.presentations[0]["bnf_code"][:4]]
+
+    def run():
+        return list(_get_prescribing_entries(bnf_code_prefixes, orgs, "ccg"))
+
+    return run
@@ -0,0 +1,260 @@
+import gzip
+import io
+import os
+import re
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+from django.test import SimpleTestCase, override_settings
+from matrixstore.build.common import get_prescribing_filename
+from matrixstore.build.download_prescribing import (
+    download_prescribing_for_dates,
+    run_steps,
+)
+from matrixstore.build.import_prescribing import (
+    RUN_MAGIC_NUMBER,
+    parse_prescribing_csv,
+    read_run,
+    run_is_current,
+)
+from matrixstore.build.sort_prescribing import SORT_COLUMNS
+from matrixstore.csv_utils import dicts_to_csv
+from matrixstore.tests.data_factory import DataFactory
+
+
+class TestDownloadPrescribing(SimpleTestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        settings_override = override_settings(
+            MATRIXSTORE_IMPORT_DIR=self.tempdir, BQ_NONCE=None
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        factory = DataFactory()
+        months = factory.create_months("2019-01-01", 3)
+        practices = factory.create_practices(6)
+        presentations = factory.create_presentations(8)
+        factory.create_prescribing(presentations, practices, months)
+        self.dates = [month[:10] for month in months]
+        self.bucket = FakeBucket()
+        self.bq_client = FakeBigQueryClient(factory.prescribing, self.bucket)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def download(self, dates=None):
+        download_prescribing_for_dates(
+            dates or self.dates,
+            self.bq_client,
+            self.bucket,
+            concurrency={"extract": 2, "download": 2, "consolidate": 2},
+        )
+
+    def test_downloads_and_consolidates_each_date(self):
+        self.download()
+        for date in self.dates:
+            with self.subTest(date=date):
+                pd.testing.assert_frame_equal(
+                    read_prescribing_file(date), self.bq_client.expected_data(date)
+                )
+        self.assertEqual(sorted(self.bq_client.calls["extract"]), self.dates)
+        self.assertEqual(sorted(self.bq_client.calls["export"]), self.dates)
+        # Downloaded shards are deleted once consolidated
+        download_dir = os.path.join(self.tempdir, "temporary_downloads")
+        self.assertEqual(os.listdir(download_dir), [])
+
+    def test_skips_steps_which_have_already_happened(self):
+        # Fully download the last date, then delete the consolidated file so
+        # the data has to be downloaded again from storage
+        self.download(self.dates[2:])
+        os.unlink(get_prescribing_filename(self.dates[2]))
+        # Extract the second date
+        self.bq_client.extract(self.dates[1])
+        self.bq_client.calls = {"extract": [], "export": []}
+        self.download()
+        self.assertEqual(self.bq_client.calls["extract"], self.dates[:1])
+        self.assertEqual(sorted(self.bq_client.calls["export"]), self.dates[:2])
+        # Nothing more needs doing on subsequent runs
+        self.bq_client.calls = {"extract": [], "export": []}
+        self.bucket.downloads = []
+        self.download()
+        self.assertEqual(self.bq_client.calls, {"extract": [], "export": []})
+        self.assertEqual(self.bucket.downloads, [])
+
+    def test_downloads_again_if_file_format_is_outdated(self):
+        self.download(self.dates[2:])
+        filename = get_prescribing_filename(self.dates[2])
+        with open(filename, "r+b") as f:
+            f.seek(len(RUN_MAGIC_NUMBER))
+            f.write(b"\x00\x00")
+        self.bucket.downloads = []
+        self.download(self.dates[2:])
+        self.assertTrue(self.bucket.downloads)
+        self.assertTrue(run_is_current(filename))
+        pd.testing.assert_frame_equal(
+            read_prescribing_file(self.dates[2]),
+            self.bq_client.expected_data(self.dates[2]),
+        )
+
+    def test_can_resume_after_failure(self):
+        self.bq_client.fail_export_for = self.dates[1]
+        with self.assertRaises(RuntimeError):
+            self.download()
+        self.assertFalse(os.path.exists(get_prescribing_filename(self.dates[1])))
+        self.bq_client.fail_export_for = None
+        self.download()
+        for date in self.dates:
+            with self.subTest(date=date):
+                pd.testing.assert_frame_equal(
+                    read_prescribing_file(date), self.bq_client.expected_data(date)
+                )
+        # Each date only ever gets extracted once
+        self.assertEqual(sorted(self.bq_client.calls["extract"]), self.dates)
+
+
+class TestRunSteps(SimpleTestCase):
+    def test_runs_steps_for_each_date_in_order(self):
+        log = []
+        lock = threading.Lock()
+
+        def step(date, n):
+            with lock:
+                log.append((date, n))
+
+        steps_for_dates = {
+            date: [("a", step, (date, 1)), ("b", step, (date, 2))]
+            for date in ["2019-01-01", "2019-02-01", "2019-03-01"]
+        }
+        with ThreadPoolExecutor(2) as a, ThreadPoolExecutor(1) as b:
+            run_steps(steps_for_dates, {"a": a, "b": b})
+        self.assertEqual(len(log), 6)
+        for date in steps_for_dates:
+            self.assertEqual([n for d, n in log if d == date], [1, 2])
+
+    def test_stops_after_failure(self):
+        log = []
+
+        def fail():
+            raise ValueError()
+
+        steps_for_dates = {
+            "2019-01-01": [("a", fail, ()), ("a", log.append, ("unreachable",))]
+        }
+        with ThreadPoolExecutor(1) as a:
+            with self.assertRaises(ValueError):
+                run_steps(steps_for_dates, {"a": a})
+        self.assertEqual(log, [])
+
+
+def read_prescribing_file(date):
+    return pd.concat(read_run(get_prescribing_filename(date)), ignore_index=True)
+
+
+class FakeBigQueryClient:
+    """
+    Implements just enough of `gcutils.bigquery.Client` for
+    `download_prescribing`, with exports written to a `FakeBucket`
+    """
+
+    def __init__(self, prescribing, bucket):
+        self.prescribing = prescribing
+        self.bucket = bucket
+        self.tables = {}
+        self.fail_export_for = None
+        self.calls = {"extract": [], "export": []}
+
+    def list_tables(self):
+        return [FakeTable(self, table_id) for table_id in self.tables]
+
+    def get_table(self, table_id):
+        return FakeTable(self, table_id)
+
+    def query(self, sql):
+        date = re.search(r'TIMESTAMP\("(.+?)"\)', sql).group(1)
+        return FakeResults([[len(self.rows_for_date(date))]])
+
+    def rows_for_date(self, date):
+        return [p for p in self.prescribing if p["month"][:10] == date]
+
+    def expected_data(self, date):
+        rows = "".join(dicts_to_csv(self.rows_for_date(date)))
+        df = pd.concat(parse_prescribing_csv(io.StringIO(rows)))
+        return df.sort_values(SORT_COLUMNS, ignore_index=True)
+
+    def extract(self, date):
+        table_id = "prescribing_{}".format(date[:7].replace("-", "_"))
+        self.get_table(table_id).insert_rows_from_query(
+            "", substitutions={"month": date}
+        )
+
+
+class FakeTable:
+    def __init__(self, client, table_id):
+        self.client = client
+        self.table_id = table_id
+
+    def insert_rows_from_query(self, sql, substitutions):
+        date = substitutions["month"]
+        self.client.calls["extract"].append(date)
+        self.client.tables[self.table_id] = self.client.rows_for_date(date)
+
+    def export_to_storage(self, storage_prefix):
+        rows = self.client.tables[self.table_id]
+        date = rows[0]["month"][:10]
+        self.client.calls["export"].append(date)
+        if date == self.client.fail_export_for:
+            raise RuntimeError("Export failed")
+        # Split the data between multiple unsorted shards, as BigQuery does
+        for n in range(3):
+            name = "{}{:012d}.csv.gz".format(storage_prefix, n)
+            contents = "".join(dicts_to_csv(rows[n::3]))
+            self.client.bucket.blob(name).upload_from_string(
+                gzip.compress(contents.encode("utf8"))
+            )
+
+
+class FakeResults:
+    def __init__(self, rows):
+        self.rows = rows
+
+
+class FakeBucket:
+    """
+    Implements just enough of a `google.cloud.storage.Bucket` for
+    `download_prescribing`
+    """
+
+    name = "fake-bucket"
+
+    def __init__(self):
+        self.blobs = {}
+        self.downloads = []
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+    def list_blobs(self, prefix):
+        return [self.blob(name) for name in self.blobs if name.startswith(prefix)]
+
+
+class FakeBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+
+    def exists(self):
+        return self.name in self.bucket.blobs
+
+    def upload_from_string(self, contents):
+        self.bucket.blobs[self.name] = contents
+
+    def download_to_filename(self, filename):
+        self.bucket.downloads.append(self.name)
+        contents = self.bucket.blobs[self.name]
+        if isinstance(contents, str):
+            contents = contents.encode("utf8")
+        with open(filename, "wb") as f:
+            f.write(contents)
@@ -0,0 +1,120 @@
+import csv
+import io
+import json
+
+import numpy
+from django.test import SimpleTestCase
+from matrixstore.build.import_practice_stats import (
+    MissingHeaderError,
+    build_matrices,
+    parse_practice_statistics_csv,
+)
+from matrixstore.csv_utils import dicts_to_csv
+from matrixstore.matrix_ops import finalise_matrix, sparse_matrix
+from matrixstore.serializer import serialize_compressed
+from matrixstore.tests.data_factory import DataFactory
+
+
+class TestImportPracticeStats(SimpleTestCase):
+    def setUp(self):
+        factory = DataFactory()
+        months = factory.create_months("2019-01-01", 3)
+        practices = factory.create_practices(5)
+        factory.create_practice_statistics(practices, months)
+        statistics = factory.practice_statistics
+        # Zero values, which aren't stored
+        statistics[0]["astro_pu_cost"] = 0.0
+        statistics[1]["male_0_4"] = 0
+        # A practice code with trailing spaces
+        statistics[2]["practice"] += " "
+        # A practice we don't know about, which should be ignored
+        statistics.append(dict(statistics[3], practice="XYZ999"))
+        # A duplicated entry, of which only the last should be kept
+        statistics.append(dict(statistics[4], total_list_size=123456))
+        # A STAR-PU value which only appears for some practices
+        star_pu = json.loads(statistics[5]["star_pu"])
+        star_pu["antibacterials_cost"] = 7.5
+        statistics[5]["star_pu"] = json.dumps(star_pu)
+        # An integer STAR-PU value which only appears for some practices
+        for row in statistics[6:9]:
+            star_pu = json.loads(row["star_pu"])
+            star_pu["statins_items"] = 7
+            row["star_pu"] = json.dumps(star_pu)
+        self.csv = "".join(dicts_to_csv(statistics))
+        self.practices = {p["code"]: i for i, p in enumerate(practices[:4])}
+        self.dates = {month[:10]: i for i, month in enumerate(months)}
+
+    def test_matches_legacy_implementation(self):
+        legacy_matrices = legacy_build_matrices(
+            legacy_parse_practice_statistics_csv(io.StringIO(self.csv)),
+            self.practices,
+            self.dates,
+        )
+        expected = serialize(legacy_matrices)
+        self.assertIn("star_pu.antibacterials_cost", [name for name, _ in expected])
+        for chunk_size in [1, 7, 1000]:
+            with self.subTest(chunk_size=chunk_size):
+                statistics = parse_practice_statistics_csv(
+                    io.StringIO(self.csv), chunk_size=chunk_size
+                )
+                matrices = build_matrices(statistics, self.practices, self.dates)
+                self.assertEqual(serialize(matrices), expected)
+
+    def test_sparse_integer_statistic_keeps_integer_type(self):
+        statistics = parse_practice_statistics_csv(io.StringIO(self.csv), chunk_size=7)
+        matrices = dict(build_matrices(statistics, self.practices, self.dates))
+        self.assertEqual(matrices["star_pu.statins_items"].dtype, numpy.uint8)
+        self.assertEqual(matrices["star_pu.antibacterials_cost"].dtype, numpy.float64)
+
+    def test_missing_header(self):
+        with self.assertRaises(MissingHeaderError):
+            list(parse_practice_statistics_csv(io.StringIO("month,practice\nA,B\n")))
+
+
+def serialize(matrices):
+    return [(name, serialize_compressed(matrix)) for name, matrix in matrices]
+
+
+def legacy_parse_practice_statistics_csv(input_stream):
+    """
+    The original row-by-row CSV parser
+    """
+    reader = csv.reader(input_stream)
+    headers = next(reader)
+    date_col = headers.index("month")
+    practice_col = headers.index("practice")
+    star_pu_col = headers.index("star_pu")
+    other_headers = [
+        (i, header)
+        for (i, header) in enumerate(headers)
+        if i not in (date_col, practice_col, star_pu_col) and header != "pct_id"
+    ]
+    for row in reader:
+        date = row[date_col][:10]
+        practice = row[practice_col].strip()
+        for i, statistic_name in other_headers:
+            value_str = row[i]
+            value = float(value_str) if "." in value_str else int(value_str)
+            yield statistic_name, practice, date, value
+        star_pu = json.loads(row[star_pu_col])
+        for star_pu_name, value in star_pu.items():
+            yield "star_pu." + star_pu_name, practice, date, value
+
+
+def legacy_build_matrices(practice_statistics, practices, dates):
+    """
+    The original implementation of `build_matrices` which assigned values one
+    at a time to LIL matrices
+    """
+    shape = (max(practices.values()) + 1, max(dates.values()) + 1)
+    matrices = {}
+    for statistic_name, practice, date, value in practice_statistics:
+        if practice not in practices:
+            continue
+        if statistic_name not in matrices:
+            matrices[statistic_name] = sparse_matrix(
+                shape, integer=isinstance(value, int)
+            )
+        matrices[statistic_name][practices[practice], dates[date]] = value
+    for statistic_name, matrix in sorted(matrices.items()):
+        yield statistic_name, finalise_matrix(matrix)
@@ -0,0 +1,186 @@
+import csv
+import heapq
+import io
+import os
+import shutil
+import tempfile
+from itertools import groupby
+
+import pandas as pd
+from django.test import SimpleTestCase
+from matrixstore.build.import_prescribing import (
+    RUN_MAGIC_NUMBER,
+    MissingHeaderError,
+    OutdatedRunError,
+    build_matrices,
+    merge_by_bnf_code,
+    parse_prescribing_csv,
+    read_run,
+    run_is_current,
+    write_run,
+)
+from matrixstore.csv_utils import dicts_to_csv
+from matrixstore.matrix_ops import finalise_matrix, sparse_matrix
+from matrixstore.serializer import serialize_compressed
+from matrixstore.tests.data_factory import DataFactory
+
+
+class TestImportPrescribing(SimpleTestCase):
+    def setUp(self):
+        factory = DataFactory()
+        months = factory.create_months("2019-01-01", 3)
+        practices = factory.create_practices(5)
+        presentations = factory.create_presentations(6)
+        factory.create_prescribing(presentations, practices, months)
+        prescriptions = factory.prescribing
+        # Values which need rounding when converted to pence
+        prescriptions[0]["net_cost"] = 0.125
+        prescriptions[1]["actual_cost"] = 2.675
+        # Zero values, which aren't stored
+        prescriptions[2]["items"] = 0
+        prescriptions[2]["quantity"] = 0.0
+        # A duplicated prescription, of which only one should be kept
+        prescriptions.append(dict(prescriptions[3], items=1000))
+        prescriptions.append(dict(prescriptions[4], items=1000, net_cost=0))
+        # BNF codes sometimes have trailing spaces in the CSV
+        for prescription in prescriptions:
+            if prescription["bnf_code"] == presentations[1]["bnf_code"]:
+                prescription["bnf_code"] += " "
+        self.csv_files = []
+        for month in months:
+            rows = [p for p in prescriptions if p["month"] == month]
+            rows.sort(key=lambda p: (p["bnf_code"], p["practice"], p["month"]))
+            self.csv_files.append("".join(dicts_to_csv(rows)))
+        self.practices = {p["code"]: i for i, p in enumerate(practices)}
+        self.dates = {month[:10]: i for i, month in enumerate(months)}
+
+    def test_matches_legacy_implementation(self):
+        for chunk_size in [1, 7, 1000]:
+            with self.subTest(chunk_size=chunk_size):
+                streams = [
+                    parse_prescribing_csv(io.StringIO(f), chunk_size=chunk_size)
+                    for f in self.csv_files
+                ]
+                matrices = build_matrices(
+                    merge_by_bnf_code(streams), self.practices, self.dates
+                )
+                legacy_streams = [
+                    legacy_parse_prescribing_csv(io.StringIO(f)) for f in self.csv_files
+                ]
+                legacy_matrices = legacy_build_matrices(
+                    heapq.merge(*legacy_streams), self.practices, self.dates
+                )
+                self.assertEqual(serialize(matrices), serialize(legacy_matrices))
+
+    def test_merge_by_bnf_code_keeps_bnf_codes_together(self):
+        streams = [
+            parse_prescribing_csv(io.StringIO(f), chunk_size=2) for f in self.csv_files
+        ]
+        seen = set()
+        for prescribing in merge_by_bnf_code(streams):
+            bnf_codes = set(prescribing["bnf_code"])
+            self.assertFalse(bnf_codes & seen)
+            seen.update(bnf_codes)
+
+    def test_missing_header(self):
+        with self.assertRaises(MissingHeaderError):
+            list(parse_prescribing_csv(io.StringIO("bnf_code,practice\nA,B\n")))
+
+
+class TestRunFiles(SimpleTestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.filename = os.path.join(self.tempdir, "prescribing.run")
+        factory = DataFactory()
+        months = factory.create_months("2019-01-01", 2)
+        practices = factory.create_practices(3)
+        presentations = factory.create_presentations(4)
+        factory.create_prescribing(presentations, practices, months)
+        self.csv = "".join(dicts_to_csv(factory.prescribing))
+
+    def test_round_trip(self):
+        chunks = list(parse_prescribing_csv(io.StringIO(self.csv), chunk_size=5))
+        write_run(self.filename, chunks)
+        self.assertTrue(run_is_current(self.filename))
+        result = list(read_run(self.filename))
+        self.assertEqual(len(result), len(chunks))
+        for chunk, expected in zip(result, chunks):
+            pd.testing.assert_frame_equal(chunk, expected.reset_index(drop=True))
+
+    def test_round_trip_empty(self):
+        write_run(self.filename, [])
+        self.assertEqual(list(read_run(self.filename)), [])
+
+    def test_other_format_versions_are_outdated(self):
+        # This is how files written by the previous version begin: the magic
+        # number followed directly by the length of the first chunk
+        with open(self.filename, "wb") as f:
+            f.write(RUN_MAGIC_NUMBER + (1234).to_bytes(8, "little"))
+        self.assertFalse(run_is_current(self.filename))
+        with self.assertRaises(OutdatedRunError):
+            list(read_run(self.filename))
+
+
+def serialize(matrices):
+    return [(row[0], [serialize_compressed(m) for m in row[1:]]) for row in matrices]
+
+
+def legacy_parse_prescribing_csv(input_stream):
+    """
+    The original row-by-row CSV parser
+    """
+    reader = csv.reader(input_stream)
+    headers = next(reader)
+    columns = [
+        headers.index(name)
+        for name in [
+            "bnf_code",
+            "practice",
+            "month",
+            "items",
+            "quantity",
+            "actual_cost",
+            "net_cost",
+        ]
+    ]
+    for row in reader:
+        bnf_code, practice, date, items, quantity, actual_cost, net_cost = [
+            row[i] for i in columns
+        ]
+        yield (
+            bnf_code.strip(),
+            practice.strip(),
+            date[:10],
+            int(items),
+            float(quantity),
+            int(round(float(actual_cost) * 100)),
+            int(round(float(net_cost) * 100)),
+        )
+
+
+def legacy_build_matrices(prescriptions, practices, dates):
+    """
+    The original implementation of `build_matrices` which assigned values one
+    at a time to LIL matrices
+    """
+    shape = (max(practices.values()) + 1, max(dates.values()) + 1)
+    for bnf_code, row_group in groupby(prescriptions, lambda row: row[0]):
+        items_matrix = sparse_matrix(shape, integer=True)
+        quantity_matrix = sparse_matrix(shape, integer=False)
+        actual_cost_matrix = sparse_matrix(shape, integer=True)
+        net_cost_matrix = sparse_matrix(shape, integer=True)
+        for _, practice, date, items, quantity, actual_cost, net_cost in row_group:
+            practice_offset = practices[practice]
+            date_offset = dates[date]
+            items_matrix[practice_offset, date_offset] = items
+            quantity_matrix[practice_offset, date_offset] = quantity
+            actual_cost_matrix[practice_offset, date_offset] = actual_cost
+            net_cost_matrix[practice_offset, date_offset] = net_cost
+        yield (
+            bnf_code,
+            finalise_matrix(items_matrix),
+            finalise_matrix(quantity_matrix),
+            finalise_matrix(actual_cost_matrix),
+            finalise_matrix(net_cost_matrix),
+        )
@@ -0,0 +1,132 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+
+from django.test import SimpleTestCase
+from matrixstore.build.build_hot_storage import build_hot_storage_for_db
+from matrixstore.build.chunk_presentations_by_date import (
+    chunk_presentations_by_date_for_db,
+)
+from matrixstore.build.import_prescribing_incremental import (
+    get_dates_missing_from_previous_for_db,
+    get_storage_options,
+    merge_bnf_codes,
+)
+from matrixstore.hot_storage import get_hot_storage_path
+from matrixstore.tests.data_factory import DataFactory
+from matrixstore.tests.import_test_data_fast import import_test_data_fast
+
+
+class TestImportPrescribingIncremental(SimpleTestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        factory = DataFactory()
+        months = factory.create_months("2019-01-01", 4)
+        practices = factory.create_practices(6)
+        presentations = factory.create_presentations(8)
+        factory.create_prescribing(presentations[:6], practices[:4], months[:3])
+        factory.create_prescribing(presentations[1:], practices[1:], months[3:])
+        factory.create_practice_statistics(practices, months)
+        # Add a presentation and a practice which only appear in the month
+        # which gets dropped
+        factory.create_prescribing(
+            factory.create_presentations(1), factory.create_practices(1), months[:1]
+        )
+        # Add a BNF code change to check this gets applied to the new month
+        factory.update_bnf_code(presentations[2])
+        self.factory = factory
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def build_file(self, name, end_date, previous_filename=None):
+        path = os.path.join(self.tempdir, name)
+        connection = sqlite3.connect(path)
+        import_test_data_fast(
+            connection,
+            self.factory,
+            end_date,
+            months=3,
+            previous_filename=previous_filename,
+        )
+        return path, connection
+
+    def test_matches_full_build(self):
+        previous_path, connection = self.build_file("previous.sqlite", "2019-03")
+        connection.close()
+        _, expected = self.build_file("full.sqlite", "2019-04")
+        _, incremental = self.build_file("new.sqlite", "2019-04", previous_path)
+        self.assertDatabasesEqual(incremental, expected)
+
+    def test_matches_full_build_from_chunked_file(self):
+        previous_path, connection = self.build_file("previous.sqlite", "2019-03")
+        connection.isolation_level = None
+        chunk_presentations_by_date_for_db(connection, 2)
+        connection.close()
+        _, expected = self.build_file("full.sqlite", "2019-04")
+        _, incremental = self.build_file("new.sqlite", "2019-04", previous_path)
+        self.assertDatabasesEqual(incremental, expected)
+
+    def test_matches_full_build_when_practice_dropped(self):
+        previous_path, connection = self.build_file("previous.sqlite", "2019-03")
+        connection.close()
+        # Remove all data for a practice which has prescribing in the retained
+        # months, as if the data had been revised since the previous build
+        practice = self.factory.practices[0]["code"]
+        self.factory.prescribing = [
+            p for p in self.factory.prescribing if p["practice"] != practice
+        ]
+        self.factory.practice_statistics = [
+            p for p in self.factory.practice_statistics if p["practice"] != practice
+        ]
+        _, expected = self.build_file("full.sqlite", "2019-04")
+        with self.assertLogs(
+            "matrixstore.build.import_prescribing_incremental", "WARNING"
+        ) as logs:
+            _, incremental = self.build_file("new.sqlite", "2019-04", previous_path)
+        self.assertIn(practice, logs.output[0])
+        self.assertDatabasesEqual(incremental, expected)
+
+    def test_get_storage_options(self):
+        previous_path, connection = self.build_file("previous.sqlite", "2019-03")
+        self.assertEqual(
+            get_storage_options(previous_path),
+            {"months_per_chunk": None, "hot_presentations": None},
+        )
+        connection.isolation_level = None
+        chunk_presentations_by_date_for_db(connection, 2)
+        build_hot_storage_for_db(
+            connection, get_hot_storage_path(previous_path), num_presentations=3
+        )
+        connection.close()
+        self.assertEqual(
+            get_storage_options(previous_path),
+            {"months_per_chunk": 2, "hot_presentations": 3},
+        )
+
+    def test_previous_file_must_cover_start_of_range(self):
+        previous_path, connection = self.build_file("previous.sqlite", "2019-04")
+        connection.close()
+        _, connection = self.build_file("full.sqlite", "2019-03")
+        with self.assertRaises(RuntimeError):
+            get_dates_missing_from_previous_for_db(connection, previous_path)
+
+    def assertDatabasesEqual(self, connection, expected_connection):
+        for table in ["practice", "date", "presentation", "all_presentations"]:
+            sql = "SELECT * FROM {} ORDER BY 1".format(table)
+            with self.subTest(table=table):
+                self.assertEqual(
+                    list(connection.execute(sql)),
+                    list(expected_connection.execute(sql)),
+                )
+
+
+class TestMergeBNFCodes(SimpleTestCase):
+    def test_merge_bnf_codes(self):
+        previous_bnf_codes = ["a", "c", "d", "f"]
+        new_entries = [("b", 1), ("c", 2), ("e", 3)]
+        self.assertEqual(
+            list(merge_bnf_codes(previous_bnf_codes, new_entries)),
+            [("a", None), ("b", 1), ("c", 2), ("d", None), ("e", 3), ("f", None)],
+        )
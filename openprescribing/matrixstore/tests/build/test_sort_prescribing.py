@@ -0,0 +1,63 @@
+import gzip
+import os
+import shutil
+import tempfile
+
+import pandas as pd
+from django.test import SimpleTestCase
+from matrixstore.build.import_prescribing import parse_prescribing_csv, read_run
+from matrixstore.build.sort_prescribing import sort_and_merge_prescribing_files
+from matrixstore.csv_utils import dicts_to_csv
+from matrixstore.tests.data_factory import DataFactory
+
+
+class TestSortPrescribing(SimpleTestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        factory = DataFactory()
+        months = factory.create_months("2019-01-01", 1)
+        practices = factory.create_practices(8)
+        presentations = factory.create_presentations(12)
+        factory.create_prescribing(presentations, practices, months)
+        prescriptions = factory.prescribing
+        # `sort` used to get confused by quoted commas
+        for prescription in prescriptions:
+            prescription["bnf_name"] = "Foo, Tablet"
+        factory.random.shuffle(prescriptions)
+        # Split the data into unsorted shards, some compressed and some not
+        self.input_files = []
+        for n in range(4):
+            shard = "".join(dicts_to_csv(prescriptions[n::4]))
+            if n % 2:
+                filename = os.path.join(self.tempdir, "shard_{}.csv.gz".format(n))
+                with gzip.open(filename, "wt") as f:
+                    f.write(shard)
+            else:
+                filename = os.path.join(self.tempdir, "shard_{}.csv".format(n))
+                with open(filename, "w") as f:
+                    f.write(shard)
+            self.input_files.append(filename)
+        self.output_file = os.path.join(self.tempdir, "output.run")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_sort_and_merge(self):
+        sort_and_merge_prescribing_files(
+            self.input_files, self.output_file, processes=2, run_size=5
+        )
+        result = pd.concat(read_run(self.output_file), ignore_index=True)
+        expected = (
+            pd.concat(
+                [df for f in self.input_files for df in parse_prescribing_csv(f)],
+                ignore_index=True,
+            )
+            .sort_values(["bnf_code", "practice", "date"])
+            .reset_index(drop=True)
+        )
+        pd.testing.assert_frame_equal(result, expected)
+        # Temporary run files should have been cleaned up
+        self.assertEqual(
+            sorted(os.listdir(self.tempdir)),
+            sorted([os.path.basename(f) for f in self.input_files] + ["output.run"]),
+        )
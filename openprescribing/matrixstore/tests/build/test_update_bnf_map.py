@@ -0,0 +1,112 @@
+import sqlite3
+
+import numpy
+from django.test import SimpleTestCase
+from matrixstore.build.init_db import SCHEMA_SQL
+from matrixstore.build.update_bnf_map import (
+    format_values_for_sqlite,
+    resolve_bnf_map,
+    sum_rows,
+    update_bnf_map_for_db,
+)
+from matrixstore.matrix_ops import finalise_matrix, sparse_matrix
+from matrixstore.serializer import deserialize
+
+SHAPE = (4, 3)
+
+
+class TestUpdateBNFMap(SimpleTestCase):
+    def setUp(self):
+        self.connection = sqlite3.connect(":memory:")
+        self.connection.isolation_level = None
+        self.connection.executescript(SCHEMA_SQL)
+        self.random = numpy.random.RandomState(0)
+        for code in ["A", "B", "C", "D", "E", "F"]:
+            self.add_presentation(code)
+        # A presentation with no prescribing, which should be deleted
+        self.connection.execute("INSERT INTO presentation (bnf_code) VALUES ('Z')")
+
+    def add_presentation(self, bnf_code):
+        values = []
+        for integer in [True, False, True, True]:
+            matrix = sparse_matrix(SHAPE, integer=integer)
+            matrix[self.random.randint(SHAPE[0]), self.random.randint(SHAPE[1])] = (
+                self.random.randint(1, 100)
+            )
+            values.append(finalise_matrix(matrix))
+        self.connection.execute(
+            "INSERT INTO presentation VALUES (?, ?, ?, ?, ?)",
+            [bnf_code] + format_values_for_sqlite(values),
+        )
+
+    def get_values(self):
+        return {
+            bnf_code: [deserialize(value) for value in row]
+            for bnf_code, *row in self.connection.execute(
+                "SELECT * FROM presentation WHERE items IS NOT NULL"
+            )
+        }
+
+    def assertValuesEqual(self, values, expected):
+        self.assertEqual(sorted(values), sorted(expected))
+        for bnf_code in values:
+            for matrix, expected_matrix in zip(values[bnf_code], expected[bnf_code]):
+                self.assertEqual((matrix != expected_matrix).sum(), 0)
+
+    def test_moves_and_merges_values(self):
+        original = self.get_values()
+        update_bnf_map_for_db(
+            self.connection,
+            # "X" and "Y" have no existing data and there's no data under "W"
+            [("A", "X"), ("B", "C"), ("D", "Y"), ("E", "Y"), ("W", "F")],
+            processes=1,
+        )
+        self.assertValuesEqual(
+            self.get_values(),
+            {
+                "X": original["A"],
+                "C": sum_rows([original["C"], original["B"]]),
+                "Y": sum_rows([original["D"], original["E"]]),
+                "F": original["F"],
+            },
+        )
+        # Presentations with no prescribing are deleted
+        self.assertEqual(
+            list(
+                self.connection.execute("SELECT * FROM presentation WHERE bnf_code='Z'")
+            ),
+            [],
+        )
+
+    def test_follows_chains_of_updates(self):
+        original = self.get_values()
+        update_bnf_map_for_db(
+            self.connection, [("B", "C"), ("A", "B"), ("C", "D")], processes=2
+        )
+        self.assertValuesEqual(
+            self.get_values(),
+            {
+                "D": sum_rows([original[code] for code in "DBAC"]),
+                "E": original["E"],
+                "F": original["F"],
+            },
+        )
+
+
+class TestResolveBNFMap(SimpleTestCase):
+    def test_resolve_bnf_map(self):
+        self.assertEqual(
+            resolve_bnf_map(
+                [("A", "B"), ("B", "C"), ("D", "D"), ("E", "F"), ("E", "G")]
+            ),
+            {"A": "C", "B": "C", "E": "F"},
+        )
+
+    def test_codes_leading_into_cycles_are_skipped(self):
+        with self.assertLogs("matrixstore.build.update_bnf_map", "WARNING") as logs:
+            current_codes = resolve_bnf_map(
+                [("A", "B"), ("B", "C"), ("C", "A"), ("D", "A"), ("E", "F")]
+            )
+        self.assertEqual(current_codes, {"E": "F"})
+        self.assertEqual(len(logs.output), 4)
+        self.assertIn("D -> A -> B -> C -> A", logs.output[3])
@@ -0,0 +1,31 @@
+import json
+import os
+import tempfile
+
+from django.core.management import call_command
+from django.test import SimpleTestCase
+from matrixstore.tests.benchmarks import BENCHMARKS
+
+
+class TestMatrixStoreBenchmark(SimpleTestCase):
+    def test_outputs_results_as_json(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            output = os.path.join(tempdir, "results.json")
+            call_command(
+                "matrixstore_benchmark",
+                practices=20,
+                months=3,
+                presentations=12,
+                repeat=2,
+                output=output,
+            )
+            with open(output) as f:
+                results = json.load(f)
+        self.assertEqual(
+            results["metadata"]["fixture"],
+            {"practices": 20, "months": 3, "presentations": 12, "seed": 1},
+        )
+        self.assertEqual(set(results["benchmarks"]), set(BENCHMARKS))
+        for result in results["benchmarks"].values():
+            self.assertEqual(len(result["times"]), 2)
+            self.assertEqual(result["min"], min(result["times"]))
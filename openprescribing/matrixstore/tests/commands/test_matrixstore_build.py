@@ -233,6 +233,35 @@ class TestMatrixStoreBuild(SimpleTestCase):
             # Check there are no additional values that we weren't expecting
             self.assertEqual(get_value.nonzero_values, len(totals))
 
+    def test_bnf_prefix_totals(self):
+        bnf_codes = [
+            row[0]
+            for row in self.connection.execute("SELECT bnf_code FROM presentation")
+        ]
+        prefixes = [
+            row[0]
+            for row in self.connection.execute("SELECT prefix FROM bnf_prefix_totals")
+        ]
+        # Every precalculated prefix should match more than one presentation
+        for prefix in prefixes:
+            matches = [code for code in bnf_codes if code.startswith(prefix)]
+            self.assertGreater(len(matches), 1)
+        for field in ["items", "quantity", "net_cost", "actual_cost"]:
+            totals = MatrixValueFetcher(
+                self.connection, "bnf_prefix_totals", "prefix", field
+            )
+            values = MatrixValueFetcher(
+                self.connection, "presentation", "bnf_code", field
+            )
+            for prefix in prefixes:
+                expected = sum(
+                    to_float_array(values.matrices[code])
+                    for code in bnf_codes
+                    if code.startswith(prefix)
+                )
+                total = to_float_array(totals.matrices[prefix])
+                numpy.testing.assert_allclose(total, expected)
+
 
 class TestMatrixStoreBuildEndToEnd(TestMatrixStoreBuild):
     """
@@ -326,3 +355,13 @@ def sum_dicts(current_values, new_values):
             continue
         zero = type(value)()
         current_values[field] = current_values.get(field, zero) + value
+
+
+def to_float_array(matrix):
+    """
+    Convert a sparse or dense matrix of any type into a float ndarray so we can
+    sum them without worrying about integer overflow
+    """
+    if hasattr(matrix, "toarray"):
+        matrix = matrix.toarray()
+    return matrix.astype(numpy.float64)
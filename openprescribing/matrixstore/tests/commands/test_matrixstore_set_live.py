@@ -25,6 +25,8 @@ class TestMatrixStoreSetLive(SimpleTestCase):
         for name in cls.files.values():
             path = os.path.join(cls.tempdir, name)
             open(path, "w").close()
+        # Hot storage sidecar files should never be selected
+        open(os.path.join(cls.tempdir, cls.files["latest_jun"] + ".hot"), "w").close()
 
     def test_updates_to_latest_with_no_args(self):
         self.call_command()
@@ -1,26 +1,38 @@
+import io
+
 from matrixstore.build.import_practice_stats import (
     parse_practice_statistics_csv,
     write_practice_stats,
 )
 from matrixstore.build.import_prescribing import (
+    merge_by_bnf_code,
     parse_prescribing_csv,
     write_prescribing,
 )
+from matrixstore.build.import_prescribing_incremental import (
+    get_dates_missing_from_previous_for_db,
+    write_prescribing_incremental,
+)
 from matrixstore.build.init_db import SCHEMA_SQL, generate_dates, import_dates
-from matrixstore.build.precalculate_totals import precalculate_totals_for_db
-from matrixstore.build.update_bnf_map import (
-    delete_presentations_with_no_prescribing,
-    move_values_from_old_code_to_new,
+from matrixstore.build.precalculate_bnf_prefix_totals import (
+    precalculate_bnf_prefix_totals_for_db,
 )
+from matrixstore.build.precalculate_totals import precalculate_totals_for_db
+from matrixstore.build.update_bnf_map import update_bnf_map_for_db
 from matrixstore.csv_utils import dicts_to_csv
 
 
-def import_test_data_fast(sqlite_conn, data_factory, end_date, months=None):
+def import_test_data_fast(
+    sqlite_conn, data_factory, end_date, months=None, previous_filename=None
+):
     """
     Imports the data in `data_factory` into the supplied SQLite connection
     without touching any external services such as BigQuery or Google Cloud
     Storage (and indeed without touching disk, if the SQLite database is in
     memory).
+
+    If `previous_filename` is supplied then prescribing data is imported
+    incrementally, reusing the data in that file for any months it covers.
     """
     dates = generate_dates(end_date, months=months)
 
@@ -31,9 +43,15 @@ def import_test_data_fast(sqlite_conn, data_factory, end_date, months=None):
 
     init_db(sqlite_conn, data_factory, dates)
     import_practice_stats(sqlite_conn, data_factory, dates)
-    import_prescribing(sqlite_conn, data_factory, dates)
+    if previous_filename:
+        import_prescribing_incremental(
+            sqlite_conn, data_factory, dates, previous_filename
+        )
+    else:
+        import_prescribing(sqlite_conn, data_factory, dates)
     update_bnf_map(sqlite_conn, data_factory)
     precalculate_totals_for_db(sqlite_conn)
+    precalculate_bnf_prefix_totals_for_db(sqlite_conn)
 
     sqlite_conn.isolation_level = previous_isolation_level
     sqlite_conn.commit()
@@ -52,32 +70,46 @@ def import_practice_stats(sqlite_conn, data_factory, dates):
     filtered_practice_stats = _filter_by_date(data_factory.practice_statistics, dates)
     filtered_practice_stats = list(filtered_practice_stats)
     if filtered_practice_stats:
-        practice_statistics_csv = dicts_to_csv(filtered_practice_stats)
+        practice_statistics_csv = "".join(dicts_to_csv(filtered_practice_stats))
         # This blows up if we give it an empty CSV because it can't find the
         # headers it expects
-        practice_statistics = parse_practice_statistics_csv(practice_statistics_csv)
+        practice_statistics = parse_practice_statistics_csv(
+            io.StringIO(practice_statistics_csv)
+        )
     else:
         practice_statistics = []
     write_practice_stats(sqlite_conn, practice_statistics)
 
 
 def import_prescribing(sqlite_conn, data_factory, dates):
+    write_prescribing(sqlite_conn, _get_prescribing(data_factory, dates))
+
+
+def import_prescribing_incremental(sqlite_conn, data_factory, dates, previous_filename):
+    new_dates = get_dates_missing_from_previous_for_db(sqlite_conn, previous_filename)
+    write_prescribing_incremental(
+        sqlite_conn,
+        previous_filename,
+        _get_prescribing(data_factory, new_dates),
+        processes=2,
+    )
+
+
+def _get_prescribing(data_factory, dates):
     filtered_prescribing = _filter_by_date(data_factory.prescribing, dates)
     sorted_prescribing = sorted(
         filtered_prescribing, key=lambda p: (p["bnf_code"], p["practice"], p["month"])
     )
-    prescribing_csv = dicts_to_csv(sorted_prescribing)
-    prescribing = parse_prescribing_csv(prescribing_csv)
-    write_prescribing(sqlite_conn, prescribing)
+    prescribing_csv = io.StringIO("".join(dicts_to_csv(sorted_prescribing)))
+    return merge_by_bnf_code([parse_prescribing_csv(prescribing_csv)])
 
 
 def update_bnf_map(sqlite_conn, data_factory):
-    cursor = sqlite_conn.cursor()
-    for item in data_factory.bnf_map:
-        move_values_from_old_code_to_new(
-            cursor, item["former_bnf_code"], item["current_bnf_code"]
-        )
-    delete_presentations_with_no_prescribing(cursor)
+    bnf_map = [
+        (item["former_bnf_code"], item["current_bnf_code"])
+        for item in data_factory.bnf_map
+    ]
+    update_bnf_map_for_db(sqlite_conn, bnf_map, processes=1)
 
 
 def _get_active_practice_codes(data_factory, dates):
@@ -0,0 +1,100 @@
+import numpy
+from django.test import SimpleTestCase
+from matrixstore.bnf_prefix_totals import (
+    get_query_plan,
+    get_totals_for_bnf_code_prefixes,
+    remove_redundant_prefixes,
+)
+from matrixstore.tests.data_factory import DataFactory
+from matrixstore.tests.matrixstore_factory import matrixstore_from_data_factory
+
+
+class TestBNFPrefixTotals(SimpleTestCase):
+    bnf_codes = [
+        "0202010B0AAABAB",
+        "0202010B0AAACAC",
+        "0202010D0AAAAAA",
+        "0202020L0AAAAAA",
+        "0204000H0AAAAAA",
+        "0212000B0AAABAB",
+        "0212000B0BBABAB",
+        "0301011R0AAAPAP",
+    ]
+
+    @classmethod
+    def setUpClass(cls):
+        factory = DataFactory()
+        months = factory.create_months("2019-01-01", 3)
+        practices = factory.create_practices(4)
+        presentations = [factory.create_presentation(code) for code in cls.bnf_codes]
+        factory.create_prescribing(presentations, practices, months)
+        cls.matrixstore = matrixstore_from_data_factory(factory)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.matrixstore.close()
+
+    def test_only_prefixes_with_multiple_presentations_are_precalculated(self):
+        self.assertEqual(
+            self.matrixstore.precalculated_bnf_prefixes,
+            {"02", "0202", "020201", "0202010", "0202010B0", "0212", "021200"}
+            | {"0212000", "0212000B0"},
+        )
+
+    def test_totals_match_summing_presentations(self):
+        test_cases = [
+            ["02"],
+            ["0202"],
+            ["0202010B0"],
+            ["0202010B0AAABAB"],
+            ["03"],
+            ["021"],
+            ["0", "0212000B0"],
+            ["02", "0202", "0301"],
+            ["0202010", "0212", "0301011R0"],
+            ["0202010B0AAA"],
+            ["99"],
+        ]
+        fields = ["items", "quantity", "actual_cost", "net_cost"]
+        for prefixes in test_cases:
+            with self.subTest(prefixes=prefixes):
+                values = get_totals_for_bnf_code_prefixes(
+                    self.matrixstore, prefixes, fields
+                )
+                expected_values = self.sum_presentations(prefixes, fields)
+                for value, expected_value in zip(values, expected_values):
+                    if expected_value is None:
+                        self.assertIsNone(value)
+                    else:
+                        numpy.testing.assert_allclose(value, expected_value)
+
+    def test_unknown_field_raises_error(self):
+        with self.assertRaises(ValueError):
+            get_totals_for_bnf_code_prefixes(self.matrixstore, ["02"], ["bnf_code"])
+
+    def test_query_plan_uses_child_prefixes(self):
+        nodes, clauses, params = get_query_plan(
+            self.matrixstore.precalculated_bnf_prefixes, ["021", "03"]
+        )
+        self.assertEqual(nodes, ["0212"])
+        self.assertEqual(
+            clauses,
+            [
+                "(bnf_code LIKE ? AND substr(bnf_code, 1, 4) NOT IN (?))",
+                "bnf_code LIKE ?",
+            ],
+        )
+        self.assertEqual(params, ["021%", "0212", "03%"])
+
+    def test_remove_redundant_prefixes(self):
+        self.assertEqual(
+            remove_redundant_prefixes(["0202", "02", "0301", "0202", "030101"]),
+            ["02", "0301"],
+        )
+
+    def sum_presentations(self, prefixes, fields):
+        where = " OR ".join(["bnf_code LIKE ?"] * len(prefixes))
+        sql = "SELECT {} FROM presentation WHERE {}".format(
+            ", ".join("MATRIX_SUM({})".format(field) for field in fields), where
+        )
+        return self.matrixstore.query_one(sql, [p + "%" for p in prefixes])
@@ -1,10 +1,25 @@
+import shutil
+import tempfile
+import threading
+import time
 import warnings
 
-from django.core.cache import CacheKeyWarning
+import numpy
+import scipy.sparse
+from django.core.cache import CacheKeyWarning, cache
 from django.test import SimpleTestCase, override_settings
-from matrixstore.cachelib import memoize
+from matrixstore.cachelib import (
+    Fingerprint,
+    fingerprint,
+    get_memoize_stats,
+    get_or_set_single_flight,
+    get_size,
+    memoize,
+)
 from mock import Mock
 
+from diskcache import DjangoCache
+
 # The local memory cache backend we use in testing warns that our binary cache
 # keys won't be compatible with memcached, but we really don't care
 warnings.simplefilter("ignore", CacheKeyWarning)
@@ -63,3 +78,240 @@ class MemoizeDecoratorTest(SimpleTestCase):
         test_arg = MyTestObject()
         with self.assertRaises(ValueError):
             cached_func(test_arg)
+
+    def test_local_cache(self):
+        test_func = Mock(
+            side_effect=lambda n: numpy.zeros(n, dtype="uint8"),
+            __qualname__="test_local_cache",
+        )
+        cached_func = memoize(local_max_bytes=100)(test_func)
+        result = cached_func(10)
+        # We should get back the identical object from the in-process cache
+        self.assertIs(cached_func(10), result)
+        self.assertEqual(test_func.call_count, 1)
+        stats = get_memoize_stats()[
+            "{}.test_local_cache:1".format(test_func.__module__)
+        ]
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["local_hits"], 1)
+        self.assertEqual(stats["local_bytes"], 10)
+
+        # Too large for the local cache but should still be cached in the
+        # shared cache
+        cached_func(200)
+        cached_func(200)
+        self.assertEqual(test_func.call_count, 2)
+        stats = get_memoize_stats()[
+            "{}.test_local_cache:1".format(test_func.__module__)
+        ]
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["local_bytes"], 10)
+
+    def test_local_cache_evicts_least_recently_used(self):
+        test_func = Mock(
+            side_effect=lambda n: numpy.zeros(40, dtype="uint8"),
+            __qualname__="test_local_cache_evicts",
+        )
+        cached_func = memoize(local_max_bytes=100)(test_func)
+        cached_func(1)
+        cached_func(2)
+        # Use the first value so the second is now least recently used
+        cached_func(1)
+        cached_func(3)
+        local_cache = cached_func.local_cache
+        self.assertEqual([key[1] for key in local_cache.entries], [(1,), (3,)])
+        stats = get_memoize_stats()[
+            "{}.test_local_cache_evicts:1".format(test_func.__module__)
+        ]
+        self.assertEqual(stats["local_evictions"], 1)
+        self.assertEqual(stats["local_bytes"], 80)
+
+    def test_zero_local_max_bytes_disables_local_cache(self):
+        test_func = Mock(return_value=1, __qualname__="test_zero_local_max_bytes")
+        cached_func = memoize(local_max_bytes=0)(test_func)
+        self.assertIsNone(cached_func.local_cache)
+
+    def test_stats_are_not_lost_across_threads(self):
+        test_func = Mock(return_value=1, __qualname__="test_stats_across_threads")
+        cached_func = memoize(local_max_bytes=100)(test_func)
+
+        def call_repeatedly():
+            for _ in range(1000):
+                cached_func(1)
+
+        threads = [threading.Thread(target=call_repeatedly) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = get_memoize_stats()[
+            "{}.test_stats_across_threads:1".format(test_func.__module__)
+        ]
+        self.assertEqual(stats["local_hits"] + stats["hits"] + stats["misses"], 8000)
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+)
+class SingleFlightTest(SimpleTestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_concurrent_calls_compute_value_once(self):
+        started = threading.Event()
+
+        def slow_func(arg):
+            started.set()
+            time.sleep(0.2)
+            return arg * 2
+
+        test_func = Mock(side_effect=slow_func, __qualname__="test_single_flight")
+        cached_func = memoize(single_flight=True)(test_func)
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(cached_func(21)))
+            for _ in range(4)
+        ]
+        threads[0].start()
+        started.wait()
+        for thread in threads[1:]:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [42, 42, 42, 42])
+        test_func.assert_called_once_with(21)
+
+    def test_lock_from_crashed_process_expires(self):
+        # Simulate a process which acquired the lock and then crashed without
+        # releasing it
+        cache.add(("single-flight-lock", "some-key"), 1234, timeout=0.2)
+        start = time.monotonic()
+        value, computed = get_or_set_single_flight(
+            cache, "some-key", lambda: "value", lock_timeout=5
+        )
+        self.assertEqual(value, "value")
+        self.assertTrue(computed)
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(cache.get("some-key"), "value")
+
+    def test_expired_lock_taken_by_another_process_is_not_released(self):
+        lock_key = ("single-flight-lock", "fourth-key")
+
+        def compute():
+            # Simulate our lock expiring while we compute the value and another
+            # process acquiring it in the meantime
+            cache.delete(lock_key)
+            cache.add(lock_key, "other-token", timeout=60)
+            return "value"
+
+        value, computed = get_or_set_single_flight(cache, "fourth-key", compute)
+        self.assertEqual(value, "value")
+        self.assertTrue(computed)
+        self.assertEqual(cache.get(lock_key), "other-token")
+
+    def test_lock_is_released_on_error(self):
+        def compute():
+            raise ValueError()
+
+        with self.assertRaises(ValueError):
+            get_or_set_single_flight(cache, "other-key", compute)
+        value, computed = get_or_set_single_flight(
+            cache, "other-key", lambda: "value", lock_timeout=0.5
+        )
+        self.assertEqual(value, "value")
+        self.assertTrue(computed)
+
+    def test_gives_up_waiting_after_max_wait(self):
+        cache.add(("single-flight-lock", "fifth-key"), 1234, timeout=60)
+        start = time.monotonic()
+        value, computed = get_or_set_single_flight(
+            cache, "fifth-key", lambda: "value", max_wait=0.2
+        )
+        self.assertEqual(value, "value")
+        self.assertTrue(computed)
+        self.assertLess(time.monotonic() - start, 5)
+
+    def test_none_results_not_stored_if_cache_none_false(self):
+        value, computed = get_or_set_single_flight(
+            cache, "sixth-key", lambda: None, cache_none=False
+        )
+        self.assertIsNone(value)
+        self.assertTrue(computed)
+        self.assertEqual(cache.get("sixth-key", default="missing"), "missing")
+
+    def test_releases_lock_atomically_with_diskcache(self):
+        disk_cache = DjangoCache(self.tempdir, {})
+        lock_key = ("single-flight-lock", "seventh-key")
+
+        def compute():
+            # Simulate our lock expiring and another process acquiring it
+            disk_cache.delete(lock_key)
+            disk_cache.add(lock_key, "other-token", timeout=60)
+            return "value"
+
+        value, _ = get_or_set_single_flight(disk_cache, "seventh-key", compute)
+        self.assertEqual(value, "value")
+        self.assertEqual(disk_cache.get(lock_key), "other-token")
+        get_or_set_single_flight(disk_cache, "eighth-key", lambda: "value")
+        self.assertIsNone(disk_cache.get(("single-flight-lock", "eighth-key")))
+        disk_cache.close()
+
+    def test_gives_up_waiting_after_lock_timeout(self):
+        cache.add(("single-flight-lock", "third-key"), 1234, timeout=60)
+        value, computed = get_or_set_single_flight(
+            cache, "third-key", lambda: "value", lock_timeout=0.2
+        )
+        self.assertEqual(value, "value")
+        self.assertTrue(computed)
+
+
+class GetSizeTest(SimpleTestCase):
+    def test_get_size(self):
+        array = numpy.zeros((1000, 1))
+        self.assertEqual(get_size(array), 8000)
+        self.assertEqual(get_size(scipy.sparse.csc_matrix(array)), 8)
+        self.assertGreater(get_size((array, array)), 16000)
+        self.assertGreater(get_size({"a": array}), 8000)
+
+
+class FingerprintTest(SimpleTestCase):
+    def test_equal_values_have_equal_fingerprints(self):
+        values = ["abc", 1, 2.5, None, b"xyz", numpy.arange(10), [["x"], ("y",)]]
+        self.assertEqual(fingerprint(*values), fingerprint(*values))
+
+    def test_incremental_updates_match(self):
+        fingerprint_obj = Fingerprint()
+        fingerprint_obj.update("abc")
+        fingerprint_obj.update(numpy.arange(10))
+        self.assertEqual(fingerprint_obj.digest(), fingerprint("abc", numpy.arange(10)))
+
+    def test_different_values_have_different_fingerprints(self):
+        # Numpy elides the middle of large arrays when formatting them as
+        # strings so these two have the same `str` representation
+        array_a = numpy.arange(10000)
+        array_b = array_a.copy()
+        array_b[5000] = 0
+        self.assertEqual(str(array_a), str(array_b))
+        pairs = [
+            (array_a, array_b),
+            (["ab", "c"], ["a", "bc"]),
+            (numpy.array([1, 2], dtype="int32"), numpy.array([1, 2], dtype="int64")),
+            (numpy.zeros((2, 3)), numpy.zeros((3, 2))),
+            ("1", 1),
+            (1, True),
+            (None, "None"),
+        ]
+        for value_a, value_b in pairs:
+            with self.subTest(value_a=value_a, value_b=value_b):
+                self.assertNotEqual(fingerprint(value_a), fingerprint(value_b))
+
+    def test_non_contiguous_arrays(self):
+        array = numpy.arange(12).reshape((3, 4))
+        self.assertEqual(fingerprint(array[:, 1]), fingerprint(numpy.array([1, 5, 9])))
+
+    def test_unsupported_type_raises_error(self):
+        with self.assertRaises(TypeError):
+            fingerprint({"a": 1})
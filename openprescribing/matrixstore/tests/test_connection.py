@@ -2,6 +2,9 @@ import numbers
 from collections import defaultdict
 
 from django.test import SimpleTestCase
+from matrixstore.build.chunk_presentations_by_date import (
+    chunk_presentations_by_date_for_db,
+)
 from matrixstore.tests.data_factory import DataFactory
 from matrixstore.tests.matrixstore_factory import matrixstore_from_data_factory
 
@@ -14,6 +17,10 @@ class TestMatrixStoreConnection(SimpleTestCase):
             start_date="2018-06-01", num_months=6, num_practices=6, num_presentations=6
         )
         cls.matrixstore = matrixstore_from_data_factory(cls.factory)
+        cls.chunked_matrixstore = matrixstore_from_data_factory(cls.factory)
+        chunk_presentations_by_date_for_db(
+            cls.chunked_matrixstore.connection, months_per_chunk=4
+        )
 
     def test_practice_offsets(self):
         practice_codes = sorted(p["code"] for p in self.factory.practices)
@@ -69,6 +76,46 @@ class TestMatrixStoreConnection(SimpleTestCase):
                 expected_value = items_dict[practice, date]
                 self.assertEqual(value, expected_value)
 
+    def test_parallel_matrix_sum(self):
+        sql = "SELECT {0}(items), {0}(net_cost) FROM presentation"
+        expected = self.matrixstore.query_one(sql.format("MATRIX_SUM"))
+        values = self.matrixstore.query_one(sql.format("PARALLEL_MATRIX_SUM"))
+        for value, expected_value in zip(values, expected):
+            self.assertEqual(value.tolist(), expected_value.tolist())
+
+    def test_query_columns(self):
+        sql = "SELECT bnf_code, items, net_cost FROM presentation ORDER BY bnf_code"
+        dates = self.matrixstore.dates
+        full_results = list(self.matrixstore.query(sql))
+        for start, end in [(0, 0), (3, 5), (2, 4), (0, 5)]:
+            date_range = (dates[start], dates[end])
+            for matrixstore in [self.matrixstore, self.chunked_matrixstore]:
+                with self.subTest(date_range=date_range, matrixstore=matrixstore):
+                    results = list(matrixstore.query_columns(sql, date_range))
+                    self.assertEqual(len(results), len(full_results))
+                    for row, full_row in zip(results, full_results):
+                        self.assertEqual(row[0], full_row[0])
+                        for matrix, full_matrix in zip(row[1:], full_row[1:]):
+                            self.assertEqual(matrix.shape[1], end - start + 1)
+                            self.assertEqual(
+                                to_list(matrix),
+                                to_list(full_matrix[:, start : end + 1]),
+                            )
+
+    def test_chunked_matrix_sum(self):
+        sql = "SELECT MATRIX_SUM(items), MATRIX_SUM(quantity) FROM presentation"
+        items, quantity = self.matrixstore.query_one(sql)
+        chunked_items, chunked_quantity = self.chunked_matrixstore.query_one(sql)
+        self.assertEqual(chunked_items.tolist(), items.tolist())
+        self.assertEqual(chunked_quantity.tolist(), quantity.tolist())
+
     @classmethod
     def tearDownClass(cls):
         cls.matrixstore.close()
+        cls.chunked_matrixstore.close()
+
+
+def to_list(matrix):
+    if hasattr(matrix, "toarray"):
+        matrix = matrix.toarray()
+    return matrix.tolist()
@@ -0,0 +1,175 @@
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+import numpy
+from django.test import SimpleTestCase
+from frontend import ghost_branded_generics
+from frontend.price_per_unit import savings
+from matrixstore.build.build_cube import build_cube_for_db
+from matrixstore.cube import PresentationCube
+from matrixstore.matrix_ops import to_dense
+from matrixstore.tests.benchmarks import Fixture, clear_local_caches
+from matrixstore.tests.test_row_grouper import round_floats
+
+
+class TestCube(SimpleTestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.fixture = Fixture(practices=40, months=4, presentations=24, seed=2)
+        self.db = self.fixture.db
+        self.cube_path = os.path.join(self.tempdir, "matrixstore.sqlite.cube")
+        build_cube_for_db(self.db.connection, self.cube_path, 2)
+        self.cube = PresentationCube(self.cube_path)
+
+    def test_arrays_match_matrixstore(self):
+        self.assertEqual(self.cube.dates, self.db.dates[-2:])
+        self.assertEqual(self.cube.practices, self.db.practices)
+        for date in self.cube.dates:
+            results = self.db.query_columns(
+                "SELECT bnf_code, quantity, net_cost FROM presentation", (date, date)
+            )
+            for bnf_code, quantity, net_cost in results:
+                quantity = to_dense(quantity)[:, 0]
+                net_cost = to_dense(net_cost)[:, 0]
+                if bnf_code not in self.cube.offsets:
+                    self.assertFalse(numpy.any(quantity) or numpy.any(net_cost))
+                    continue
+                rows, codes = self.cube.get_rows("quantity", date, [bnf_code])
+                self.assertEqual(codes, [bnf_code])
+                self.assertEqual(rows[0].tolist(), quantity.tolist())
+                rows, codes = self.cube.get_rows("net_cost", date, [bnf_code])
+                self.assertEqual(rows[0].tolist(), net_cost.tolist())
+
+    def test_grouping_matrix(self):
+        date = self.cube.dates[-1]
+        codes = self.cube.bnf_codes
+        groups = [codes[:3], codes[3:4], ["unknown"]]
+        grouping = self.cube.get_grouping_matrix(groups)
+        sums = grouping @ self.cube.get("quantity", date)
+        for group, row in zip(groups, sums):
+            values, _ = self.cube.get_rows("quantity", date, group)
+            self.assertEqual(row.tolist(), values.sum(axis=0).tolist())
+
+    def test_total_savings_for_org_type(self):
+        date = self.cube.dates[-1]
+        kwargs = dict(
+            substitution_sets=self.fixture.substitution_sets,
+            date=date,
+            group_by_org=self.db.row_groupers["ccg"],
+            min_saving=1,
+            practice_group_by_org=self.db.row_groupers["standard_practice"],
+            target_centile=savings.CONFIG_TARGET_CENTILE,
+        )
+        with self.fixture.patched():
+            function = savings.get_total_savings_for_org_type.__wrapped__
+            clear_local_caches()
+            expected = function(db=self.db, **kwargs)
+            self.db.cube = self.cube
+            totals = function(db=self.db, **kwargs)
+        self.assertTrue(numpy.any(expected))
+        self.assertEqual(totals.shape, expected.shape)
+        numpy.testing.assert_allclose(totals, expected)
+
+    def test_savings_for_substitution_sets(self):
+        """
+        Test that calculating savings for many substitution sets at once, over
+        several batches, gives the same results as handling them one at a time,
+        whether or not we use the cube
+        """
+        date = self.cube.dates[-1]
+        org_ids = sorted(self.db.row_groupers["ccg"].offsets)
+        substitution_sets = list(self.fixture.substitution_sets.values())
+        args = (substitution_sets, date, "ccg", org_ids)
+        with self.fixture.patched(), mock.patch.object(savings, "BATCH_SIZE", 2):
+            clear_local_caches()
+            expected = []
+            for substitution_set in substitution_sets:
+                expected.extend(
+                    savings.get_savings_for_orgs(
+                        substitution_set.id, date, "ccg", org_ids, min_saving=1
+                    )
+                )
+            expected.sort(key=lambda i: i["possible_savings"], reverse=True)
+            results = savings.get_savings_for_substitution_sets(*args, min_saving=1)
+            self.db.cube = self.cube
+            cube_results = savings.get_savings_for_substitution_sets(
+                *args, min_saving=1
+            )
+        self.assertGreater(len(substitution_sets), 2)
+        self.assertTrue(expected)
+        self.assertEqual(round_floats(results), round_floats(expected))
+        self.assertEqual(round_floats(cube_results), round_floats(expected))
+
+    def test_savings_skip_sets_not_prescribed_by_orgs(self):
+        date = self.cube.dates[-1]
+        practice_grouper = self.db.row_groupers["practice"]
+        substitution_sets = list(self.fixture.substitution_sets.values())
+        with self.fixture.patched():
+            clear_local_caches()
+            quantities, _ = savings.get_quantities_and_net_costs_for_batch(
+                self.db, substitution_sets, date
+            )
+            # Find a practice which prescribes some, but not all, of the sets
+            for org_id in sorted(practice_grouper.offsets):
+                prescribed = numpy.any(
+                    practice_grouper.sum(quantities, [org_id]), axis=0
+                )
+                if 0 < prescribed.sum() < len(substitution_sets):
+                    break
+            else:
+                self.fail("No practice prescribes only some substitution sets")
+            batches = list(
+                savings.iter_savings_batches(
+                    self.db,
+                    substitution_sets,
+                    date,
+                    practice_group_by_org=self.db.row_groupers["standard_practice"],
+                    target_centile=savings.CONFIG_TARGET_CENTILE,
+                    group_by_org=practice_grouper,
+                    org_ids=[org_id],
+                )
+            )
+        expected = [s for s, p in zip(substitution_sets, prescribed) if p]
+        self.assertEqual(
+            [s for batch in batches for s in batch.substitution_sets], expected
+        )
+        self.assertEqual(sum(len(batch.target_ppu) for batch in batches), len(expected))
+
+    def test_ghost_branded_generic_spending(self):
+        date = self.cube.dates[-1]
+        args = (
+            date,
+            ghost_branded_generics.PRESENTATIONS_TO_IGNORE,
+            ghost_branded_generics.MIN_GHOST_GENERIC_DELTA,
+        )
+        with self.fixture.patched():
+            function = (
+                ghost_branded_generics.get_total_ghost_branded_generic_spending_per_practice
+            )
+            clear_local_caches()
+            expected_prices = ghost_branded_generics.get_inferred_tariff_prices(
+                self.db, *args[:2]
+            )
+            expected = function.__wrapped__(self.db, *args)
+            clear_local_caches()
+            self.db.cube = self.cube
+            prices = ghost_branded_generics.get_inferred_tariff_prices(
+                self.db, *args[:2]
+            )
+            totals = function.__wrapped__(self.db, *args)
+        # Presentations with no prescribing in the month just get NaN prices
+        # without the cube, and are omitted with it
+        expected_prices = {
+            code: price
+            for code, price in expected_prices.items()
+            if not numpy.isnan(price)
+        }
+        self.assertEqual(prices.keys(), expected_prices.keys())
+        for code, price in prices.items():
+            self.assertEqual(price, expected_prices[code])
+        self.assertTrue(numpy.any(expected))
+        self.assertEqual(totals.shape, expected.shape)
+        numpy.testing.assert_allclose(totals, expected)
@@ -0,0 +1,92 @@
+import os
+import shutil
+import tempfile
+
+from django.test import SimpleTestCase
+from matrixstore.build.build_hot_storage import build_hot_storage_for_db
+from matrixstore.connection import MatrixStore
+from matrixstore.hot_storage import PAGE_SIZE, HotStorage, parse_reference
+from matrixstore.serializer import deserialize
+from matrixstore.tests.data_factory import DataFactory
+from matrixstore.tests.matrixstore_factory import matrixstore_from_data_factory
+
+
+class TestHotStorage(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        factory = DataFactory()
+        months = factory.create_months("2019-01-01", 4)
+        practices = factory.create_practices(5)
+        presentations = factory.create_presentations(6)
+        factory.create_prescribing(presentations, practices, months)
+        cls.matrixstore = matrixstore_from_data_factory(factory)
+        cls.tempdir = tempfile.mkdtemp()
+        cls.hot_storage_path = os.path.join(cls.tempdir, "matrixstore.sqlite.hot")
+        hot_connection = matrixstore_from_data_factory(factory).connection
+        build_hot_storage_for_db(hot_connection, cls.hot_storage_path, 3)
+        cls.hot_matrixstore = MatrixStore(
+            hot_connection, hot_storage=HotStorage(cls.hot_storage_path)
+        )
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.matrixstore.close()
+        cls.hot_matrixstore.close()
+        shutil.rmtree(cls.tempdir)
+
+    def test_most_prescribed_presentations_are_stored_as_references(self):
+        sql = "SELECT bnf_code, items FROM presentation"
+        totals = {
+            bnf_code: items.sum() for bnf_code, items in self.matrixstore.query(sql)
+        }
+        expected = sorted(totals, key=totals.get, reverse=True)[:3]
+        hot_bnf_codes = []
+        for bnf_code, items in self.hot_matrixstore.connection.execute(sql):
+            if items.startswith(b"MSHR"):
+                hot_bnf_codes.append(bnf_code)
+                offset = parse_reference(items)[1]
+                self.assertEqual(offset % PAGE_SIZE, 0)
+        self.assertEqual(sorted(hot_bnf_codes), sorted(expected))
+
+    def test_query_results_match(self):
+        sql = "SELECT bnf_code, items, quantity, net_cost FROM presentation"
+        hot_results = list(self.hot_matrixstore.query(sql))
+        results = list(self.matrixstore.query(sql))
+        self.assertEqual(len(hot_results), len(results))
+        for hot_row, row in zip(hot_results, results):
+            self.assertEqual(hot_row[0], row[0])
+            for hot_matrix, matrix in zip(hot_row[1:], row[1:]):
+                self.assertEqual(to_list(hot_matrix), to_list(matrix))
+
+    def test_query_columns_results_match(self):
+        sql = "SELECT items FROM presentation ORDER BY bnf_code"
+        date_range = (self.matrixstore.dates[1], self.matrixstore.dates[2])
+        hot_results = list(self.hot_matrixstore.query_columns(sql, date_range))
+        results = list(self.matrixstore.query_columns(sql, date_range))
+        for (hot_matrix,), (matrix,) in zip(hot_results, results):
+            self.assertEqual(to_list(hot_matrix), to_list(matrix))
+
+    def test_matrix_sum_results_match(self):
+        for function in ["MATRIX_SUM", "PARALLEL_MATRIX_SUM"]:
+            with self.subTest(function=function):
+                sql = "SELECT {}(quantity) FROM presentation".format(function)
+                hot_value = self.hot_matrixstore.query_one(sql)[0]
+                value = self.matrixstore.query_one(sql)[0]
+                self.assertEqual(hot_value.tolist(), value.tolist())
+
+    def test_references_require_hot_storage(self):
+        references = [
+            items
+            for (items,) in self.hot_matrixstore.connection.execute(
+                "SELECT items FROM presentation"
+            )
+            if items.startswith(b"MSHR")
+        ]
+        with self.assertRaises(ValueError):
+            deserialize(references[0])
+
+
+def to_list(matrix):
+    if hasattr(matrix, "toarray"):
+        matrix = matrix.toarray()
+    return matrix.tolist()
@@ -0,0 +1,145 @@
+import threading
+
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import HttpResponse, StreamingHttpResponse
+from django.test import RequestFactory, SimpleTestCase, override_settings
+from matrixstore.instrumentation import Recorder, bind, get_recorder, recording
+from matrixstore.middleware import matrixstore_timing_middleware
+from matrixstore.row_grouper import RowGrouper
+from matrixstore.tests.data_factory import DataFactory
+from matrixstore.tests.matrixstore_factory import matrixstore_from_data_factory
+
+
+class TestInstrumentation(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        factory = DataFactory()
+        factory.create_all(
+            start_date="2018-06-01", num_months=6, num_practices=6, num_presentations=6
+        )
+        cls.matrixstore = matrixstore_from_data_factory(factory)
+
+    def test_records_queries(self):
+        recorder = Recorder()
+        with recording(recorder):
+            rows = list(self.matrixstore.query("SELECT items FROM presentation"))
+            self.matrixstore.query_one("SELECT COUNT(*) FROM presentation")
+        stats = recorder.stats["query"]
+        self.assertEqual(stats.calls, 2)
+        self.assertEqual(stats.rows, len(rows) + 1)
+        self.assertGreater(stats.duration, 0)
+        decompressed = recorder.stats["decompress"]
+        self.assertEqual(decompressed.calls, len(rows))
+        self.assertGreater(decompressed.bytes_decompressed, 0)
+        self.assertEqual(stats.bytes_decompressed, decompressed.bytes_decompressed)
+
+    def test_records_query_columns(self):
+        recorder = Recorder()
+        dates = self.matrixstore.dates
+        with recording(recorder):
+            list(
+                self.matrixstore.query_columns(
+                    "SELECT items FROM presentation", (dates[0], dates[1])
+                )
+            )
+        self.assertEqual(recorder.stats["query"].calls, 1)
+        self.assertEqual(recorder.stats["query"].rows, 6)
+
+    def test_records_row_grouper_calls(self):
+        row_grouper = RowGrouper([(0, "a"), (1, "a"), (2, "b")])
+        (matrix,) = self.matrixstore.query_one("SELECT items FROM presentation")
+        recorder = Recorder()
+        with recording(recorder):
+            row_grouper.sum(matrix[:3])
+            row_grouper.sum_one_group(matrix[:3], "a")
+        stats = recorder.stats["row_grouper"]
+        self.assertEqual(stats.calls, 2)
+        self.assertEqual(stats.rows, 3)
+
+    def test_nothing_recorded_without_recorder(self):
+        sql = "SELECT items FROM presentation"
+        self.assertIsNone(get_recorder())
+        query = self.matrixstore.query(sql)
+        self.assertEqual(query.__qualname__, "MatrixStore._query")
+
+    def test_bind_records_work_in_other_threads(self):
+        recorder = Recorder()
+        with recording(recorder):
+            function = bind(lambda: self.matrixstore.query_one("SELECT 1"))
+        thread = threading.Thread(target=function)
+        thread.start()
+        thread.join()
+        self.assertEqual(recorder.stats["query"].calls, 1)
+
+    def test_slow_query_log(self):
+        recorder = Recorder(slow_threshold=0, label="/some/path/")
+        with self.assertLogs("matrixstore.slow_queries") as logs:
+            with recording(recorder):
+                self.matrixstore.query_one("SELECT\n   1")
+        (message,) = logs.output
+        self.assertIn("/some/path/: SELECT 1", message)
+
+
+class TestMiddleware(SimpleTestCase):
+    def get_response(self, request):
+        self.assertIsNotNone(get_recorder())
+        return HttpResponse("OK", headers={"Server-Timing": "app;dur=1"})
+
+    @override_settings(
+        MATRIXSTORE_INSTRUMENTATION=True, MATRIXSTORE_SLOW_QUERY_THRESHOLD_MS=100
+    )
+    def test_adds_server_timing_header(self):
+        middleware = matrixstore_timing_middleware(self.get_response)
+        response = middleware(RequestFactory().get("/"))
+        self.assertIsNone(get_recorder())
+        metrics = [
+            metric.split(";")[0] for metric in response["Server-Timing"].split(", ")
+        ]
+        self.assertEqual(
+            metrics,
+            [
+                "app",
+                "matrixstore-query",
+                "matrixstore-decompress",
+                "matrixstore-row-grouper",
+            ],
+        )
+
+    @override_settings(
+        MATRIXSTORE_INSTRUMENTATION=True, MATRIXSTORE_SLOW_QUERY_THRESHOLD_MS=0
+    )
+    def test_records_while_streaming(self):
+        def get_response(request):
+            def content():
+                self.assertIsNotNone(get_recorder())
+                get_recorder().record("query", "SELECT 1", 1, 0, 0.5)
+                yield b"OK"
+
+            return StreamingHttpResponse(content())
+
+        middleware = matrixstore_timing_middleware(get_response)
+        response = middleware(RequestFactory().get("/streaming/"))
+        self.assertFalse(response.has_header("Server-Timing"))
+        with self.assertLogs("matrixstore.slow_queries") as logs:
+            self.assertEqual(b"".join(response.streaming_content), b"OK")
+        self.assertIsNone(get_recorder())
+        (message,) = logs.output
+        self.assertIn("/streaming/: SELECT 1", message)
+
+    @override_settings(
+        MATRIXSTORE_INSTRUMENTATION=True, MATRIXSTORE_SLOW_QUERY_THRESHOLD_MS=None
+    )
+    def test_slow_query_log_disabled_without_threshold(self):
+        def get_response(request):
+            get_recorder().record("query", "SELECT 1", 1, 0, 60)
+            return HttpResponse("OK")
+
+        middleware = matrixstore_timing_middleware(get_response)
+        with self.assertNoLogs("matrixstore.slow_queries"):
+            middleware(RequestFactory().get("/"))
+
+    @override_settings(MATRIXSTORE_INSTRUMENTATION=False)
+    def test_not_used_when_disabled(self):
+        with self.assertRaises(MiddlewareNotUsed):
+            matrixstore_timing_middleware(self.get_response)
@@ -1,11 +1,15 @@
 import random
+import warnings
+from itertools import product
 
 import numpy
 from django.test import SimpleTestCase
 from matrixstore.matrix_ops import (
     convert_to_smallest_int_type,
     finalise_matrix,
+    nan_centile,
     sparse_matrix,
+    to_dense,
 )
 from scipy.sparse import spmatrix as SparseMatrixBase
 
@@ -93,3 +97,83 @@ class TestFinaliseMatrix(SimpleTestCase):
             i = int(n / cols)
             j = n % cols
             yield i, j
+
+
+class TestToDense(SimpleTestCase):
+    def test_sparse_matrices_are_converted_to_ndarrays(self):
+        matrix = sparse_matrix((3, 2))
+        matrix[1, 1] = 5.0
+        dense = to_dense(matrix.tocsc())
+        self.assertIsInstance(dense, numpy.ndarray)
+        self.assertEqual(dense.tolist(), [[0.0, 0.0], [0.0, 5.0], [0.0, 0.0]])
+
+    def test_ndarrays_are_returned_unchanged(self):
+        matrix = numpy.ones((2, 2))
+        self.assertIs(to_dense(matrix), matrix)
+
+
+class TestNanCentile(SimpleTestCase):
+    def setUp(self):
+        self.random = random.Random()
+        self.random.seed(25)
+
+    def test_matches_numpy_nanpercentile(self):
+        """
+        Test that we get exactly the same results (of the same type) as numpy
+        over lots of random matrices with varying proportions of NaN and
+        infinite values, without emitting any warnings
+        """
+        for n in range(500):
+            matrix = self._random_matrix()
+            centile = self.random.choice([0, 10, 50, 100, self.random.random() * 100])
+            options = product(
+                [0, 1], ["linear", "lower"], [numpy.float64, numpy.float32]
+            )
+            for axis, method, dtype in options:
+                with self.subTest(
+                    n=n, centile=centile, axis=axis, method=method, dtype=dtype
+                ):
+                    typed_matrix = matrix.astype(dtype)
+                    with warnings.catch_warnings():
+                        # Ignore numpy's warnings about all-NaN columns
+                        warnings.simplefilter("ignore", RuntimeWarning)
+                        expected = numpy.nanpercentile(
+                            typed_matrix, centile, axis=axis, method=method
+                        )
+                    with warnings.catch_warnings():
+                        warnings.simplefilter("error")
+                        value = nan_centile(
+                            typed_matrix, centile, axis=axis, method=method
+                        )
+                    self.assertEqual(value.dtype, expected.dtype)
+                    numpy.testing.assert_array_equal(value, expected)
+
+    def test_one_dimensional_input_gives_scalar(self):
+        value = nan_centile(numpy.array([4.0, numpy.nan, 1.0, 2.0]), 50)
+        self.assertEqual(value, 2.0)
+        self.assertTrue(numpy.isnan(nan_centile(numpy.array([numpy.nan]), 50)))
+
+    def test_unsupported_method_raises_error(self):
+        with self.assertRaises(ValueError):
+            nan_centile(numpy.ones((2, 2)), 50, method="nearest")
+
+    def _random_matrix(self):
+        rows = self.random.randint(0, 12)
+        cols = self.random.randint(1, 12)
+        nan_density = self.random.random()
+        inf_density = self.random.choice([0, 0, 0.2])
+        # Use a small range of integer values in some cases, so we get plenty of
+        # duplicates
+        integers = self.random.random() < 0.5
+        matrix = numpy.empty((rows, cols))
+        for i, j in product(range(rows), range(cols)):
+            if self.random.random() < nan_density:
+                value = numpy.nan
+            elif self.random.random() < inf_density:
+                value = self.random.choice([numpy.inf, -numpy.inf])
+            elif integers:
+                value = self.random.randint(-3, 3)
+            else:
+                value = self.random.uniform(-1e6, 1e6)
+            matrix[i, j] = value
+        return matrix
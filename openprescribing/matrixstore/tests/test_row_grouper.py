@@ -5,6 +5,7 @@ import numpy
 from django.test import SimpleTestCase
 from matrixstore.matrix_ops import finalise_matrix, sparse_matrix
 from matrixstore.row_grouper import RowGrouper
+from matrixstore.tests.benchmark_row_grouper import loop_sum
 
 
 class TestGrouper(SimpleTestCase):
@@ -100,6 +101,20 @@ class TestGrouper(SimpleTestCase):
         value = to_list_of_lists(grouped_matrix)
         self.assertEqual(value, [])
 
+    def test_cache_key(self):
+        """
+        Test that cache keys are equal if and only if the group configuration
+        is the same, even where the groups are too large for numpy to print in
+        full
+        """
+        group_definition = [(row, row % 2) for row in range(10000)]
+        altered_definition = group_definition[:5000] + group_definition[5002:]
+        row_grouper = RowGrouper(group_definition)
+        self.assertEqual(row_grouper.cache_key, RowGrouper(group_definition).cache_key)
+        self.assertNotEqual(
+            row_grouper.cache_key, RowGrouper(altered_definition).cache_key
+        )
+
     def test_sum_with_all_group_and_matrix_type_combinations(self):
         """
         Tests the `sum` method with every combination of group type and matrix
@@ -138,6 +153,32 @@ class TestGrouper(SimpleTestCase):
                         round_floats(values), round_floats(expected_values)
                     )
 
+                # Test summing an empty list of groups
+                with self.subTest(group_ids=[]):
+                    grouped_matrix = row_grouper.sum(matrix, [])
+                    self.assertEqual(grouped_matrix.shape, (0, matrix.shape[1]))
+
+    def test_sum_matches_loop_implementation(self):
+        """
+        Tests the `sum` method gives identical results to the original
+        implementation, including when group IDs are repeated
+
+        (We skip cases where every group has exactly one row as these take a
+        different path.)
+        """
+        test_cases = product(self.get_group_definitions(), self.get_matrices())
+        for (group_name, group_definition), (matrix_name, matrix) in test_cases:
+            row_grouper = RowGrouper(group_definition)
+            if row_grouper._single_row_groups_selector is not None:
+                continue
+            with self.subTest(matrix=matrix_name, group=group_name):
+                group_ids = row_grouper.ids[:2] + row_grouper.ids[:1]
+                value = row_grouper.sum(matrix, group_ids)
+                expected_value = loop_sum(row_grouper, matrix, group_ids)
+                self.assertIsInstance(value, numpy.ndarray)
+                self.assertEqual(value.dtype, expected_value.dtype)
+                numpy.testing.assert_allclose(value, expected_value)
+
     def test_sum_one_group_with_all_group_and_matrix_type_combinations(self):
         """
         Tests the `sum_one_group` method with every combination of group type
@@ -0,0 +1,100 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+
+import numpy
+from django.test import SimpleTestCase
+from matrixstore.connection import MatrixStore
+from matrixstore.row_grouper import RowGrouper
+from matrixstore.row_grouper_storage import (
+    FORMAT_VERSION,
+    get_row_groupers_path,
+    read_row_groupers,
+    write_row_groupers,
+)
+from matrixstore.serializer import serialize_compressed
+from matrixstore.tests.data_factory import DataFactory
+from matrixstore.tests.import_test_data_fast import import_test_data_fast
+
+
+class TestRowGrouperStorage(SimpleTestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, "matrixstore.sqlite.row_groupers")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_round_trip(self):
+        row_groupers = {
+            "ccg": RowGrouper([(0, "ccg_a"), (1, "ccg_b"), (2, "ccg_a")]),
+            "practice": RowGrouper([(0, "P1"), (1, "P2"), (2, "P3")]),
+        }
+        write_row_groupers(self.path, ["P1", "P2", "P3"], row_groupers)
+        loaded = read_row_groupers(self.path, ["P1", "P2", "P3"])
+        self.assertEqual(set(loaded.keys()), {"ccg", "practice"})
+        matrix = numpy.array([[1, 2], [3, 4], [5, 6]])
+        for org_type, row_grouper in row_groupers.items():
+            with self.subTest(org_type=org_type):
+                loaded_row_grouper = loaded[org_type]
+                self.assertEqual(loaded_row_grouper.ids, row_grouper.ids)
+                self.assertEqual(loaded_row_grouper.offsets, row_grouper.offsets)
+                self.assertEqual(loaded_row_grouper.cache_key, row_grouper.cache_key)
+                self.assertEqual(
+                    loaded_row_grouper.sum(matrix).tolist(),
+                    row_grouper.sum(matrix).tolist(),
+                )
+
+    def test_ignores_row_groupers_for_different_practices(self):
+        row_groupers = {"practice": RowGrouper([(0, "P1"), (1, "P2")])}
+        write_row_groupers(self.path, ["P1", "P2"], row_groupers)
+        with self.assertLogs("matrixstore.row_grouper_storage", "WARNING"):
+            self.assertEqual(read_row_groupers(self.path, ["P2", "P1"]), {})
+
+    def test_ignores_other_format_versions(self):
+        with open(self.path, "wb") as f:
+            f.write(
+                serialize_compressed(
+                    {
+                        "format_version": FORMAT_VERSION + 1,
+                        "practices": ["P1"],
+                        "group_assignments": {"practice": [(0, "P1")]},
+                    }
+                )
+            )
+        with self.assertLogs("matrixstore.row_grouper_storage", "WARNING"):
+            self.assertEqual(read_row_groupers(self.path, ["P1"]), {})
+
+    def test_ignores_unreadable_files(self):
+        with open(self.path, "wb") as f:
+            f.write(b"not a row groupers file")
+        with self.assertLogs("matrixstore.row_grouper_storage", "WARNING"):
+            self.assertEqual(read_row_groupers(self.path, ["P1"]), {})
+
+    def test_missing_file(self):
+        self.assertEqual(read_row_groupers(self.path, ["P1"]), {})
+
+    def test_loaded_by_matrixstore(self):
+        factory = DataFactory()
+        factory.create_all(num_practices=3, num_presentations=2)
+        sqlite_path = os.path.join(self.tempdir, "matrixstore.sqlite")
+        connection = sqlite3.connect(sqlite_path)
+        import_test_data_fast(
+            connection, factory, max(factory.months)[:7], months=len(factory.months)
+        )
+        connection.close()
+        matrixstore = MatrixStore.from_file(sqlite_path)
+        self.assertEqual(matrixstore.row_groupers, {})
+        practices = matrixstore.practices
+        matrixstore.close()
+
+        row_grouper = RowGrouper(enumerate(practices))
+        write_row_groupers(
+            get_row_groupers_path(sqlite_path), practices, {"practice": row_grouper}
+        )
+        matrixstore = MatrixStore.from_file(sqlite_path)
+        self.assertEqual(
+            matrixstore.row_groupers["practice"].cache_key, row_grouper.cache_key
+        )
+        matrixstore.close()
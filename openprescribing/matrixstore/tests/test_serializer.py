@@ -1,9 +1,18 @@
 import sqlite3
+from unittest import mock
 
 import numpy
 import scipy.sparse
 from django.test import SimpleTestCase
-from matrixstore.serializer import deserialize, serialize, serialize_compressed
+from matrixstore import lz4_buffers, serializer
+from matrixstore.serializer import (
+    deserialize,
+    deserialize_columns,
+    deserialize_transient,
+    serialize,
+    serialize_chunked,
+    serialize_compressed,
+)
 
 
 class TestSerializer(SimpleTestCase):
@@ -42,6 +51,107 @@ class TestSerializer(SimpleTestCase):
         new_obj = deserialize(new_data)
         self.assertEqual(new_obj, obj)
 
+    def test_chunked_serialisation(self):
+        for obj in self.get_test_matrices():
+            for columns_per_chunk in [1, 2, 3, 7]:
+                with self.subTest(type=type(obj), columns_per_chunk=columns_per_chunk):
+                    data = serialize_chunked(obj, columns_per_chunk)
+                    new_obj = deserialize(roundtrip_through_sqlite(data))
+                    self.assertEqual(type(new_obj), type(obj))
+                    self.assertEqual(new_obj.dtype, obj.dtype)
+                    self.assertEqual(to_list(new_obj), to_list(obj))
+
+    def test_deserialize_columns(self):
+        for obj in self.get_test_matrices():
+            chunked = serialize_chunked(obj, 2)
+            unchunked = serialize_compressed(obj)
+            for start, stop in [(0, 1), (1, 2), (1, 4), (3, 5), (0, 5), (4, None)]:
+                expected = [row[start:stop] for row in to_list(obj)]
+                for data in [chunked, unchunked]:
+                    with self.subTest(type=type(obj), start=start, stop=stop):
+                        value = deserialize_columns(data, start, stop)
+                        self.assertEqual(to_list(value), expected)
+                        # Check the value isn't a view onto a scratch buffer
+                        # which gets overwritten by subsequent calls
+                        deserialize_transient(serialize_compressed(obj * 0))
+                        self.assertEqual(to_list(value), expected)
+
+    def test_deserialize_transient(self):
+        for obj in self.get_test_matrices():
+            data = serialize_compressed(obj)
+            with self.subTest(type=type(obj)):
+                self.assertEqual(to_list(deserialize_transient(data)), to_list(obj))
+
+    def test_deserialize_transient_reuses_buffer(self):
+        obj = numpy.arange(1000, dtype=numpy.float64)
+        first = deserialize_transient(serialize_compressed(obj))
+        second = deserialize_transient(serialize_compressed(obj * 2))
+        self.assertTrue(numpy.shares_memory(first, second))
+        self.assertEqual(first.tolist(), second.tolist())
+
+    def test_deserialize_transient_with_uncompressed_data(self):
+        obj = numpy.arange(10)
+        self.assertEqual(deserialize_transient(serialize(obj)).tolist(), obj.tolist())
+
+    def test_deserialize_into_buffer_which_is_too_small(self):
+        obj = numpy.arange(1000)
+        value = deserialize(serialize_compressed(obj), bytearray(10))
+        self.assertEqual(value.tolist(), obj.tolist())
+
+    def get_test_matrices(self):
+        dense = numpy.arange(30, dtype=numpy.uint16).reshape((6, 5))
+        dense[dense % 3 == 0] = 0
+        return [dense, scipy.sparse.csc_matrix(dense), dense.astype(numpy.float64)]
+
+
+class TestLZ4Buffers(SimpleTestCase):
+    def test_fast_path_available(self):
+        # If this fails then the installed version of the `lz4` package no
+        # longer exports the functions we need and every matrix we sum will
+        # silently take the slower path (see `matrixstore.lz4_buffers`)
+        self.assertTrue(lz4_buffers.AVAILABLE)
+
+    def test_deserialize_transient_uses_fast_path(self):
+        compressed = serialize_compressed(numpy.arange(1000))
+        with mock.patch("lz4.frame.decompress") as decompress:
+            self.assertEqual(
+                deserialize_transient(compressed).tolist(), list(range(1000))
+            )
+        decompress.assert_not_called()
+
+    def test_large_values_not_decompressed_into_scratch_buffer(self):
+        compressed = serialize_compressed(numpy.arange(1000))
+        with mock.patch.object(serializer, "MAX_SCRATCH_BUFFER_SIZE", 100):
+            with mock.patch.object(serializer, "get_scratch_buffer") as get_buffer:
+                self.assertEqual(
+                    deserialize_transient(compressed).tolist(), list(range(1000))
+                )
+        get_buffer.assert_not_called()
+
+    def test_decompress_into(self):
+        data = serialize(numpy.arange(1000))
+        compressed = serialize_compressed(numpy.arange(1000))
+        self.assertEqual(lz4_buffers.get_content_size(compressed), len(data))
+        buffer = bytearray(len(data) + 10)
+        size = lz4_buffers.decompress_into(compressed, buffer)
+        self.assertEqual(size, len(data))
+        self.assertEqual(buffer[:size], data)
+
+    def test_decompress_into_buffer_which_is_too_small(self):
+        compressed = serialize_compressed(numpy.arange(1000))
+        with self.assertRaises(lz4_buffers.LZ4BufferError):
+            lz4_buffers.decompress_into(compressed, bytearray(10))
+        # The decompression context is still usable afterwards
+        buffer = bytearray(lz4_buffers.get_content_size(compressed))
+        lz4_buffers.decompress_into(compressed, buffer)
+        self.assertEqual(deserialize(buffer).tolist(), list(range(1000)))
+
+
+def to_list(matrix):
+    if hasattr(matrix, "toarray"):
+        matrix = matrix.toarray()
+    return matrix.tolist()
+
 
 def roundtrip_through_sqlite(value):
     db = sqlite3.connect(":memory:")
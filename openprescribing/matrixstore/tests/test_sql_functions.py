@@ -1,7 +1,15 @@
+import os
+
 import numpy
 import scipy.sparse
 from django.test import SimpleTestCase
-from matrixstore.sql_functions import MatrixSum, fast_in_place_add
+from matrixstore.serializer import deserialize, serialize_compressed
+from matrixstore.sql_functions import (
+    MatrixSum,
+    ParallelMatrixSum,
+    fast_in_place_add,
+    get_thread_pool,
+)
 
 
 class TestMatrixSum(SimpleTestCase):
@@ -34,3 +42,53 @@ class TestMatrixSum(SimpleTestCase):
         self.assertEqual(
             accumulator.tolist(), [[1, 0, 2], [0, 0, 4], [1, 5, 6], [5, 5, 2]]
         )
+
+
+class TestParallelMatrixSum(SimpleTestCase):
+    def test_matches_matrix_sum(self):
+        random = numpy.random.default_rng(seed=1)
+        matrices = []
+        for i in range(50):
+            matrix = random.integers(0, 3, size=(8, 6))
+            if i % 2:
+                matrix = scipy.sparse.csc_matrix(matrix)
+            matrices.append(matrix)
+        values = [serialize_compressed(matrix) for matrix in matrices]
+        values.insert(10, None)
+
+        expected_sum = MatrixSum()
+        for value in values:
+            expected_sum.step(value)
+        expected = expected_sum.value()
+
+        # Use a small batch size so we exercise the thread pool, and a batch
+        # size of 1 so we exercise the limit on the number of pending batches
+        for batch_size in [1, 7, 100]:
+            with self.subTest(batch_size=batch_size):
+                matrix_sum = ParallelMatrixSum()
+                matrix_sum.batch_size = batch_size
+                for value in values:
+                    matrix_sum.step(value)
+                value = deserialize(matrix_sum.finalize())
+                self.assertTrue(value.flags.f_contiguous)
+                self.assertEqual(value.tolist(), expected.tolist())
+
+    def test_returns_none_on_empty_sum(self):
+        matrix_sum = ParallelMatrixSum()
+        matrix_sum.step(None)
+        self.assertIsNone(matrix_sum.finalize())
+
+
+class TestThreadPool(SimpleTestCase):
+    def test_thread_pool_usable_after_fork(self):
+        # Make sure the pool exists before we fork
+        self.assertEqual(get_thread_pool().submit(abs, -1).result(), 1)
+        pid = os.fork()
+        if pid == 0:
+            try:
+                result = get_thread_pool().submit(abs, -1).result(timeout=5)
+                os._exit(0 if result == 1 else 1)
+            except BaseException:
+                os._exit(1)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.waitstatus_to_exitcode(status), 0)
@@ -180,6 +180,7 @@ MIDDLEWARE = (
     "django.contrib.messages.middleware.MessageMiddleware",
     # 'django.middleware.clickjacking.XFrameOptionsMiddleware',
     "frontend.middleware.stp_redirect_middleware",
+    "matrixstore.middleware.matrixstore_timing_middleware",
 )
 # END MIDDLEWARE CONFIGURATION
 
@@ -352,6 +353,36 @@ SLACK_SENDING_ACTIVE = True
 ENABLE_CACHING = utils.get_env_setting_bool("ENABLE_CACHING", default=False)
 
 
+# Report time spent in MatrixStore code in a `Server-Timing` header on each
+# response, and log any individual query or RowGrouper call which takes longer
+# than the threshold (see `matrixstore.instrumentation`). Setting the threshold
+# to an empty value disables the slow query log.
+MATRIXSTORE_INSTRUMENTATION = utils.get_env_setting_bool(
+    "MATRIXSTORE_INSTRUMENTATION", default=False
+)
+_slow_query_threshold = utils.get_env_setting(
+    "MATRIXSTORE_SLOW_QUERY_THRESHOLD_MS", default="250"
+).strip()
+MATRIXSTORE_SLOW_QUERY_THRESHOLD_MS = (
+    float(_slow_query_threshold) if _slow_query_threshold else None
+)
+
+
+# Sizes (in MB) of the in-process caches which some expensive memoized
+# functions keep in addition to the shared cache (see `local_max_bytes` in
+# `matrixstore.cachelib.memoize`). Every worker process gets its own copy so
+# the defaults are small; set them to 0 to disable these caches entirely.
+PPU_QUANTITIES_LOCAL_CACHE_MB = int(
+    utils.get_env_setting("PPU_QUANTITIES_LOCAL_CACHE_MB", default="16")
+)
+PPU_SAVINGS_LOCAL_CACHE_MB = int(
+    utils.get_env_setting("PPU_SAVINGS_LOCAL_CACHE_MB", default="4")
+)
+GHOST_GENERICS_LOCAL_CACHE_MB = int(
+    utils.get_env_setting("GHOST_GENERICS_LOCAL_CACHE_MB", default="2")
+)
+
+
 # Total on-disk size of the cache. We want _some_ limit here so it doesn't grow
 # without bound, but I don't think we need to be too fussy about exactly what
 # it is as we're not short on disk space.  For reference, a month's worth of
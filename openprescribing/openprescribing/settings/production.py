@@ -80,6 +80,13 @@ LOGGING = {
             "filename": "%s/logs/mail-signals.log" % REPO_ROOT,
             "maxBytes": 1024 * 1024 * 100,  # 100 mb
         },
+        "matrixstore_slow_queries": {
+            "level": "DEBUG",
+            "class": "logging.handlers.RotatingFileHandler",
+            "formatter": "verbose",
+            "filename": "%s/logs/matrixstore-slow-queries.log" % REPO_ROOT,
+            "maxBytes": 1024 * 1024 * 100,  # 100 mb
+        },
         "sentry": {
             "level": "WARNING",
             "class": "raven.contrib.django.raven_compat.handlers.SentryHandler",
@@ -97,6 +104,11 @@ LOGGING = {
             "handlers": ["signals"],
             "propagate": False,
         },
+        "matrixstore.slow_queries": {
+            "level": "WARNING",
+            "handlers": ["matrixstore_slow_queries"],
+            "propagate": False,
+        },
     },
 }
 
@@ -379,6 +379,7 @@ urlpatterns = [
         r"robots.txt",
         TemplateView.as_view(template_name="robots.txt", content_type="text/plain"),
     ),
+    path(r"admin/memoize-stats/", views.memoize_stats, name="memoize_stats"),
     path(r"admin/", admin.site.urls),
     # bookmarks
     path(r"bookmarks/<key>/", views.bookmarks, name="bookmarks"),
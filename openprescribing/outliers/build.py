@@ -2,6 +2,7 @@ import shutil
 
 import pandas as pd
 from django.conf import settings
+from matrixstore.bnf_prefix_totals import get_totals_for_bnf_code_prefixes
 from matrixstore.build.dates import generate_dates
 from matrixstore.db import get_db, get_row_grouper
 
@@ -101,8 +102,7 @@ def prescribing_by_org(start_date, end_date, org_type, bnf_prefix):
     with given BNF prefix, prescribed in given time period.
     """
     db = get_db()
-    sql = f"select matrix_sum(items) from presentation where bnf_code like '{bnf_prefix}%'"
-    results = list(db.query_one(sql))[0]
+    results = get_totals_for_bnf_code_prefixes(db, [bnf_prefix], ["items"])[0]
     from_offset = db.date_offsets[start_date]
     to_offset = db.date_offsets[end_date] + 1
     filtered_results = results[:, from_offset:to_offset]
@@ -160,7 +160,7 @@ def delete_matrixstore_download(year, month):
     path = os.path.join(
         settings.PIPELINE_DATA_BASEDIR,
         "matrixstore_import",
-        f"{year}-{month}-01_prescribing.csv.gz",
+        f"{year}-{month}-01_prescribing.run",
     )
     os.remove(path)
 